@@ -1,6 +1,6 @@
 """Pypet page for oscilloscopes served by epicsdev-based server."""
 # pylint: disable=invalid-name
-__version__ = 'v1.3.3 2026-02-16'# fixed title.
+__version__ = 'v1.3.4 2026-10-19'# plot decimated display waveforms
 print(f'epicsScope {__version__}')
 
 #``````````````````Definitions````````````````````````````````````````````````
@@ -79,7 +79,8 @@ string or device:parameter and the value is dictionary of the features.
         #scopeWWW = {'WWW':{'launch':f'firefox http://{host}/Tektronix/#/client/c/   Tek%20e*Scope',
         #    **lColor, **ButtonFont, **span(1,2)}}
         PaneP2P = ' '.join([f'c{i+1:02}Peak2Peak' for i in range(channels)])
-        PaneWF = ' '.join([f'c{i+1:02}Waveform' for i in range(channels)])
+        # The decimated min/max envelopes are plotted instead of full waveforms
+        PaneWF = ' '.join([f'c{i+1:02}WaveformDisplay' for i in range(channels)])
         Plot = {'Plot':{'launch':f'{PyPath} pvplot -aV:{instance} -#0"{PaneP2P}" -#1"{PaneWF}" -#2"{PaneT}"',
             **lColor, **ButtonFont}}
         print(f'Plot command: {Plot}')
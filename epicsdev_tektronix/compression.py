@@ -0,0 +1,98 @@
+"""Compressed waveforms for the clients behind slow links.
+The raw int16 samples are delta-encoded, zigzag-mapped (0,-1,1,-2.. to
+0,1,2,3..), so that small deltas of either sign have zero high bytes, split
+into the planes of low and high bytes and compressed with lz4 (if
+installed) or zlib, with its fast run-length strategy. The result is a
+self-describing byte array, a client restores the waveform with
+
+    from epicsdev_tektronix.compression import decompress_waveform
+    waveform = decompress_waveform(ctx.get('tektronix0:c01WaveformCompressed'))
+
+It is equal to the c<nn>Waveform, in divisions, as float32.
+The module depends only on numpy, the lz4 is optional.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# decompress the bytes of compress_waveform()
+import zlib
+import struct
+import numpy as np
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from .processing import scale_waveform
+
+# Header: magic, codec index, number of points, scale, offset.
+# The waveform is raw*scale + offset.
+Header = struct.Struct('<4sBIdd')
+Magic = b'TKWZ'
+Codecs = ['zlib', 'lz4']
+ZlibLevel = 1# the fastest, higher levels gain little on the delta planes
+ZlibStrategy = zlib.Z_RLE# 3 times faster than the default, on noisy
+# waveforms it compresses better, the default wins only on noiseless ones
+
+def choose_codec(name='auto'):
+    """The codec name: lz4 if it is installed, when name is auto.
+    Raises ValueError if the codec is not available."""
+    if name == 'auto':
+        return 'zlib' if lz4 is None else 'lz4'
+    if name not in Codecs:
+        raise ValueError(f'Unknown codec {name}, expected one of {Codecs}')
+    if name == 'lz4' and lz4 is None:
+        raise ValueError('Codec lz4 is not installed, pip install lz4')
+    return name
+
+def compress_waveform(raw, scale:float, offset:float, codec='zlib',
+        buffers=None):
+    """Compress the raw int16 waveform, scale and offset into a byte
+    string. The intermediate arrays are taken from the processing Buffers,
+    if provided."""
+    n = len(raw)
+    get = (lambda _key,n,dtype: np.empty(n, dtype)) if buffers is None\
+        else buffers.get
+    delta = get('compressionDelta', n, np.dtype('<i2'))
+    sign = get('compressionSign', n, np.dtype('<i2'))
+    if n > 0:
+        delta[0] = raw[0]
+        np.subtract(raw[1:], raw[:-1], out=delta[1:])# wraps around
+    # zigzag: (delta << 1) ^ (delta >> 15)
+    np.right_shift(delta, 15, out=sign)
+    np.left_shift(delta, 1, out=delta)
+    np.bitwise_xor(delta, sign, out=delta)
+    planes = get('compressionPlanes', 2*n, np.dtype(np.uint8))
+    planes.reshape(2, n)[:] = delta.view(np.uint8).reshape(n, 2).T
+    if codec == 'lz4':
+        payload = lz4.frame.compress(planes.data)
+    else:
+        compressor = zlib.compressobj(ZlibLevel, zlib.DEFLATED, zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL, ZlibStrategy)
+        payload = compressor.compress(planes.data) + compressor.flush()
+    return Header.pack(Magic, Codecs.index(codec), n, scale, offset)\
+        + payload
+
+def decompress_waveform(blob, raw=False):
+    """Restore the waveform from the compressed byte array blob, returned
+    by compress_waveform() or received from the PV. Returns float32 array, scaled like c<nn>Waveform
+    or, if raw, the int16 samples."""
+    if isinstance(blob, (bytes, bytearray)):# from compress_waveform()
+        blob = np.frombuffer(blob, np.uint8)
+    blob = memoryview(np.asarray(blob, np.uint8)).cast('B')
+    magic, codec, n, scale, offset = Header.unpack_from(blob)
+    if magic != Magic:
+        raise ValueError('Not a compressed waveform')
+    payload = blob[Header.size:]
+    if Codecs[codec] == 'lz4':
+        if lz4 is None:
+            raise ValueError('The waveform is compressed with lz4, pip install lz4')
+        data = lz4.frame.decompress(payload)
+    else:
+        data = zlib.decompress(payload)
+    planes = np.frombuffer(data, np.uint8).reshape(2, n)
+    zigzag = np.empty(n, '<u2')
+    zigzag.view(np.uint8).reshape(n, 2)[:] = planes.T
+    delta = (zigzag >> 1).view(np.int16) ^ -(zigzag & 1).view(np.int16)
+    samples = np.cumsum(delta, dtype=np.int16)# the wrap-around undoes the one of the encoding
+    if raw:
+        return samples
+    return scale_waveform(samples, scale, offset)
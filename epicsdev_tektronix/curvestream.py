@@ -0,0 +1,147 @@
+"""Continuous acquisition with CURVEStream? of the 4/5/6 Series scopes.
+After the query the scope pushes the waveforms of all sources, selected by
+DATa:SOUrce, one binary block per source, for every acquisition, until it
+receives the next command or a device clear. A reader thread parses the
+blocks into buffers from a pool, so nothing is allocated per acquisition
+in the steady state, and queues complete acquisitions for publishing.
+If the publishing falls behind, the pool is exhausted and the reader stops
+reading, then the scope skips acquisitions, nothing is dropped here.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# bounded wait for the reader in stop()
+import time
+import queue
+import threading
+import numpy as np
+from pyvisa.errors import VisaIOError
+from pyvisa import constants
+
+from epicsdev.epicsdev import printi, printe
+
+DrainTimeout = 200# ms of silence, which means the streaming stopped
+StopTimeout = 1.# s to wait for the reader in stop()
+
+class CurveStreamer():
+    """Read CURVEStream? of channels (list of channel numbers) from the
+    session, which is held locked while streaming. The poolSize is the
+    number of acquisitions, which can wait for publishing."""
+    def __init__(self, session, lock, channels:list, poolSize=8,
+            bigEndian=False):
+        self.session = session
+        self.lock = lock
+        self.channels = channels
+        self.dtype = '>i2' if bigEndian else '<i2'
+        self.error = None# exception, which stopped the streaming
+        self.acquisitions = 0
+        self._pool = queue.Queue()
+        for _ in range(poolSize):
+            self._pool.put([np.empty(0, np.int16) for _ in channels])
+        self._ready = queue.Queue()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self, timeout:float):
+        """Return next acquisition as (trigTime, [waveform per channel]),
+        None if there was none during timeout. The waveforms must be
+        returned to the pool by release() after use."""
+        try:
+            return self._ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, waveforms:list):
+        """Return the waveforms of an acquisition to the pool"""
+        self._pool.put(waveforms)
+
+    def pending(self):
+        """Number of acquisitions waiting for publishing"""
+        return self._ready.qsize()
+
+    def stop(self, timeout=StopTimeout):
+        """Stop the streaming. The reader notices it after the current
+        acquisition or the session timeout, then it drains the stream and
+        releases the session. Returns False if the reader did not finish
+        within timeout, it finishes in the background."""
+        self._running = False
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    #``````````````Reader thread``````````````````````````````````````````````
+    def _run(self):
+        with self.lock:
+            try:
+                self.session.write('CURVEStream?')
+                printi(f'CURVEStream started for channels {self.channels}')
+                self._stream()
+            except Exception as e:
+                self.error = e
+                printe(f'CURVEStream stopped: {e}')
+            finally:
+                try:
+                    self._drain()
+                except Exception:
+                    pass
+
+    def _drain(self):
+        # Any command stops the streaming, the blocks, which are already
+        # on the way, are discarded.
+        self.session.write('*CLS')
+        timeout = self.session.timeout
+        self.session.timeout = DrainTimeout
+        try:
+            while True:
+                self.session.read_raw()
+        except VisaIOError:
+            pass
+        finally:
+            self.session.timeout = timeout
+            self.session.clear()
+
+    def _stream(self):
+        while self._running:
+            try:
+                buffers = self._pool.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            waveforms = None
+            while waveforms is None and self._running:
+                try:
+                    waveforms = self._read_acquisition(buffers)
+                except VisaIOError as e:
+                    if e.error_code != constants.StatusCode.error_timeout:
+                        raise
+                    # no trigger during the timeout
+            if waveforms is None:
+                self._pool.put(buffers)
+                return
+            self.acquisitions += 1
+            self._ready.put((time.time(), waveforms))
+
+    def _read_acquisition(self, buffers:list):
+        """Read blocks of all channels into the buffers, reallocating them
+        if the record length changed. Timeout is raised only if nothing
+        of the acquisition was received."""
+        waveforms = []
+        for i in range(len(self.channels)):
+            started = False
+            try:
+                # Format: [\n]#<x><yyy><data>
+                # where x is number of digits in yyy, yyy is number of bytes
+                c = self.session.read_bytes(1)
+                while c != b'#':# skip the terminators of the previous block
+                    c = self.session.read_bytes(1)
+                started = True
+                ndigits = int(self.session.read_bytes(1))
+                npoints = int(self.session.read_bytes(ndigits))//2
+                if len(buffers[i]) != npoints:
+                    buffers[i] = np.empty(npoints, np.int16)
+                data = self.session.read_bytes(npoints*2)
+            except VisaIOError as e:
+                if i == 0 and not started:
+                    raise
+                # the acquisition is incomplete, the stream is out of sync
+                raise RuntimeError(f'incomplete acquisition: {e}') from e
+            buffers[i][:] = np.frombuffer(data, self.dtype)
+            waveforms.append(buffers[i])
+        return waveforms
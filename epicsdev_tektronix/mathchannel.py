@@ -0,0 +1,109 @@
+"""Math channels: waveforms derived from the acquired channels by restricted
+arithmetic expressions, e.g. CH1-CH2, CH1*CH2 or integral(CH1).
+The expression is parsed and validated once, when it is set, into a program
+of numpy operations. Each operation stores its result into its own reusable
+buffer, so the evaluation on every trigger does not re-parse the expression
+and does not allocate in the steady state.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# too long and too deep expressions are rejected
+import ast
+import re
+import numpy as np
+
+from .processing import Buffers, scale_waveform
+
+BinaryOps = {ast.Add:np.add, ast.Sub:np.subtract, ast.Mult:np.multiply,
+    ast.Div:np.divide, ast.Pow:np.power}
+UnaryOps = {ast.USub:np.negative, ast.UAdd:np.positive}
+Functions = {'abs':np.absolute, 'sqrt':np.sqrt, 'integral':None}
+MaxLength = 1000# characters of an expression
+Help = 'operators + - * / **, functions abs(), sqrt(), integral(), '\
+    'channels CH<n>, numbers'
+
+class MathChannel():
+    """Compiled expression over channels CH1..CH<nchannels>, which are in
+    volts. The integral() is the running integral over time, in V*s.
+    Raises ValueError if the expression is not valid."""
+    def __init__(self, text:str, nchannels:int):
+        self.text = text
+        self.nchannels = nchannels
+        self.channels = set()
+        self.loads = {}# {channel: slot}, a channel is scaled only once
+        self.program = []# [(function, operand slots or constants, slot)]
+        if len(text) > MaxLength:
+            raise ValueError(f'Expression is longer than {MaxLength} characters')
+        try:
+            tree = ast.parse(text, mode='eval')
+            self.result = self._compile(tree.body)
+        except SyntaxError as e:
+            raise ValueError(f'Syntax error in {text!r}: {e.msg}') from None
+        except (RecursionError, MemoryError):# of the parser or _compile()
+            raise ValueError(f'Expression {text[:40]!r}... is nested too deeply') from None
+        except OverflowError as e:# of a huge constant
+            raise ValueError(f'In {text[:40]!r}...: {e}') from None
+        if not isinstance(self.result, int):
+            raise ValueError(f'Expression {text!r} does not use any channel')
+        self.channels = sorted(self.channels)
+        self.buffers = Buffers()
+
+    def _slot(self, function, operands):
+        self.program.append((function, operands, len(self.program)))
+        return len(self.program) - 1
+
+    def _compile(self, node):
+        """Compile the node, return its slot or, if it is constant, its
+        value"""
+        if isinstance(node, ast.Constant) and type(node.value) in (int,float):
+            return float(node.value)
+        if isinstance(node, ast.Name):
+            m = re.fullmatch(r'CH(\d+)', node.id)
+            if m is None or not 1 <= int(m.group(1)) <= self.nchannels:
+                raise ValueError(f'Unknown channel {node.id}, expected CH1..CH{self.nchannels}')
+            ch = int(m.group(1))
+            self.channels.add(ch)
+            if ch not in self.loads:
+                self.loads[ch] = self._slot('load', (ch,))
+            return self.loads[ch]
+        if isinstance(node, ast.BinOp) and type(node.op) in BinaryOps:
+            operands = (self._compile(node.left), self._compile(node.right))
+            function = BinaryOps[type(node.op)]
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UnaryOps:
+            operands = (self._compile(node.operand),)
+            function = UnaryOps[type(node.op)]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name)\
+          and node.func.id in Functions and len(node.args) == 1\
+          and not node.keywords:
+            operands = (self._compile(node.args[0]),)
+            function = Functions[node.func.id] or 'integral'
+        else:
+            raise ValueError(f'Not allowed in {self.text!r}: {ast.unparse(node)}, use {Help}')
+        if all([isinstance(o, float) for o in operands]):
+            if function == 'integral':
+                raise ValueError(f'integral() of a constant in {self.text!r}')
+            with np.errstate(all='ignore'):# folded once
+                return float(function(*operands))
+        return self._slot(function, operands)
+
+    def evaluate(self, acquired:dict, xincrement:float):
+        """Evaluate the expression. The acquired is the
+        {channel: (raw samples, scale, offset)} map, the volts are
+        raw*scale + offset. Returns float32 array, valid until the next
+        evaluation."""
+        npoints = len(acquired[self.channels[0]][0])
+        values = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for function, operands, slot in self.program:
+                out = self.buffers.get(slot, npoints, np.float32)
+                if function == 'load':
+                    raw, scale, offset = acquired[operands[0]]
+                    scale_waveform(raw, scale, offset, out)
+                elif function == 'integral':
+                    acc = self.buffers.get('integral', npoints, np.float64)
+                    np.cumsum(values[operands[0]], out=acc)
+                    np.multiply(acc, xincrement, out=out, casting='unsafe')
+                else:
+                    function(*[values[o] if isinstance(o, int) else o
+                        for o in operands], out=out)
+                values.append(out)
+        return values[self.result]
@@ -1,20 +1,40 @@
 """EPICS PVAccess server for Tektronix MSO oscilloscopes using epicsdev module."""
 # pylint: disable=invalid-name
-__version__ = 'v1.0.3 26-02-13'# cleanup
+__version__ = 'v1.1.37 26-10-19'# span arguments not built with tracing off
 # Note, visa INSTR works more reliably than SOCKET, but waveform acquisition is ~10 times slower
 #TODO: Timing does not match for 0.3 s: cycleTime=2.0, acquire_wf=0.7, sleep=1.0
 import sys
+import os
 import time
+import re
+import json
+import math as pymath
+import hashlib
 from time import perf_counter as timer
 import argparse
 import threading
+import zlib
 import numpy as np
 
 import pyvisa as visa
 from pyvisa.errors import VisaIOError
+from p4p import Type, Value
+from p4p.server.thread import SharedPV
+from p4p.nt.enum import ntenum
 
+from .recorder import Recorder, write_record
+from .ringbuffer import RingBuffer
+from .shmexport import ShmWriter, MaxChannels as MaxShmChannels
+from .processing import channel_products, StreamingProducts, Buffers,\
+    digital_products, DigitalLines, pulse_products
+from .offload import Offloader
+from .curvestream import CurveStreamer
+from .mathchannel import MathChannel, Help as MathHelp
+from .tracing import Tracer, NullTracer, NullSpan
+from .replay import Capture, Replay
+from .compression import compress_waveform, choose_codec
 from epicsdev.epicsdev import  Server, SPV, init_epicsdev, sleep,\
-    serverState, set_server, publish, pvv,\
+    serverState, set_server, publish, pvobj, pvv,\
     printi, printe, printw, printv, printvv
 
 #``````````````````Constants
@@ -25,7 +45,31 @@ IF_CHANGED =True
 ElapsedTime = {}
 NDIVSX = 10# number of horizontal divisions of the scope display
 NDIVSY = 10# number of vertical divisions
+ErrCountLimit = 2# consecutive failed trigger queries, which mean lost connection
+# Transport tuning: timeout is TimeoutMargin times the expected transfer time
+# plus TimeoutLatency, the chunk size is limited to the ChunkSizeRange
+TimeoutMargin = 3.
+TimeoutLatency = 1.# s
+ChunkSizeRange = (20*1024, 4*1024*1024)# 20 KiB is the default of pyvisa
 BigEndian = False# Defined in configure_scope(WFMOUTPRE:BYT_Or LSB)
+BytesPerPoint = 2# Defined in configure_scope(WFMOUTPRE:BYT_NR 2)
+# Channel PVs, which clients are tracked for demand-driven acquisition
+PulseDataPVs = ['PulseTimes','PulseWidths','PulseHeights','PulseSamples',
+    'PulseSegments']
+ChannelDataPVs = ['Waveform','WaveformDisplay','Mean','Peak2Peak',
+    'WaveformCompressed'] + PulseDataPVs
+# Settings, which are synchronized with the instrument in the fast tier,
+# the rest of the SCPI PVs are in the slow tier
+VolatileSettings = ['trigState','samplingRate','recLengthR','timePerDiv',
+    'trigDelay','horzMode']
+UserRequest = 0x40# URQ bit of the event status register: front panel used
+# Steps of the acquisition, the slowest is reported by the --replay
+ReplaySteps = ['trigger_detection','preamble','query_wf','publish_wf']
+SaturationRatio = 0.95# the replay is saturated below this part of the offered rate
+# PVs of the math channels, which clients are tracked
+MathDataPVs = ['Waveform','Mean','Peak2Peak']
+# PVs of the digital channels, which clients are tracked
+DigitalDataPVs = ['Bits','Edges','EdgeCounts']
 #``````````````````PVs defined here```````````````````````````````````````````
 def myPVDefs():
     """PV definitions"""
@@ -36,12 +80,47 @@ def myPVDefs():
 ['setup', 'Save/recall instrument state to/from latest or operational setup',
     SPV(['Setup','Save latest','Save oper','Recall latest','Recall oper'],'WD'),{
     SET:set_setup}],
+['syncChanges', 'Number of settings changed on the instrument, detected by the settings sync',
+    SPV(0), {}],
+['traceDump',   'Write the recorded acquisition trace to the file with this name in --cacheDir, in Chrome trace format, viewable in https://ui.perfetto.dev. Requires --trace',
+    SPV('','W'), {SET:set_traceDump}],
+['traceSpans',  'Number of spans in the trace buffer', SPV(0), {}],
+['snapshotSave', 'Capture the current settings into the host-side snapshot with this name',
+    SPV('','W'), {SET:set_snapshotSave}],
+['snapshotRestore', 'Restore the snapshot with this name, only the differing settings are written. <name> full: restore the complete instrument setup',
+    SPV('','W'), {SET:set_snapshotRestore}],
+['snapshots',   'Names of the saved snapshots', SPV(''), {}],
+['snapshotChanges', 'Number of settings written by the last snapshot restore', SPV(0), {}],
+['snapshotRestoreTime', 'Duration of the last snapshot restore, including the verification',
+    SPV(0.), {U:'ms'}],
 ['visaResource', 'VISA resource to access the device', SPV(pargs.resource,'R'), {}],
+['connection',  'State of the connection to the device', SPV('Connecting'), {}],
+['reconnects',  'Number of restored connections', SPV(0), {}],
+['reconnectAttempts', 'Number of attempts to reconnect', SPV(0), {}],
+['downtime',    'Total time the device was disconnected', SPV(0.), {U:'S'}],
+['linkMBps',    'Measured throughput of waveform transfers', SPV(0.), {U:'MB/s'}],
+['tunedTimeout', 'VISA timeout of waveform transfers, chosen by --autoTune',
+    SPV(0), {U:'ms'}],
+['tunedChunkSize', 'VISA read chunk size, chosen by --autoTune', SPV(0), {U:'B'}],
+['controlLatency', 'Round-trip time of the last control command, including the wait for the busy session',
+    SPV(0.), {U:'ms'}],
 ['dateTime',    'Scope`s date & time', SPV('N/A'), {}],
 ['acqCount',    'Number of acquisition recorded', SPV(0), {}],
+['timeToFirstPublish', 'Time from the process start to the first published acquisition',
+    SPV(0.), {U:'S'}],
 ['scopeAcqCount',  'Acquisition count of the scope', SPV(0),{
     SCPI:'ACQuire:NUMACq'}],
 ['lostTrigs',   'Number of triggers lost',  SPV(0), {}],
+['acqRate',     'Rate of published acquisitions', SPV(0.), {U:'Hz'}],
+['streamPending', 'Number of streamed acquisitions waiting for publishing',
+    SPV(0), {}],
+['rearmLatency', 'Dead time of the --sequence mode: from the detection of the completed sequence to the re-arm, including the readout',
+    SPV(0.), {U:'ms'}],
+['gapFreeRate', 'Rate of the completed sequences in the --sequence mode, all channels of each are from the same trigger',
+    SPV(0.), {U:'Hz'}],
+['replayRate',  'Rate of the acquisitions offered by the --replay', SPV(0.), {U:'Hz'}],
+['replayReport', 'Whether the server sustains the rate offered by the --replay, and its slowest acquisition step',
+    SPV(''), {}],
 ['instrCtrl',   'Scope control commands',
     SPV('*IDN?,*RST,*CLS,*ESR?,*OPC?,*STB?'.split(','),'WD'), {}],
 ['instrCmdS',   'Execute a scope command. Features: RWE',  SPV('*IDN?','W'),{
@@ -62,7 +141,13 @@ def myPVDefs():
     SCPI:'HORizontal:SAMPLERate'}],
 ['timePerDiv', f'Horizontal scale (1/{NDIVSX} of full scale)', SPV(2.e-6,'W'), {U:'S/du',
     SCPI: 'HORizontal:SCAle', SET:set_scpi}],
-['tAxis',       'Horizontal axis array', SPV([0.]), {U:'S'}],
+['xOrigin',     'Time of the first waveform point', SPV(0.,'','f64'), {U:'S'}],
+['xIncrement',  'Time between waveform points', SPV(0.,'','f64'), {U:'S'}],
+['tAxis',       'Horizontal axis array, published with --fullTAxis or while watched',
+    SPV([0.]), {U:'S'}],
+['displayWidth', 'Number of points in the decimated display waveforms',
+    SPV(2000,'W','u32'), {SET:set_displayWidth, LL:2, LH:1000000}],
+['tAxisDisplay', 'Horizontal axis of the display waveforms', SPV([0.]), {U:'S'}],
 
 #``````````````````Trigger PVs
 ['trigger',     'Click to force trigger event to occur',
@@ -86,6 +171,37 @@ def myPVDefs():
 ['trigLevel', 'Trigger level', SPV(0.,'W'), {U:'V',SET:set_trigLevel}],
 #``````````````````Auxiliary PVs
 ['timing',  'Performance timing: trigger,waveforms,preamble,query,publish', SPV([0.]), {U:'S'}],
+['skippedMB', 'Waveform transfers skipped as no client watched the channel',
+    SPV(0.), {U:'MB'}],
+['maxRates', 'Max publish rates of channel PVs, e.g. Waveform:2,WaveformDisplay:5',
+    SPV(pargs.maxRates,'W'), {SET:set_maxRates}],
+['suppressUnchanged', 'Do not publish waveforms, which did not change',
+    SPV(['0','1'],'WD'), {}],
+['throttledUpdates', 'Number of updates dropped due to maxRates', SPV(0), {}],
+['unchangedUpdates', 'Number of unchanged waveforms not published', SPV(0), {}],
+['acqAllocations', 'Number of processing buffer allocations in the last acquisition, 0 in the steady state. The arrays received from the instrument are not counted',
+    SPV(0), {}],
+['acqAllocatedBytes', 'Bytes of processing buffers allocated in the last acquisition',
+    SPV(0), {U:'B'}],
+['offloadPending', 'Number of channels waiting for processing in worker processes',
+    SPV(0), {}],
+#``````````````````Recorder PVs
+['recordFile',  'File, the acquisitions are recorded to', SPV(''), {}],
+['recordQueue', 'Number of acquisitions waiting to be written', SPV(0), {}],
+['recordDropped', 'Number of acquisitions not recorded', SPV(0), {}],
+['recordMBps',  'Recording throughput', SPV(0.), {U:'MB/s'}],
+#``````````````````Ring buffer PVs
+['ringRange',   'acqCounts of the oldest and newest acquisitions in the ring buffer',
+    SPV([0,0]), {}],
+['ringRecall',  'Publish acquisition with this acqCount from the ring buffer in the history PV',
+    SPV(0,'W'), {SET:set_ringRecall}],
+['ringDump',    'Dump acquisitions first-last from the ring buffer to file',
+    SPV('','W'), {SET:set_ringDump}],
+#``````````````````Structured PVs
+['acquisition', 'All channels of a trigger in one update: acqCount, trigTime, xOrigin, xIncrement and raw waveforms with their scale and offset',
+    create_acquisitionPV(), {}],
+['history',     'Acquisition recalled from the ring buffer by ringRecall, same structure as the acquisition',
+    create_historyPV(), {}],
     ]
 
     #``````````````Templates for channel-related PVs.
@@ -103,8 +219,33 @@ def myPVDefs():
 ['c<n>Termination', 'Input termination', ('50.000','W'), {U:'Ohm',
     SCPI:'CH<n>:TERmination', SET:set_scpi}],
 ['c<n>Waveform', 'Waveform array',           ([0.],), {U:'du'}],
+['c<n>WaveformDisplay', 'Min/max envelope of the waveform, decimated to displayWidth',
+    ([0.],), {U:'du'}],
+['c<n>WaveformCompressed', 'Waveform for clients behind slow links: delta-encoded raw samples, compressed with --codec. Decode with epicsdev_tektronix.compression.decompress_waveform()',
+    ([0],'','u8'), {}],
+['c<n>CompressionRatio', 'Size of the Waveform over the size of the WaveformCompressed',
+    (0.,), {}],
+['c<n>CompressionTime', 'CPU time of the compression of the last waveform', (0.,), {U:'ms'}],
 ['c<n>Mean',     'Mean of the waveform',     (0.,'A'), {U:'du'}],
 ['c<n>Peak2Peak','Peak-to-peak amplitude',   (0.,'A'), {U:'du',**alarm}],
+['c<n>PulseThreshold', 'Threshold of the pulse detection', (0.5,'W'), {U:'du'}],
+['c<n>PulseHysteresis', 'The pulse ends when the waveform returns beyond the threshold by this amount',
+    (0.1,'W'), {U:'du'}],
+['c<n>PulsePolarity', 'Polarity of the detected pulses', (['POSITIVE','NEGATIVE'],'WD'), {}],
+['c<n>PulseWindow', 'Number of samples before and after each pulse in PulseSamples',
+    (50,'W'), {LL:0, LH:1000000}],
+['c<n>PulseTimes', 'Times of the threshold crossings by the leading edges of pulses',
+    ([0.],'','f64'), {U:'S'}],
+['c<n>PulseWidths', 'Widths of pulses, from the threshold to the end of the hysteresis',
+    ([0.],), {U:'S'}],
+['c<n>PulseHeights', 'Peak values of pulses', ([0.],), {U:'du'}],
+['c<n>PulseSamples', 'Zero-suppressed waveform: the samples around pulses only',
+    ([0.],), {U:'du'}],
+['c<n>PulseSegments', 'First sample index and length of each segment of PulseSamples, interleaved',
+    ([0],'','u32'), {}],
+['c<n>AlwaysRead','Read the channel even if no client watches it, e.g. for archiving',
+    (['0','1'],'WD'), {}],
+['c<n>Clients', 'Number of channel PVs watched by clients', (0,), {}],
     ]
     # extend PvDefs with channel-related PVs
     for ch in range(pargs.channels):
@@ -113,6 +254,40 @@ def myPVDefs():
             newpvdef[0] = pvdef[0].replace('<n>',f'{ch+1:02}')
             newpvdef[2] = SPV(*pvdef[2])
             pvDefs.append(newpvdef)
+
+    #``````````````Templates for math channels, derived from the analog ones
+    MathTemplates = [
+['m<n>Expression', f'Expression of the math channel over channels in volts: {MathHelp}, e.g. CH1*CH2',
+    ('','W'), {SET:set_mathExpression}],
+['m<n>Waveform', 'Waveform of the math channel', ([0.],), {}],
+['m<n>Mean',     'Mean of the math waveform', (0.,), {}],
+['m<n>Peak2Peak','Peak-to-peak amplitude of the math waveform', (0.,), {}],
+['m<n>Clients',  'Number of math data PVs watched by clients', (0,), {}],
+    ]
+    for mch in range(1, pargs.mathChannels+1):
+        for pvdef in MathTemplates:
+            newpvdef = pvdef.copy()
+            newpvdef[0] = pvdef[0].replace('<n>',f'{mch:02}')
+            newpvdef[2] = SPV(*pvdef[2])
+            pvDefs.append(newpvdef)
+
+    #``````````````Templates for digital channels, i.e. FlexChannels with
+    # logic probes. All lines of a channel are transferred in one byte per
+    # sample.
+    DigitalTemplates = [
+['d<n>Bits', f'Bit-packed logic lines D0-D{DigitalLines-1}, shaped ({DigitalLines}, ceil(recLengthR/8))',
+    ([0],'','u8'), {}],
+['d<n>Edges', 'Indices of the transitions of all lines, line D0 first',
+    ([0],'','u32'), {}],
+['d<n>EdgeCounts', 'Number of transitions of each line', ([0]*DigitalLines,), {}],
+['d<n>Clients', 'Number of digital data PVs watched by clients', (0,), {}],
+    ]
+    for ch in pargs.digitalList:
+        for pvdef in DigitalTemplates:
+            newpvdef = pvdef.copy()
+            newpvdef[0] = pvdef[0].replace('<n>',f'{ch:02}')
+            newpvdef[2] = SPV(*pvdef[2])
+            pvDefs.append(newpvdef)
     return pvDefs
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 class C_():
@@ -122,22 +297,75 @@ class C_():
     setterMap = {}
     PvDefs = []
     readSettingQuery = None
-    exceptionCount = {}
+    idn = ''
+    startTime = 0.# of the process, for timeToFirstPublish
+    firstPublished = False
+    resourceManager = None
+    connected = False
+    queryErrors = 0# consecutive failures of the trigger query
+    reconnectDelay = 1.# current backoff interval
+    nextAttempt = 0.# time of the next reconnect attempt
+    downSince = 0.
+    downtime = 0.# of the previous disconnections
+    reconnects = 0
+    reconnectAttempts = 0
+    dataScope = None# session for waveform transfers, it is the scope by default
+    dataLock = Threadlock# lock of the dataScope
+    dataErrors = 0# consecutive failures of waveform transfers
+    linkMBps = 0.# moving average of the waveform transfer throughput
+    streamer = None# CurveStreamer of the --curveStream mode
+    streamRestart = False# settings changed, the streaming needs to restart
+    lastRate = (0., 0, 0, 0)# time, acqCount, sequences and replayed acquisitions of the last acqRate calculation
+    armed = False# a sequence is armed in the --sequence mode
+    sequences = 0# completed and read sequences
     numacq = 0
     triggersLost = 0
     trigTime = 0
     previousScopeParametersQuery = ''
     channelsTriggered = []
     npoints = 0
+    xorigin = 0.
+    xincrement = 1.
+    displayStep = 1# number of samples per min/max bin of display waveforms
+    displayAxisPoints = 0# waveform length, the tAxisDisplay is for
     #ypars = None
     ymult = []
     yoff = []# not used
     yzero = []
+    watchedPVs = set()# channel data PVs having clients
+    bytesSkipped = 0
+    maxRates = {}# {PV suffix: max publish rate}
+    lastPublished = {}# {pvName: time of last publishing}
+    ringTooLong = 0# waveform length, which did not fit into the ring buffer
+    shmTooLong = 0# waveform length, which did not fit into the shared memory
+    throttledUpdates = 0
+    waveformSignature = {}# {pvName: (checksum, scale)} of the last published waveform
+    unchangedUpdates = 0
+    acquired = {}# {channel: (raw waveform, scale, offset)} of the last acquisition
+    acquisitionType = None
+    recorder = None
+    ring = None
+    shm = None
+    offloader = None
+    buffers = {}# {channel: Buffers} for the processing products
+    math = {}# {math channel number: MathChannel}
+    snapshots = {}# {name: snapshot} of the setup snapshots
+    tracer = NullTracer()# Tracer with --trace
+    capture = None# Capture of the instrument sessions with --capture
+    replay = None# Replay, which replaces the instrument with --replay
+    replaySaturated = None
+    replayPeakRate = 0.# max acqRate during the replay
+    syncTiers = ([], [])# PV names of the fast and slow tiers of the sync
+    nextFastSync = 0.
+    volatileChanged = False# a volatile setting, published by triggered(), changed
+    nextSlowSync = 0.
+    syncChanges = 0
 #``````````````````Setters````````````````````````````````````````````````````
 def scopeCmd(cmd):
     """Send command to scope, return reply if any."""
     printv(f'>scopeCmd: {cmd}')
     reply = None
+    ts = timer()
     try:
         if cmd[-1] == '?':
             with Threadlock:
@@ -147,6 +375,9 @@ def scopeCmd(cmd):
                 C_.scope.write(cmd)
     except:
         handle_exception(f'in scopeCmd{cmd}')
+        return reply
+    # including the wait for the session, which may be busy with acquisition
+    publish('controlLatency', round((timer() - ts)*1000.,3))
     return reply
 
 def set_instrCmdS(cmd, *_):
@@ -157,13 +388,18 @@ def set_instrCmdS(cmd, *_):
         publish('instrCmdR',reply)
     publish('instrCmdS',cmd)
 
+def override_sleep(seconds:float, reason:str):
+    """Set the sleep PV, which is chosen by the acquisition mode"""
+    printi(f'Sleeping per cycle {seconds} S instead of {float(pvv("sleep"))} S: {reason}')
+    publish('sleep', seconds)
+
 def serverStateChanged(newState:str):
     """Start device function called when server is started"""
     if newState == 'Start':
         printi('start_device called')
         configure_scope()
     elif newState == 'Stop':
-        printi('stop_device called')
+        printi('stop_device called')# the main loop stops the CURVEStream
     elif newState == 'Clear':
         printi('clear_device called')
     adopt_local_setting()
@@ -197,6 +433,80 @@ def set_setup(action_slot, *_):
         adopt_local_setting()
     return OK
 
+def set_snapshotSave(name, *_):
+    """setter for the snapshotSave PV"""
+    name = str(name).strip()
+    printv(f'set_snapshotSave: {name}')
+    if re.fullmatch(r'[\w.-]+', name) is None:
+        printw(f'Wrong snapshot name: {name!r}, use letters, digits, _.-')
+        return NotOK
+    try:
+        snapshot = capture_snapshot()
+    except:
+        handle_exception('in capture_snapshot')
+        return NotOK
+    if snapshot is None:
+        return NotOK
+    C_.snapshots[name] = snapshot
+    save_snapshots()
+    publish('snapshots', ','.join(C_.snapshots))
+    publish('snapshotSave', name)
+    printi(f'Snapshot {name} saved')
+    return OK
+
+def set_snapshotRestore(value, *_):
+    """setter for the snapshotRestore PV"""
+    printv(f'set_snapshotRestore: {value}')
+    words = str(value).split()
+    snapshot = C_.snapshots.get(words[0]) if words else None
+    if snapshot is None:
+        printw(f'No snapshot {value!r}, available: {",".join(C_.snapshots)}')
+        return NotOK
+    ts = timer()
+    try:
+        if words[1:] == ['full']:
+            with Threadlock:
+                C_.scope.write(snapshot['setup'])
+            adopt_local_setting()
+            changes = len(snapshot['settings'])
+        else:
+            changes = restore_snapshot(snapshot)
+    except:
+        handle_exception('in restore of snapshot')
+        return NotOK
+    if changes and C_.streamer is not None:
+        C_.streamRestart = True# the scaling may change
+    publish('snapshotChanges', changes)
+    publish('snapshotRestoreTime', round((timer() - ts)*1000.,3))
+    publish('snapshotRestore', str(value))
+    printi(f'Snapshot {words[0]} restored, {changes} settings changed')
+    return OK
+
+def set_traceDump(filename, *_):
+    """setter for the traceDump PV"""
+    filename = str(filename).strip()
+    printv(f'set_traceDump: {filename}')
+    if not C_.tracer.enabled:
+        printw('Tracing is off, start the server with --trace')
+        return NotOK
+    # a client may write only into the cache directory
+    if filename in ('', '.', '..') or os.path.basename(filename) != filename:
+        printw(f'Wrong traceDump {filename}: expected a file name, without directory')
+        return NotOK
+    if not pargs.cacheDir:
+        printw('Trace cannot be written, --cacheDir is empty')
+        return NotOK
+    path = os.path.join(pargs.cacheDir, filename)
+    try:
+        os.makedirs(pargs.cacheDir, exist_ok=True)
+        n = C_.tracer.dump(path)
+    except Exception as e:
+        printw(f'Could not write trace {path}: {e}')
+        return NotOK
+    printi(f'{n} spans written to {path}')
+    publish('traceDump', filename)
+    return OK
+
 def set_trigger(value, *_):
     """setter for the trigger PV"""
     printv(f'set_trigger: {value}')
@@ -220,6 +530,91 @@ def set_recLengthS(value, *_):
         C_.scope.write(f'HORizontal:RECOrdlength {value}')
     publish('recLengthS', value)
 
+def set_maxRates(value, *_):
+    """setter for the maxRates PV"""
+    printv(f'set_maxRates: {value}')
+    maxRates = {}
+    try:
+        for item in str(value).split(','):
+            if item.strip() == '':
+                continue
+            suffix,rate = item.split(':')
+            maxRates[suffix.strip()] = float(rate)
+    except ValueError:
+        printw(f'Wrong maxRates: {value}, should be like Waveform:2,Mean:10')
+        return NotOK
+    C_.maxRates = maxRates
+    C_.lastPublished = {}
+    publish('maxRates', value)
+    return OK
+
+def set_mathExpression(value, pv, *_):
+    """setter for the m<nn>Expression PVs. The expression is compiled
+    here, once, an empty one disables the math channel."""
+    printv(f'set_mathExpression({value},{pv.name})')
+    mch = int(pv.name[1:3])
+    text = str(value).strip()
+    if text == '':
+        C_.math.pop(mch, None)
+        C_.buffers.pop(f'm{mch:02}', None)
+    else:
+        try:
+            math = MathChannel(text, pargs.channels)
+        except ValueError as e:
+            printw(f'Wrong {pv.name}: {e}')
+            return NotOK
+        C_.math[mch] = math
+        C_.buffers[f'm{mch:02}'] = math.buffers# for allocation_totals
+    publish(pv.name, text)
+    return OK
+
+def set_ringRecall(value, *_):
+    """setter for the ringRecall PV"""
+    printv(f'set_ringRecall: {value}')
+    if C_.ring is None:
+        printw('Ring buffer is not enabled, use --ring option')
+        return NotOK
+    index = C_.ring.find(int(value))
+    if index is None:
+        printw(f'Acquisition {value} is not in the ring buffer {C_.ring.range()}')
+        return NotOK
+    acqCount, trigTime, xorigin, xincrement, acquired = C_.ring.read(index)
+    pvobj('history').post(acquisitionValue(acqCount, trigTime, xorigin,
+        xincrement, acquired))
+    publish('ringRecall', value)
+    return OK
+
+def set_ringDump(value, *_):
+    """setter for the ringDump PV. The value is the range of acqCounts,
+    e.g. 100-200, the acquisitions are written in the binary format of
+    the recorder."""
+    printv(f'set_ringDump: {value}')
+    if C_.ring is None:
+        printw('Ring buffer is not enabled, use --ring option')
+        return NotOK
+    try:
+        first,last = [int(i) for i in str(value).split('-')]
+    except ValueError:
+        printw(f'Wrong ringDump range: {value}, should be like 100-200')
+        return NotOK
+    filename = f'{C_.ring.filename}_{first}-{last}.bin'
+    n = 0
+    with open(filename, 'wb') as f:
+        for index in C_.ring.indexes():
+            acquisition = C_.ring.read(index)
+            if first <= acquisition[0] <= last and acquisition[4]:
+                write_record(f, *acquisition)
+                n += 1
+    printi(f'{n} acquisitions dumped to {filename}')
+    publish('ringDump', value)
+    return OK
+
+def set_displayWidth(value, *_):
+    """setter for the displayWidth PV"""
+    printv(f'set_displayWidth: {value}')
+    publish('displayWidth', value)
+    update_displayAxis()
+
 def set_scpi(value, pv, *_):
     """setter for SCPI-associated PVs"""
     printv(f'set_scpi({value},{pv.name})')
@@ -233,6 +628,8 @@ def set_scpi(value, pv, *_):
         scpi = f':HORizontal:MODE MANUAL;:{scpi}'
         print(f'setting recLengthS: {scpi}')
     printv(f'set_scpi command: {scpi}')
+    if C_.streamer is not None:
+        C_.streamRestart = True# the scaling may change
     reply = scopeCmd(scpi)
     if reply is not None:
         publish(pv.name, reply)
@@ -258,10 +655,17 @@ def configure_scope():
         C_.scope.write('HORizontal:DELay:MODe ON')
         C_.scope.write('HORizontal:MODE MANual')
         C_.scope.write('HORizontal:MODE:MANual:CONFIGure HORIZontalscale')
-        C_.scope.write((  ':WFMOUTPRE:ENCdg BINARY;'
-                        ':WFMOUTPRE:BN_Fmt RI;'
-                        ':WFMOUTPRE:BYT_NR 2;'
-                        f':WFMOUTPRE:BYT_Or LSB;'))
+    # the data session may have its own transfer settings
+    for session,lock in {C_.scope:Threadlock, C_.dataScope:C_.dataLock}.items():
+        with lock:
+            session.write((  ':WFMOUTPRE:ENCdg BINARY;'
+                            ':WFMOUTPRE:BN_Fmt RI;'
+                            ':WFMOUTPRE:BYT_NR 2;'
+                            f':WFMOUTPRE:BYT_Or LSB;'))
+    if pargs.sequence:
+        with Threadlock:
+            C_.scope.write('ACQuire:STOPAfter SEQuence')
+        C_.armed = False
 
 def update_scopeParameters():
     """Update sensitive scope parameters"""
@@ -297,62 +701,361 @@ def update_scopeParameters():
         xorigin = xzero
         xincrement = xincr
         C_.npoints = npoints
-        taxis = np.arange(0, C_.npoints) * xincrement + xorigin
-        publish('tAxis', taxis)
+        C_.xorigin = xorigin
+        C_.xincrement = xincrement
+        publish('xOrigin', xorigin, IF_CHANGED)
+        publish('xIncrement', xincrement, IF_CHANGED)
+        if pargs.fullTAxis or 'tAxis' in C_.watchedPVs:
+            publish_tAxis()
+        update_displayAxis()
         publish('recLengthR', C_.npoints, IF_CHANGED)
         publish('timePerDiv', C_.npoints*xincrement/NDIVSX, IF_CHANGED)
         publish('samplingRate', 1./xincrement, IF_CHANGED)
     C_.previousScopeParametersQuery = currentScopeParameters
 
-def init_visa():
-    '''Init VISA interface to device'''
-    try:
-        rm = visa.ResourceManager('@py')
-    except ModuleNotFoundError as e:
-        printe(f'in visa.ResourceManager: {e}')
-        sys.exit(1)
+def publish_tAxis():
+    """Publish the full horizontal axis"""
+    if C_.npoints == 0:
+        return
+    # float32 is sufficient, this is the type of the tAxis PV
+    taxis = np.arange(C_.npoints, dtype=np.float32)
+    taxis *= C_.xincrement
+    taxis += C_.xorigin
+    publish('tAxis', taxis)
+
+def update_displayAxis():
+    """Recalculate the min/max decimation step and publish tAxisDisplay"""
+    nbins = max(int(pvv('displayWidth'))//2, 1)
+    C_.displayStep = max(C_.npoints//nbins, 1)
+    publish_displayAxis(C_.npoints)
+
+def publish_displayAxis(npoints:int):
+    """Publish tAxisDisplay for the display waveform of npoints samples,
+    decimated the way minmax_envelope() does it"""
+    step = C_.displayStep
+    nbins = npoints//step
+    if step <= 1 or nbins == 0:# no decimation, display waveform is the waveform
+        taxis = np.arange(npoints)
+    else:
+        # both points of the min/max pair are placed at the bin center
+        centers = np.arange(nbins)*step + (step-1)/2.
+        taxis = np.repeat(centers, 2)
+    C_.displayAxisPoints = npoints
+    publish('tAxisDisplay', taxis*C_.xincrement + C_.xorigin)
+
+def check_displayAxis(npoints:int):
+    """Follow the length of the transferred waveform, it differs from the
+    recLengthR until the next update of the scope parameters"""
+    if npoints != C_.displayAxisPoints:
+        publish_displayAxis(npoints)
 
+def open_session(timeout:int):
+    """Open a VISA session to the device with timeout in ms"""
     resourceName = pargs.resource.upper()
     printv(f'Opening resource {resourceName}')
-    try:
-        C_.scope = rm.open_resource(resourceName)#, open_timeout=5000)
-    except visa.errors.VisaIOError as e:
-        printe(f'Could not open resource {resourceName}: {e}')
-        sys.exit(1)
-    except Exception as e:
-        printe(f'Exception: Could not open resource {resourceName}: {e}')
-        sys.exit(1)
-    #C_.scope.set_visa_attribute( visa.constants.VI_ATTR_TERMCHAR_EN, True)
-    C_.scope.timeout = 5000 # ms
-    #C_.scope.encoding = 'latin_1'
-    C_.scope.read_termination = '\n'
-    C_.scope.write_termination = '\n'
-    
-    try:
-        C_.scope.clear()
-        print("Instrument buffer cleared successfully.")
-    except Exception as e:
-        print(f"An error occurred during clearing the buffer: {e}")
-        sys.exit(1)
-    #time.sleep(.1)
+    session = C_.resourceManager.open_resource(resourceName)#, open_timeout=5000)
+    if C_.capture is not None:
+        session = C_.capture.session(session)
+    #session.set_visa_attribute( visa.constants.VI_ATTR_TERMCHAR_EN, True)
+    session.timeout = timeout
+    #session.encoding = 'latin_1'
+    session.read_termination = '\n'
+    session.write_termination = '\n'
+    session.clear()
+    return session
+
+def open_scope():
+    """Open the VISA resource and check that it is a Tektronix instrument.
+    With --splitSessions, the second session is opened for waveform
+    transfers. Raises exception if the device is not reachable."""
+    resourceName = pargs.resource.upper()
+    C_.scope = open_session(pargs.controlTimeout)
+    C_.dataScope = C_.scope
     try:
         idn = C_.scope.query('*IDN?')
-    except Exception as e:
-        printe(f"An error occurred during IDN query: {e}")
+    except Exception:
         if 'SOCKET' in resourceName:
             print('You may need to disable VXI server on the instrument.')
-        sys.exit(1)
+        raise
     print(f'IDN: {idn}')
+    C_.idn = idn.strip()
     if not 'TEKTRONIX' in idn.upper():
         print('ERROR: instrument is not TEKTRONIX')
         sys.exit(1)
+    C_.scope.write('*CLS') # clear ESR, previous error messages will be cleared
+    if pargs.splitSessions:
+        C_.dataScope = open_session(pargs.dataTimeout)
+
+def connect():
+    """Try to open the device. On failure the next attempt is scheduled
+    with exponentially increasing delay, up to --reconnectMax."""
+    try:
+        open_scope()
+    except Exception as e:
+        printe(f'Could not connect to {pargs.resource}: {e}')
+        close_scope()
+        C_.nextAttempt = time.time() + C_.reconnectDelay
+        C_.reconnectDelay = min(2*C_.reconnectDelay, pargs.reconnectMax)
+        return False
+    C_.connected = True
+    C_.queryErrors = 0
+    publish('connection', 'Connected')
+    return True
+
+def close_scope():
+    """Close the VISA sessions, ignoring errors of the broken connection"""
+    for session,lock in ((C_.dataScope,C_.dataLock), (C_.scope,Threadlock)):
+        if session is None:
+            continue
+        with lock:
+            try:
+                session.close()
+            except Exception:
+                pass
+    C_.dataScope = None
+
+def init_visa():
+    '''Init VISA interface to device, wait until the device is reachable'''
+    try:
+        # the replay of a capture replaces the VISA resource manager
+        C_.resourceManager = C_.replay if C_.replay is not None\
+            else visa.ResourceManager('@py')
+    except ModuleNotFoundError as e:
+        printe(f'in visa.ResourceManager: {e}')
+        sys.exit(1)
+    while not connect():
+        printw(f'Retrying in {C_.nextAttempt - time.time():.0f} s')
+        time.sleep(max(C_.nextAttempt - time.time(), 0.))
 
+def connection_lost(reason:str):
+    """Close the broken session and schedule reconnection"""
+    if not C_.connected:
+        return
+    printe(f'Connection to {pargs.resource} lost: {reason}')
+    stop_curveStream()
+    C_.armed = False
+    C_.connected = False
+    C_.downSince = time.time()
+    C_.nextAttempt = C_.downSince + C_.reconnectDelay
+    close_scope()
+    publish('connection', 'Disconnected')
+
+def reconnect():
+    """Reopen the device and restore its transfer configuration and the
+    settings, cached in PVs. The validated SCPI map is reused, so the
+    reconnection is much faster than the server startup."""
+    C_.reconnectAttempts += 1
+    publish('reconnectAttempts', C_.reconnectAttempts)
+    if not connect():
+        return
     try:
-        C_.scope.write('*CLS') # clear ESR, previous error messages will be cleared
+        configure_scope()
+        restore_settings()
+        C_.previousScopeParametersQuery = ''# force update
+        C_.numacq = 0
+        update_scopeParameters()
+        if pargs.autoTune:
+            tune_transport()
+    except Exception as e:
+        connection_lost(f'in restoring settings: {e}')
+        C_.reconnectDelay = min(2*C_.reconnectDelay, pargs.reconnectMax)
+        return
+    C_.downtime += time.time() - C_.downSince
+    C_.reconnectDelay = 1.
+    C_.reconnects += 1
+    printi(f'Connection restored after {time.time() - C_.downSince:.1f} s')
+    publish('reconnects', C_.reconnects)
+    publish('downtime', round(C_.downtime,1))
+
+def plain_value(value):
+    """Text of the PV value, the str() of numbers and strings, wrapped
+    by p4p, includes the timestamp"""
+    if isinstance(value, ntenum):# it is int, but str() is the choice
+        return str(value)
+    if isinstance(value, (int, float)):
+        return str(value.real)
+    if isinstance(value, str):
+        return str.__str__(value)
+    return str(value)
+
+def restore_settings():
+    """Write the settings, cached in the writable SCPI PVs, to the device
+    in one compound command and read them back"""
+    cmds = []
+    for pvname,scpi in C_.scpi.items():
+        if C_.setterMap.get(pvname) is set_scpi and pvobj(pvname).writable:
+            cmds.append(f'{scpi} {plain_value(pvv(pvname))}')
+    if trigLevelCmd():
+        cmds.append(f'{trigLevelCmd()} {plain_value(pvv("trigLevel"))}')
+    printv(f'restore_settings: {cmds}')
+    with Threadlock:
+        C_.scope.write(':'+';:'.join(cmds))
+    adopt_local_setting()
+
+#``````````````````Settings synchronization```````````````````````````````````
+def make_syncTiers():
+    """Split the SCPI PVs into the fast (volatile) and slow (stable) tiers"""
+    C_.syncTiers = ([pvname for pvname in C_.scpi if pvname in VolatileSettings],
+        [pvname for pvname in C_.scpi if pvname not in VolatileSettings])
+    printv(f'syncTiers: {C_.syncTiers}')
+
+def sync_tier(pvnames:list, explicitSCPIs=(), extraPVs=None):
+    """Read the PVs of a tier, the extraPVs ({pvname: SCPI}) and
+    explicitSCPIs in one compound query and publish the changed PVs. The
+    explicitSCPIs may be common commands. The PVs are compared and
+    published under the lock of the control session, so that the reply
+    cannot overwrite a setting, written by a client after the query.
+    Returns the replies of the explicitSCPIs, None on a wrong reply,
+    and the number of changed writable settings."""
+    extraPVs = {} if extraPVs is None else extraPVs
+    pvnames = list(pvnames) + list(extraPVs)
+    scpis = [extraPVs.get(pvname) or C_.scpi[pvname] for pvname in pvnames]
+    combinedScpi = ';'.join([':'+scpi+'?' for scpi in scpis]
+        + [scpi+'?' for scpi in explicitSCPIs])
+    changes = 0
+    with Threadlock:
+        r = C_.scope.query(combinedScpi).split(';')
+        if len(r) != len(scpis) + len(explicitSCPIs):
+            printw(f'Wrong reply to the settings sync: {r}')
+            return None, 0
+        for pvname,value in zip(pvnames, r):
+            if same_setting(value, pvv(pvname)):
+                continue
+            publish(pvname, value)
+            if pvobj(pvname).writable:
+                printv(f'{pvname} changed on the instrument: {value}')
+                changes += 1
+    return r[len(pvnames):], changes
+
+def sync_settings():
+    """Synchronize the PVs with the settings changed on the instrument.
+    The volatile settings and the trigger level are read every --syncFast
+    seconds, together with the event status register. The stable ones
+    every --syncSlow seconds, or immediately when the front panel was used
+    or a volatile setting changed."""
+    now = time.time()
+    changes = 0
+    flagged = False
+    try:
+        if pargs.syncFast > 0 and now >= C_.nextFastSync:
+            C_.nextFastSync = now + pargs.syncFast
+            levelCmd = trigLevelCmd()
+            r, changes = sync_tier(C_.syncTiers[0], ['*ESR'],
+                {'trigLevel':levelCmd} if levelCmd else None)
+            if r is None:
+                return
+            esr = r[-1].strip()
+            flagged = changes > 0 or C_.volatileChanged\
+                or (esr.isdigit() and int(esr) & UserRequest)
+            C_.volatileChanged = False
+        if pargs.syncSlow > 0 and (flagged or now >= C_.nextSlowSync):
+            C_.nextSlowSync = now + pargs.syncSlow
+            changes += sync_tier(C_.syncTiers[1])[1]
+    except (visa.errors.VisaIOError, OSError) as e:
+        query_failed(e)
+        return
+    if changes == 0:
+        return
+    C_.syncChanges += changes
+    publish('syncChanges', C_.syncChanges)
+    if C_.streamer is not None:
+        C_.streamRestart = True# the scaling may change
+
+#``````````````````Setup snapshots````````````````````````````````````````````
+def same_setting(a, b):
+    """True if two setting values are equivalent, the replies of the
+    instrument may differ from the PV values in format and precision"""
+    a, b = plain_value(a).strip().strip('"'), plain_value(b).strip().strip('"')
+    try:
+        return pymath.isclose(float(a), float(b), rel_tol=1.e-6, abs_tol=1.e-12)
+    except ValueError:
+        return a.upper() == b.upper()
+
+def capture_snapshot():
+    """Read all settings with the readSettingQuery and the complete setup
+    with SET?. Returns the snapshot, None if the reply is inconsistent."""
+    with Threadlock:
+        values = C_.scope.query(C_.readSettingQuery).split(';')
+        trigLevel = C_.scope.query(trigLevelCmd()+'?') if trigLevelCmd()\
+            else None
+        setup = C_.scope.query('SET?')
+    if len(values) != len(C_.scpi):
+        printw(f'Snapshot not taken: {len(values)} values for {len(C_.scpi)} settings')
+        return None
+    settings = dict(zip(C_.scpi, values))
+    for pvname,v in settings.items():
+        publish(pvname, v, IF_CHANGED)
+    if trigLevel is not None:
+        settings['trigLevel'] = trigLevel
+    return {'time':time.strftime('%Y-%m-%d %H:%M:%S'), 'idn':C_.idn,
+        'settings':settings, 'setup':setup}
+
+def restore_snapshot(snapshot:dict):
+    """Write the settings of the snapshot, which differ from the current
+    PV values, and verify them in one compound command, that is in one
+    round trip. Returns the number of written settings."""
+    settings = snapshot['settings']
+    changed = [pvname for pvname in C_.scpi if pvname in settings
+        and C_.setterMap.get(pvname) is set_scpi and pvobj(pvname).writable
+        and not same_setting(settings[pvname], pvv(pvname))]
+    cmds = [f'{C_.scpi[pvname]} {settings[pvname]}' for pvname in changed]
+    # the level command depends on the trigger source of the snapshot
+    source = settings.get('trigSource', '')
+    levelCmd = f'TRIGger:A:LEVel:{source}' if source.startswith('CH') else ''
+    level = settings.get('trigLevel')
+    if level is not None and levelCmd and ('trigSource' in changed
+            or not same_setting(level, pvv('trigLevel'))):
+        cmds.append(f'{levelCmd} {level}')
+    else:
+        levelCmd = ''
+    printv(f'restore_snapshot: {cmds}')
+    if len(cmds) == 0:
+        return 0
+    # a separate write and query would wait for the delayed TCP ACK
+    verify = [C_.scpi[pvname] for pvname in changed] + ([levelCmd] if levelCmd
+        else [])
+    with Threadlock:
+        replies = C_.scope.query(':'+';:'.join(cmds)+';:'+'?;:'.join(verify)
+            +'?').split(';')
+    wrong = []
+    for pvname,reply in zip(changed, replies):
+        publish(pvname, reply)
+        if not same_setting(reply, settings[pvname]):
+            wrong.append(pvname)
+    if levelCmd:
+        publish('trigLevel', replies[-1])
+    if wrong:
+        printw(f'Settings differ from the snapshot after restore: {wrong}')
+    return len(cmds)
+
+def snapshots_file():
+    """File of the setup snapshots of this device"""
+    return os.path.join(pargs.cacheDir, f'snapshots_{pargs.prefix[:-1]}.json')
+
+def load_snapshots():
+    """Read the saved snapshots"""
+    if not pargs.cacheDir:
+        return
+    try:
+        with open(snapshots_file()) as f:
+            C_.snapshots = json.load(f)
+    except FileNotFoundError:
         pass
     except Exception as e:
-        printe(f'Resource {resourceName} not responding: {e}')
-        sys.exit()
+        printw(f'Could not read snapshots {snapshots_file()}: {e}')
+    publish('snapshots', ','.join(C_.snapshots))
+
+def save_snapshots():
+    """Store the snapshots, they are kept in memory only without
+    --cacheDir"""
+    if not pargs.cacheDir:
+        return
+    try:
+        os.makedirs(pargs.cacheDir, exist_ok=True)
+        with open(snapshots_file(), 'w') as f:
+            json.dump(C_.snapshots, f, indent=1)
+    except Exception as e:
+        printw(f'Could not write snapshots {snapshots_file()}: {e}')
 
 #``````````````````````````````````````````````````````````````````````````````
 def handle_exception(where):
@@ -363,8 +1066,12 @@ def handle_exception(where):
     msg = tokens[0] if tokens[0] == 'VI_ERROR_TMO' else exceptionText
     msg = msg+': '+where
     printw(msg)
-    with Threadlock:
-        C_.scope.write('*CLS')
+    if C_.connected:
+        with Threadlock:
+            try:
+                C_.scope.write('*CLS')
+            except Exception:
+                pass
     return -1
 
 def adopt_local_setting():
@@ -397,39 +1104,71 @@ def adopt_local_setting():
 
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,
 #``````````````````Acquisition-related functions`````````````````````````````````
-def trigger_is_detected():
-    """check if scope was triggered"""
-    printv('Checking if trigger is detected...')
-    ts = timer()
+def query_failed(e:Exception):
+    """Account a failed control query, the connection is considered lost
+    after ErrCountLimit consecutive failures"""
+    printe(f'Exception in query for trigger: {e}')
+    C_.queryErrors += 1
+    if C_.queryErrors >= ErrCountLimit:
+        connection_lost(str(e))
+
+def query_trigger(explicitSCPIs=()):
+    """Query the trigger state, acquisition count, record length, horizontal
+    scale, the enabled channels and the explicitSCPIs. Returns the list of
+    replies, None if the query failed."""
     try:
         r = query(['trigState','scopeAcqCount','recLengthR',
-                    'timePerDiv'], ['DATa:SOUrce:AVAILable'])
+                    'timePerDiv'], ['DATa:SOUrce:AVAILable', *explicitSCPIs])
         #print(f'Result of query: {r}')
-    except visa.errors.VisaIOError as e:
-        printe(f'Exception in query for trigger: {e}')
-        for exc in C_.exceptionCount:
-            if exc in str(e):
-                C_.exceptionCount[exc] += 1
-                errCountLimit = 2
-                if C_.exceptionCount[exc] >= errCountLimit:
-                    printe(f'Processing stopped due to {exc} happened {errCountLimit} times')
-                    set_server('Exit')
-                else:
-                    printw(f'Exception  #{C_.exceptionCount[exc]} during processing: {exc}')
-        return False
+    except (visa.errors.VisaIOError, OSError) as e:
+        query_failed(e)
+        return None
+    # last query was successfull, clear error count
+    C_.queryErrors = 0
+    if len(r) != 5 + len(explicitSCPIs):
+        printw(f'wrong trig info: {r}')
+        return None
+    return r
 
-    # last query was successfull, clear error counts
-    for i in C_.exceptionCount:
-        C_.exceptionCount[i] = 0
-    try:
-        trigstate,numacq,rl,timePerDiv,channelsTriggered = r
-    except Exception as e:
-        printw(f'wrong trig info: {r}, exception:{e}')
+def triggered(trigstate:str, rl:str, timePerDiv:str, channelsTriggered:str):
+    """Register the trigger, the waveforms of its channels can be acquired"""
+    C_.channelsTriggered = channelsTriggered.split(',')
+    #print(f'Channels triggered: {C_.channelsTriggered}')
+    C_.trigTime = time.time()
+    d = {'recLengthR': int(rl), 'timePerDiv': float(timePerDiv),
+         'trigState':trigstate}
+    for pvname,value in d.items():
+        # the fast sync would not see the change, it is published here
+        if pvname in VolatileSettings and pvobj(pvname).writable\
+          and not same_setting(value, pvv(pvname)):
+            C_.volatileChanged = True
+        publish(pvname, value, IF_CHANGED, t=C_.trigTime)
+
+def analog_channels(sources:list):
+    """Numbers of the analog channels among the DATa:SOUrce names, which are
+    served by this server. The digital sources of FlexChannels, e.g. CH5_D0
+    or CH5_DALL, and the channels beyond --channels are skipped."""
+    channels = []
+    for chstr in sources:
+        chstr = chstr.strip()
+        if not chstr.startswith('CH') or '_' in chstr:
+            continue
+        ch = int(chstr[2:])
+        if ch <= pargs.channels:
+            channels.append(ch)
+    return channels
+
+def trigger_is_detected():
+    """check if scope was triggered"""
+    printv('Checking if trigger is detected...')
+    ts = timer()
+    with C_.tracer.span('trigger query') if C_.tracer.enabled else NullSpan:
+        r = query_trigger()
+    if r is None:
         return False
+    trigstate,numacq,rl,timePerDiv,channelsTriggered = r
 
     numacq = int(numacq)
-    C_.channelsTriggered = channelsTriggered.split(',')
-    #print(f'Channels triggered: {C_.channelsTriggered}')
     if numacq == 0 or C_.numacq == 0:
         C_.triggersLost = 0
     else:
@@ -445,15 +1184,315 @@ def trigger_is_detected():
 
     # trigger detected
     C_.numacq = numacq
-    C_.trigTime = time.time()
-    d = {'recLengthR': int(rl), 'timePerDiv': float(timePerDiv),
-         'trigState':trigstate}
-    for pvname,value in d.items():
-        publish(pvname, value, IF_CHANGED, t=C_.trigTime)
+    triggered(trigstate, rl, timePerDiv, channelsTriggered)
     ElapsedTime['trigger_detection'] = round(timer()-ts,6)
     printv(f'Trigger detected {C_.numacq}')
     return True
 
+def watch_channelPVs():
+    """Track clients of the channel data PVs. The PVA server reports only the
+    first connection and the last disconnection of a PV."""
+    def connected(pv):
+        C_.watchedPVs.add(pv.name)
+        if pv.name == 'tAxis':# it is not kept up to date without clients
+            publish_tAxis()
+        elif pv.name != 'acquisition':
+            update_channelClients(pv.name)
+    def disconnected(pv):
+        C_.watchedPVs.discard(pv.name)
+        if pv.name not in ('acquisition', 'tAxis'):
+            update_channelClients(pv.name)
+    pvnames = [f'c{ch:02}{suffix}' for ch in range(1, pargs.channels+1)
+                for suffix in ChannelDataPVs]
+    pvnames += [f'd{ch:02}{suffix}' for ch in pargs.digitalList
+                for suffix in DigitalDataPVs]
+    pvnames += [f'm{mch:02}{suffix}' for mch in range(1, pargs.mathChannels+1)
+                for suffix in MathDataPVs]
+    for pvname in pvnames + ['acquisition', 'tAxis']:
+        pv = pvobj(pvname)
+        pv.onFirstConnect(connected)
+        pv.onLastDisconnect(disconnected)
+    for chstr in pargs.alwaysRead.split(','):
+        if chstr != '':
+            publish(f'c{int(chstr):02}AlwaysRead', '1')
+
+def update_channelClients(pvname:str):
+    """Publish number of watched data PVs of the channel of pvname"""
+    prefix = pvname[:3]
+    n = sum([name.startswith(prefix) for name in C_.watchedPVs])
+    publish(prefix+'Clients', n)
+
+def channel_is_wanted(ch:int):
+    """True if the waveform of channel ch needs to be transferred"""
+    if str(pvv(f'c{ch:02}AlwaysRead')) == '1':
+        return True
+    if 'acquisition' in C_.watchedPVs:# it needs all channels
+        return True
+    if C_.recorder is not None or C_.ring is not None or C_.shm is not None:
+        return True
+    if any([ch in math.channels for math in watched_math().values()]):
+        return True
+    return pvv(f'c{ch:02}Clients') > 0
+
+def watched_math():
+    """{number: MathChannel} of the math channels, watched by clients"""
+    return {mch:math for mch,math in C_.math.items()
+        if pvv(f'm{mch:02}Clients') > 0}
+
+def publish_math():
+    """Evaluate the watched math channels on the acquired raw waveforms and
+    publish their products"""
+    for mch,math in watched_math().items():
+        prefix = f'm{mch:02}'
+        if not all([ch in C_.acquired for ch in math.channels]):
+            printv(f'Channels of {prefix} are not acquired')
+            continue
+        if not any([rate_allows(prefix+suffix) for suffix in MathDataPVs]):
+            C_.throttledUpdates += len(MathDataPVs)
+            continue
+        try:
+            with C_.tracer.span('math', pv=prefix) if C_.tracer.enabled\
+              else NullSpan:
+                wave = math.evaluate({ch:(C_.acquired[ch][0], C_.ymult[ch],
+                    C_.yzero[ch]) for ch in math.channels}, C_.xincrement)
+        except Exception as e:# the rate slots are not used
+            printe(f'in evaluation of {prefix} {math.text}: {e}')
+            continue
+        plan = [suffix for suffix in MathDataPVs
+            if publish_allowed(prefix+suffix)]
+        products = {'Waveform':wave, 'Mean':float(wave.mean()),
+            'Peak2Peak':float(wave.max()) - float(wave.min())}
+        for suffix in plan:
+            publish_data(prefix+suffix, products[suffix], C_.trigTime)
+
+def acquisitionType():
+    """Structure of the acquisition PV. The waveforms are raw samples,
+    the value in divisions is raw*scale[ch-1] + offset[ch-1]"""
+    timeStamp = ('S', 'time_t', [('secondsPastEpoch','l'), ('nanoseconds','i'),
+                ('userTag','i')])
+    fields = [('acqCount','l'), ('trigTime','d'), ('xOrigin','d'),
+        ('xIncrement','d'), ('channels','as'), ('scale','ad'), ('offset','ad')]
+    fields += [(f'c{ch:02}','ah') for ch in range(1, pargs.channels+1)]
+    # the display.description is set by epicsdev, like for the other PVs
+    display = ('S', None, [('description','s')])
+    return Type(fields + [('timeStamp', timeStamp), ('display', display)],
+        id='epicsdev:acquisition:1.0')
+
+def wrap_acquisition(value, timestamp=None, **_):
+    """The wrap() of the acquisition type for the SharedPV, epicsdev
+    passes the timestamp of the PV creation"""
+    if timestamp is not None:
+        value['timeStamp.secondsPastEpoch'] = int(timestamp)
+        value['timeStamp.nanoseconds'] = int((timestamp % 1)*1.e9)
+    return value
+
+def create_acquisitionPV():
+    """Create the acquisition PV, which carries all channels of a trigger
+    in one update."""
+    C_.acquisitionType = acquisitionType()# post() requires the same type
+    pv = SharedPV(initial=Value(C_.acquisitionType, {}), wrap=wrap_acquisition)
+    pv.writable = False
+    return pv
+
+def acquisitionValue(acqCount, trigTime, xorigin, xincrement, acquired):
+    """Value of the acquisition type, the acquired is the
+    {channel:(raw waveform, scale, offset)} map"""
+    nch = pargs.channels
+    scale, offset = np.zeros(nch), np.zeros(nch)
+    fields = {'acqCount': acqCount, 'trigTime': trigTime,
+        'xOrigin': xorigin, 'xIncrement': xincrement,
+        'channels': [f'CH{ch}' for ch in acquired],
+        'timeStamp': {'secondsPastEpoch': int(trigTime),
+            'nanoseconds': int((trigTime % 1)*1.e9)}}
+    for ch in range(1, nch+1):
+        bin_wave, scale[ch-1], offset[ch-1] = acquired.get(ch, ([],0.,0.))
+        fields[f'c{ch:02}'] = bin_wave
+    fields['scale'], fields['offset'] = scale, offset
+    return Value(C_.acquisitionType, fields)
+
+def publish_acquisition():
+    """Publish the acquired raw waveforms of all channels in one update"""
+    if 'acquisition' not in C_.watchedPVs:
+        return
+    pvobj('acquisition').post(acquisitionValue(pvv('acqCount'), C_.trigTime,
+        C_.xorigin, C_.xincrement, C_.acquired))
+
+def create_historyPV():
+    """Create the history PV, it carries acquisitions recalled from
+    the ring buffer"""
+    pv = SharedPV(initial=Value(C_.acquisitionType, {}), wrap=wrap_acquisition)
+    pv.writable = False
+    return pv
+
+def rate_allows(pvname:str):
+    """Check if publishing of the channel PV now does not exceed its max
+    rate, without using its rate slot"""
+    maxRate = C_.maxRates.get(pvname[3:])# the cNN prefix is not in maxRates
+    return not maxRate\
+        or timer() - C_.lastPublished.get(pvname, 0.) >= 1./maxRate
+
+def publish_allowed(pvname:str, unchanged=None):
+    """Check if publishing of the channel PV does not exceed its max rate.
+    The unchanged is an optional check, done only when the rate allows
+    the publishing, if it returns True, the PV is not published and its
+    rate slot is not used."""
+    if not rate_allows(pvname):
+        C_.throttledUpdates += 1
+        return False
+    if unchanged is not None and unchanged():
+        return False
+    if C_.maxRates.get(pvname[3:]):
+        C_.lastPublished[pvname] = timer()
+    return True
+
+def suppressing_unchanged():
+    """True if unchanged waveforms are not published"""
+    return str(pvv('suppressUnchanged')) == '1'
+
+def waveform_changed(pvname:str, checksum:int, scale):
+    """Check if the raw waveform or its scale differ from the ones, last
+    published in the PV. The checksum of the raw buffer is used, it is
+    much cheaper than the publishing. The caller publishes the PV if it
+    changed, its signature is saved."""
+    signature = (checksum, scale)
+    if signature == C_.waveformSignature.get(pvname):
+        C_.unchangedUpdates += 1
+        return False
+    C_.waveformSignature[pvname] = signature
+    return True
+
+def publish_plan(ch:int, checksum, scale):
+    """Suffixes of the channel PVs, which need to be published for this
+    acquisition. The checksum of the raw waveform is None if the
+    change detection is off or not yet possible."""
+    prefix = f'c{ch:02}'
+    plan = []
+    for suffix in ('Waveform','WaveformDisplay'):
+        pvname = prefix + suffix
+        # the signature is checked only if the rate allows the publishing,
+        # otherwise a throttled change would be taken for published
+        unchanged = None if checksum is None else\
+            lambda: not waveform_changed(pvname, checksum, scale)
+        if publish_allowed(pvname, unchanged):
+            plan.append(suffix)
+    plan += [suffix for suffix in ('Peak2Peak','Mean')
+                if publish_allowed(prefix+suffix)]
+    return plan
+
+def raw_is_needed():
+    """True if the full raw waveforms are used after the acquisition"""
+    return ('acquisition' in C_.watchedPVs or C_.recorder is not None
+        or C_.ring is not None or C_.shm is not None
+        or len(watched_math()) > 0)
+
+def pulses_watched(ch:int):
+    """True if a client watches the pulse PVs of the channel"""
+    return any([f'c{ch:02}{suffix}' in C_.watchedPVs
+        for suffix in PulseDataPVs])
+
+def publish_pulses(ch:int, bin_wave, vscale:float, voffset:float):
+    """Detect pulses in the raw waveform and publish their watched PVs"""
+    prefix = f'c{ch:02}'
+    plan = [suffix for suffix in PulseDataPVs
+        if prefix+suffix in C_.watchedPVs and publish_allowed(prefix+suffix)]
+    if len(plan) == 0:
+        return
+    products = pulse_products(bin_wave, vscale, voffset,
+        pvv(prefix+'PulseThreshold'), pvv(prefix+'PulseHysteresis'),
+        str(pvv(prefix+'PulsePolarity')) == 'NEGATIVE',
+        C_.xorigin, C_.xincrement, pvv(prefix+'PulseWindow'), plan,
+        channel_buffers(ch))
+    publish_products(ch, products, C_.trigTime)
+
+def compressed_watched(ch:int):
+    """True if a client watches the compressed waveform of the channel"""
+    return f'c{ch:02}WaveformCompressed' in C_.watchedPVs
+
+def publish_compressed(ch:int, bin_wave, vscale:float, voffset:float):
+    """Compress the raw waveform, publish it with the compression ratio
+    and the CPU time, so that it is seen whether it pays off"""
+    prefix = f'c{ch:02}'
+    if not publish_allowed(prefix+'WaveformCompressed'):
+        return
+    ts = time.thread_time()
+    with C_.tracer.span('compression', ch=ch) if C_.tracer.enabled\
+      else NullSpan:
+        blob = compress_waveform(bin_wave, vscale, voffset, pargs.codec,
+            channel_buffers(ch))
+    dt = time.thread_time() - ts
+    publish_data(prefix+'WaveformCompressed', np.frombuffer(blob, np.uint8),
+        C_.trigTime)
+    # the Waveform PV is float32
+    publish(prefix+'CompressionRatio', round(bin_wave.size*4/len(blob),3),
+        t=C_.trigTime)
+    publish(prefix+'CompressionTime', round(dt*1000.,3), t=C_.trigTime)
+
+def stream_waveform(ch:int, vscale:float, voffset:float):
+    """Read the waveform of the selected channel in chunks of --chunkPoints
+    and compute its products on the fly, so that a long record is never
+    held in memory as a whole, unless it is published or needed by the
+    consumers of raw waveforms.
+    Returns the raw waveform (None if it was not kept) and the products."""
+    scale = (vscale,voffset)
+    plan = publish_plan(ch, None, scale)
+    step = C_.displayStep
+    chunkPoints = max(pargs.chunkPoints//step, 1)*step# bins are not split
+    dtype = '>i2' if BigEndian else '<i2'
+    with C_.dataLock:
+        C_.dataScope.write('CURVe?')
+        # Format: #<x><yyy><data><terminator>
+        # where x is number of digits in yyy, yyy is number of bytes
+        ndigits = int(C_.dataScope.read_bytes(2)[1:])
+        npoints = int(C_.dataScope.read_bytes(ndigits))//BytesPerPoint
+        check_displayAxis(npoints)
+        stream = StreamingProducts(npoints, vscale, voffset, step, plan,
+            raw_is_needed() or pulses_watched(ch) or compressed_watched(ch),
+            suppressing_unchanged(),
+            channel_buffers(ch))
+        try:
+            for first in range(0, npoints, chunkPoints):
+                n = min(chunkPoints, npoints - first)
+                stream.add(np.frombuffer(
+                    C_.dataScope.read_bytes(n*BytesPerPoint), dtype))
+            C_.dataScope.read_bytes(1)
+        except Exception:
+            C_.dataScope.clear()# discard the rest of the reply
+            raise
+    products = stream.products()
+    if stream.checksum is not None:
+        # the rate was checked by the publish_plan(), before the transfer
+        for suffix in ('Waveform','WaveformDisplay'):
+            if suffix in products and not waveform_changed(f'c{ch:02}{suffix}',
+                    stream.checksum, scale):
+                products.pop(suffix)
+    return stream.raw, products
+
+def channel_buffers(ch):
+    """Reusable processing buffers of the channel, ch is the number of an
+    analog channel or d<nn> of a digital one"""
+    buffers = C_.buffers.get(ch)
+    if buffers is None:
+        buffers = C_.buffers[ch] = Buffers()
+    return buffers
+
+def allocation_totals():
+    """Total number and bytes of the buffer allocations of all channels"""
+    return (sum([b.allocations for b in C_.buffers.values()]),
+        sum([b.allocatedBytes for b in C_.buffers.values()]))
+
+def publish_data(pvname:str, value, trigTime:float):
+    """Publish the data PV of the acquisition, as a trace span with --trace"""
+    if not C_.tracer.enabled:
+        publish(pvname, value, t=trigTime)
+        return
+    with C_.tracer.span('publish', pv=pvname):
+        publish(pvname, value, t=trigTime)
+
+def publish_products(ch:int, products:dict, trigTime:float):
+    """Publish the channel products, computed by channel_products()"""
+    for suffix,value in products.items():
+        publish_data(f'c{ch:02}{suffix}', value, trigTime)
+
 def trigLevelCmd():
     """Generate SCPI command for trigger level control"""
     ch = str(pvv('trigSource'))
@@ -463,27 +1502,338 @@ def trigLevelCmd():
     printv(f'tlcmd: {r}')
     return r
 
+def measure_throughput(nbytes:int, dt:float):
+    """Update the moving average of the waveform transfer throughput"""
+    if dt <= 0. or nbytes == 0:
+        return
+    mbps = nbytes/1.e6/dt
+    C_.linkMBps = mbps if C_.linkMBps == 0. else 0.8*C_.linkMBps + 0.2*mbps
+
+def tune_transport():
+    """Choose the timeout and read chunk size of the data session from the
+    expected size of a waveform transfer and the measured throughput.
+    The timeout is never shorter than the configured one. Without
+    --splitSessions the data session is the control session, then only
+    the chunk size is tuned and the timeout stays --controlTimeout.
+    The CURVEStream reader holds the data session for the whole stream,
+    it is tuned in start_curveStream(), before the reader is created."""
+    if C_.dataScope is None or C_.linkMBps == 0. or C_.streamer is not None:
+        return
+    nbytes = C_.npoints*BytesPerPoint
+    expected = nbytes/1.e6/C_.linkMBps
+    timeout = pargs.controlTimeout
+    if pargs.splitSessions:
+        timeout = max(pargs.dataTimeout,
+            int((TimeoutMargin*expected + TimeoutLatency)*1000.))
+    chunkSize = min(max(nbytes, ChunkSizeRange[0]), ChunkSizeRange[1])
+    chunkSize = (chunkSize + 4095)//4096*4096
+    if (timeout,chunkSize) != (C_.dataScope.timeout, C_.dataScope.chunk_size):
+        printv(f'Transport tuned for {nbytes} B at {C_.linkMBps:.2f} MB/s: timeout={timeout} ms, chunk_size={chunkSize}')
+        with C_.dataLock:
+            C_.dataScope.timeout = timeout
+            C_.dataScope.chunk_size = chunkSize
+    publish('tunedTimeout', timeout, IF_CHANGED)
+    publish('tunedChunkSize', chunkSize, IF_CHANGED)
+
+def calibrate_transport():
+    """Measure the throughput with a waveform transfer of the first
+    enabled channel, the timeout is generous for that."""
+    r = query([], ['DATa:SOUrce:AVAILable'])
+    channels = r[0].split(',')
+    if channels[0] == 'NONE':
+        printw('No channel is enabled, transport calibration is skipped')
+        return
+    with C_.dataLock:
+        timeout = C_.dataScope.timeout
+        C_.dataScope.timeout = max(timeout, 60000)
+        try:
+            C_.dataScope.write(f'DATa:SOUrce {channels[0]}')
+            ts = timer()
+            bin_wave = C_.dataScope.query_binary_values('curve?',
+                datatype='h', is_big_endian=BigEndian, container=np.array)
+            dt = timer() - ts
+        finally:
+            C_.dataScope.timeout = timeout
+    measure_throughput(bin_wave.nbytes, dt)
+    printi(f'Transport calibration: {bin_wave.nbytes} B in {dt:.3f} s, {C_.linkMBps:.2f} MB/s')
+    publish('linkMBps', round(C_.linkMBps,3))
+    if pargs.autoTune:
+        tune_transport()
+
+def channel_scale(ch:int):
+    """Scale and offset, converting raw samples of channel ch to
+    vertical divisions"""
+    #v = (waveform_data - yoff) * ymult + yzero
+    voltsPerDiv = pvv(f'c{ch:02}VoltsPerDiv')
+    return C_.ymult[ch]/voltsPerDiv, C_.yzero[ch]/voltsPerDiv
+
+def process_waveform(ch:int, bin_wave, vscale:float, voffset:float):
+    """Compute the products of the raw waveform and publish them"""
+    C_.acquired[ch] = (bin_wave, vscale, voffset)
+    check_displayAxis(len(bin_wave))
+    checksum = zlib.adler32(bin_wave.data) if suppressing_unchanged()\
+        else None
+    plan = publish_plan(ch, checksum, (vscale,voffset))
+    if C_.offloader is not None:
+        C_.offloader.submit(ch, bin_wave, vscale, voffset,
+            C_.displayStep, plan, C_.trigTime)
+    else:
+        with C_.tracer.span('processing', ch=ch, plan=plan)\
+          if C_.tracer.enabled else NullSpan:
+            products = channel_products(bin_wave, vscale, voffset,
+                C_.displayStep, plan, buffers=channel_buffers(ch))
+        publish_products(ch, products, C_.trigTime)
+    if pulses_watched(ch):
+        publish_pulses(ch, bin_wave, vscale, voffset)
+    if compressed_watched(ch):
+        publish_compressed(ch, bin_wave, vscale, voffset)
+
+def deliver_acquisition(reusedBuffers=False):
+    """Pass the raw waveforms of all channels to the aggregate PV, recorder,
+    ring buffer and shared-memory export. If reusedBuffers, the waveforms
+    will be overwritten, so the recorder gets copies."""
+    publish_math()
+    publish_acquisition()
+    if C_.recorder is not None:
+        acquired = C_.acquired
+        if reusedBuffers:
+            acquired = {ch:(w.copy(),scale,offset)
+                for ch,(w,scale,offset) in acquired.items()}
+        C_.recorder.put(pvv('acqCount'), C_.trigTime, C_.xorigin,
+            C_.xincrement, acquired)
+    if C_.ring is not None:
+        if not C_.ring.write(pvv('acqCount'), C_.trigTime, C_.xorigin,
+            C_.xincrement, C_.acquired):
+            npoints = len(next(iter(C_.acquired.values()))[0])
+            if npoints != C_.ringTooLong:# warn once per record length
+                C_.ringTooLong = npoints
+                printw(f'Waveforms of {npoints} points are longer than --ringPoints, not stored in the ring buffer')
+    if C_.shm is not None:
+        if not C_.shm.write(pvv('acqCount'), C_.trigTime, C_.xorigin,
+            C_.xincrement, C_.acquired):
+            npoints = len(next(iter(C_.acquired.values()))[0])
+            if npoints != C_.shmTooLong:# warn once per record length
+                C_.shmTooLong = npoints
+                printw(f'Waveforms of {npoints} points are longer than --shmPoints, not exported')
+
+def acquisition_published(allocationsBefore:tuple, complete=True):
+    """Publish the allocations of the acquisition and, for the first
+    complete one, the time from the start"""
+    totals = allocation_totals()
+    publish('acqAllocations', totals[0] - allocationsBefore[0], IF_CHANGED)
+    publish('acqAllocatedBytes', totals[1] - allocationsBefore[1], IF_CHANGED)
+    if not C_.firstPublished and complete:
+        C_.firstPublished = True
+        publish('timeToFirstPublish', round(time.time() - C_.startTime,3))
+        printi(f'First acquisition published {time.time() - C_.startTime:.3f} s after start')
+
+def acquire_digital(ch:int):
+    """Transfer all lines of the digital channel ch, one byte per sample,
+    and publish its products. Returns False if the transfer failed."""
+    ts = timer()
+    try:
+        with C_.tracer.locked(C_.dataLock, 'data session'),\
+          (C_.tracer.span('CURVe? digital', ch=ch) if C_.tracer.enabled
+          else NullSpan):
+            C_.dataScope.write(f'DATa:SOUrce CH{ch}_DALL;:WFMOutpre:BYT_Nr 1')
+            try:
+                dall = C_.dataScope.query_binary_values('curve?',
+                    datatype='B', container=np.array)
+            finally:
+                C_.dataScope.write(f'WFMOutpre:BYT_Nr {BytesPerPoint}')
+    except (visa.errors.VisaIOError, OSError) as e:
+        printe(f'in transfer of digital channel {ch}: {e}')
+        return False
+    measure_throughput(dall.nbytes, timer() - ts)
+    ElapsedTime['query_wf'] += timer() - ts
+    ts = timer()
+    with C_.tracer.span('processing', ch=f'd{ch:02}') if C_.tracer.enabled\
+      else NullSpan:
+        products = digital_products(dall, channel_buffers(f'd{ch:02}'))
+    for suffix,value in products.items():
+        publish_data(f'd{ch:02}{suffix}', value, C_.trigTime)
+    ElapsedTime['publish_wf'] += timer() - ts
+    return True
+
+#``````````````````CURVEStream acquisition`````````````````````````````````````
+def start_curveStream():
+    """Select all enabled channels as sources and start the streaming"""
+    r = query([], ['DATa:SOUrce:AVAILable'])
+    channels = analog_channels(r[0].split(','))
+    if len(channels) == 0:
+        printv('No channel is enabled for CURVEStream')
+        return False
+    with C_.dataLock:
+        C_.dataScope.write('DATa:SOUrce '
+            + ','.join([f'CH{ch}' for ch in channels]))
+    if pargs.autoTune:
+        tune_transport()
+    C_.streamer = CurveStreamer(C_.dataScope, C_.dataLock, channels,
+        pargs.streamPool, BigEndian)
+    return True
+
+def stop_curveStream():
+    """Stop the streaming, the acquisitions not yet published are lost"""
+    streamer, C_.streamer = C_.streamer, None# it may be stopped by a put
+    if streamer is None:
+        return
+    if not streamer.stop():
+        printw('CURVEStream reader is still draining the stream, the data session is released when it finishes')
+
+def poll_curveStream():
+    """Publish the streamed acquisitions. The streaming is restarted after
+    errors and after setting changes, which affect the waveform scaling."""
+    streamer = C_.streamer
+    if streamer is not None and (streamer.error or C_.streamRestart):
+        C_.dataErrors = C_.dataErrors + 1 if streamer.error else 0
+        stop_curveStream()
+        if C_.dataErrors >= ErrCountLimit:
+            connection_lost(f'CURVEStream failed: {streamer.error}')
+            return
+    if C_.streamer is None:
+        C_.streamRestart = False
+        try:
+            update_scopeParameters()
+            started = start_curveStream()
+        except Exception as e:
+            query_failed(e)
+            return
+        C_.queryErrors = 0
+        if not started:
+            return
+    # the streamer of this poll, C_.streamer can be stopped by a put
+    streamer = C_.streamer
+    if streamer is None:
+        return
+    item = streamer.get(timeout=0.1)
+    while item is not None:
+        trigTime, waveforms = item
+        publish_streamed(streamer.channels, trigTime, waveforms)
+        streamer.release(waveforms)
+        item = streamer.get(timeout=0.)
+    publish('streamPending', streamer.pending(), IF_CHANGED)
+
+def publish_streamed(channels:list, trigTime:float, waveforms:list):
+    """Publish an acquisition, received from CURVEStream for channels"""
+    C_.trigTime = trigTime
+    publish('acqCount', pvv('acqCount') + 1, t=trigTime)
+    C_.tracer.acqCount = pvv('acqCount')
+    C_.acquired = {}
+    allocations = allocation_totals()
+    with C_.tracer.span('acquisition', streamed=True) if C_.tracer.enabled\
+      else NullSpan:
+        for ch,bin_wave in zip(channels, waveforms):
+            if not channel_is_wanted(ch):
+                continue
+            try:
+                vscale, voffset = channel_scale(ch)
+                process_waveform(ch, bin_wave, vscale, voffset)
+            except Exception as e:
+                printe(f'Exception in processing channel {ch}: {e}')
+        with C_.tracer.span('deliver') if C_.tracer.enabled else NullSpan:
+            deliver_acquisition(reusedBuffers=True)
+    acquisition_published(allocations)
+    C_.dataErrors = 0
+
+#``````````````````Sequence acquisition```````````````````````````````````````
+# With ACQuire:STOPAfter SEQuence the scope stops after each acquisition and
+# does not acquire during the readout, so all waveforms of the published
+# acquisition belong to the trigger, which completed the sequence.
+def arm_sequence():
+    """Start acquisition of the next sequence"""
+    try:
+        with Threadlock:
+            C_.scope.write('ACQuire:STATE ON')
+    except (visa.errors.VisaIOError, OSError) as e:
+        query_failed(e)
+        return False
+    C_.armed = True
+    return True
+
+def sequence_is_complete():
+    """Check if the armed sequence is complete"""
+    ts = timer()
+    r = query_trigger(['ACQuire:STATE'])
+    if r is None:
+        return False
+    trigstate,numacq,rl,timePerDiv,channelsTriggered,state = r
+    # the acquisition count is reset by the arming
+    if state.strip() != '0' or int(numacq) == 0:
+        return False
+    C_.numacq = int(numacq)
+    triggered(trigstate, rl, timePerDiv, channelsTriggered)
+    ElapsedTime['trigger_detection'] = round(timer()-ts,6)
+    printv('Sequence completed')
+    return True
+
+def poll_sequence():
+    """Arm, wait for the completion, read all channels and re-arm"""
+    if not C_.armed:
+        arm_sequence()
+        return
+    if not sequence_is_complete():
+        return
+    completed = timer()
+    C_.armed = False
+    acquire_waveforms()
+    if not C_.connected:
+        return
+    if C_.dataErrors == 0:
+        C_.sequences += 1
+    if arm_sequence():
+        publish('rearmLatency', round((timer() - completed)*1000.,3))
+
+def stop_sequence():
+    """Leave the scope acquiring continuously"""
+    try:
+        with Threadlock:
+            C_.scope.write('ACQuire:STOPAfter RUNSTop;:ACQuire:STATE RUN')
+    except Exception as e:
+        printw(f'Could not restore the run mode: {e}')
+
 #``````````````````Acquisition-related functions``````````````````````````````
 def acquire_waveforms():
     """Acquire waveforms from the device and publish them."""
     channels = C_.channelsTriggered
     printv(f'>acquire_waveform for channels {channels}')
     publish('acqCount', pvv('acqCount') + 1, t=C_.trigTime)
+    C_.tracer.acqCount = pvv('acqCount')
     ElapsedTime['acquire_wf'] = timer()
     ElapsedTime['preamble'] = 0.
     ElapsedTime['query_wf'] = 0.
     ElapsedTime['publish_wf'] = 0.
-    if channels[0] == 'NONE':
-        channels = []
-    for chstr in channels:
-        #print(f'Acquiring waveform for channel {chstr}')
-        ch = int(chstr[2])
+    C_.acquired = {}
+    allocations, allocatedBytes = allocation_totals()
+    with C_.tracer.span('acquisition') if C_.tracer.enabled else NullSpan:
+        transferFailed = transfer_waveforms(channels)
+        ts = timer()
+        with C_.tracer.span('deliver') if C_.tracer.enabled else NullSpan:
+            deliver_acquisition()
+        ElapsedTime['publish_wf'] += timer() - ts
+    acquisition_published((allocations, allocatedBytes), not transferFailed)
+    C_.dataErrors = C_.dataErrors + 1 if transferFailed else 0
+    if C_.dataErrors >= ErrCountLimit:
+        connection_lost('waveform transfers failed')
+    ElapsedTime['acquire_wf'] = timer() - ElapsedTime['acquire_wf']
+    printvv(f'elapsedTime: {ElapsedTime}')
+
+def transfer_waveforms(channels:list):
+    """Transfer, process and publish the waveforms of the triggered
+    channels and of the watched digital channels. Returns True if a
+    transfer failed."""
+    transferFailed = False
+    for ch in analog_channels(channels):
+        if not channel_is_wanted(ch):
+            C_.bytesSkipped += C_.npoints*BytesPerPoint
+            continue
         # refresh scalings
         ts = timer()
         operation = 'getting preamble'
         try:
-            with Threadlock:
-                C_.scope.write(f'DATa:SOUrce CH{ch}')
+            with C_.tracer.locked(C_.dataLock, 'data session'),\
+              (C_.tracer.span('DATa:SOUrce', ch=ch) if C_.tracer.enabled
+              else NullSpan):
+                C_.dataScope.write(f'DATa:SOUrce CH{ch}')
                 # Get waveform parameters
                 # This section is 4 times longer than the waveform acquisition
                 #TODO: do this in periodic_update
@@ -495,6 +1845,29 @@ def acquire_waveforms():
             #printvv(f'aw preamble{ch}: ymult={C_.ymult[ch]}, yoff={C_.yoff[ch]}, yzero={C_.yzero[ch]}, dt: {dt}')
             ElapsedTime['preamble'] += dt
 
+            vscale, voffset = channel_scale(ch)
+
+            if pargs.chunkPoints > 0 and C_.offloader is None:
+                # the processing is interleaved with the transfer
+                operation = 'streaming waveform'
+                with C_.tracer.span('CURVe? chunked', ch=ch,
+                  bytes=C_.npoints*BytesPerPoint) if C_.tracer.enabled\
+                  else NullSpan:
+                    bin_wave, products = stream_waveform(ch, vscale, voffset)
+                if bin_wave is not None:
+                    C_.acquired[ch] = (bin_wave, vscale, voffset)
+                measure_throughput(C_.npoints*BytesPerPoint, timer() - ts)
+                ElapsedTime['query_wf'] += timer() - ts
+                ts = timer()
+                operation = 'publishing'
+                publish_products(ch, products, C_.trigTime)
+                if bin_wave is not None and pulses_watched(ch):
+                    publish_pulses(ch, bin_wave, vscale, voffset)
+                if bin_wave is not None and compressed_watched(ch):
+                    publish_compressed(ch, bin_wave, vscale, voffset)
+                ElapsedTime['publish_wf'] += timer() - ts
+                continue
+
             # acquire the waveform
             operation = 'getting waveform'
             # with Threadlock: This is 4 times longer than the query_binary_values
@@ -508,37 +1881,84 @@ def acquire_waveforms():
             #     data_bytes = waveform[header_len:-1]  # Skip header and terminator
             #     waveform_data = np.frombuffer(data_bytes, dtype=np.int16)
             try:
-                with Threadlock:
-                    bin_wave = C_.scope.query_binary_values('curve?',
+                with C_.tracer.locked(C_.dataLock, 'data session'),\
+                  (C_.tracer.span('CURVe?', ch=ch) if C_.tracer.enabled
+                  else NullSpan) as span:
+                    bin_wave = C_.dataScope.query_binary_values('curve?',
                         datatype='h', is_big_endian=BigEndian,
                         container=np.array)
+                    span.args['bytes'] = bin_wave.nbytes
             except Exception as e:
                 printe(f'in query_binary_values: {e}')
+                transferFailed = True
                 break
+            measure_throughput(bin_wave.nbytes, timer() - ts)
             ElapsedTime['query_wf'] += timer() - ts
             ts = timer()
 
-            # Convert to vertical divisions
-            #v = (waveform_data - yoff) * ymult + yzero
-            v = bin_wave*C_.ymult[ch] + C_.yzero[ch]
-            v = v/pvv(f'c{ch:02}VoltsPerDiv')
-
-            # publish
+            # process and publish
             operation = 'publishing'
-            publish(f'c{ch:02}Waveform', v, t=C_.trigTime)
-            publish(f'c{ch:02}Peak2Peak', np.ptp(v), t=C_.trigTime)
-            publish(f'c{ch:02}Mean', np.mean(v), t=C_.trigTime)
+            process_waveform(ch, bin_wave, vscale, voffset)
         except visa.errors.VisaIOError as e:
             printe(f'Visa exception in {operation} for {ch}:{e}')
+            transferFailed = True
             break
         except Exception as e:
             printe(f'Exception in processing channel {ch}: {e}')
         ElapsedTime['publish_wf'] += timer() - ts
-    ElapsedTime['acquire_wf'] = timer() - ElapsedTime['acquire_wf']
-    printvv(f'elapsedTime: {ElapsedTime}')
+    for ch in pargs.digitalList:
+        if transferFailed:
+            break
+        if pvv(f'd{ch:02}Clients') > 0:
+            transferFailed = not acquire_digital(ch)
+    return transferFailed
+
+def scpiCache_file():
+    """File of the validated SCPI map for this instrument model, firmware,
+    channel count and the SCPI definitions of the PVs"""
+    # the serial number does not matter
+    model = ','.join([s.strip() for i,s in enumerate(C_.idn.split(','))
+        if i != 2])
+    scpis = [(pvdef[0], pvdef[3]['scpi']) for pvdef in C_.PvDefs
+        if 'scpi' in pvdef[3]]
+    key = f'{model};{pargs.channels};{scpis}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(pargs.cacheDir, f'scpi_{digest}.json')
+
+def load_scpiCache():
+    """Return the cached SCPI map and readSettingQuery, None if
+    there is no cache for this instrument"""
+    filename = scpiCache_file()
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        printw(f'Could not read SCPI cache {filename}: {e}')
+        return None
+    printi(f'Validated SCPI map is taken from {filename}, use --revalidate if the instrument misbehaves')
+    return cache
+
+def save_scpiCache():
+    """Store the validated SCPI map and readSettingQuery"""
+    filename = scpiCache_file()
+    try:
+        os.makedirs(pargs.cacheDir, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump({'idn':C_.idn, 'channels':pargs.channels,
+                'scpi':C_.scpi, 'readSettingQuery':C_.readSettingQuery},
+                f, indent=1)
+    except Exception as e:
+        printw(f'Could not write SCPI cache {filename}: {e}')
 
 def make_readSettingQuery():
-    """Create combined SCPI query to read all settings at once"""
+    """Create combined SCPI query to read all settings at once. Each SCPI
+    is validated by the instrument, unless it was cached for the same
+    instrument model and firmware."""
+    cache = None
+    if pargs.cacheDir and not pargs.revalidate:
+        cache = load_scpiCache()
     for pvdef in C_.PvDefs:
         pvname = pvdef[0]
         # if setter is defined, add it to the setterMap
@@ -551,6 +1971,8 @@ def make_readSettingQuery():
             continue
         scpi = scpi.replace('<n>',pvname[2])#
         scpi = ''.join([char for char in scpi if not char.islower()])# remove lowercase letters
+        if cache is not None:
+            continue
         # check if scpi is correct:
         s = scpi+'?'
         try:
@@ -563,7 +1985,13 @@ def make_readSettingQuery():
         if not scpi[0] in '!*':# only SCPI starting with !,* are not added
             C_.scpi[pvname] = scpi
        
-    C_.readSettingQuery = '?;:'.join(C_.scpi.values()) + '?'
+    if cache is not None:
+        C_.scpi = cache['scpi']
+        C_.readSettingQuery = cache['readSettingQuery']
+    else:
+        C_.readSettingQuery = '?;:'.join(C_.scpi.values()) + '?'
+        if pargs.cacheDir:
+            save_scpiCache()
     printv(f'readSettingQuery: {C_.readSettingQuery}')
     #printv(f'setterMap: {C_.setterMap}')
 
@@ -574,6 +2002,8 @@ def init():
     C_.yoff = [0.]*(pargs.channels+1)
     init_visa()
     make_readSettingQuery()
+    make_syncTiers()
+    load_snapshots()
     adopt_local_setting()
     update_scopeParameters()
     publish('version', __version__)
@@ -581,13 +2011,21 @@ def init():
 def periodicUpdate():
     """Called for infrequent updates"""
     printvv(f'periodicUpdate')
+    if not C_.connected:
+        publish('downtime', round(C_.downtime + time.time() - C_.downSince,1))
+        return
+    if C_.streamer is None:# streaming updates them when it restarts
+        try:
+            update_scopeParameters()
+        except:
+            handle_exception('in update_scopeParameters')
     try:
-        update_scopeParameters()
+        with Threadlock:
+            r = C_.scope.query(':ACTONEVent:ENable?;:DATE?;:TIMe?').split(';')
+            # the dateTime is here, because it is dual command
     except:
-        handle_exception('in update_scopeParameters')
-    with Threadlock:
-        r = C_.scope.query(':ACTONEVent:ENable?;:DATE?;:TIMe?').split(';')
-        # the dateTime is here, because it is dual command
+        handle_exception('in periodicUpdate')
+        return
     dt = ' '.join(r[1:3]).replace('"','')
     #print(f'dateTime: {dt}, {r}')
     publish('dateTime', dt)
@@ -597,31 +2035,187 @@ def periodicUpdate():
     if 'STOP' in str(pvv('trigState')).upper():
         printe('Acquisition is stopped')
     publish('timing', [(round(i,6)) for i in ElapsedTime.values()])
+    publish('skippedMB', round(C_.bytesSkipped/1.e6,3), IF_CHANGED)
+    publish('throttledUpdates', C_.throttledUpdates, IF_CHANGED)
+    publish('unchangedUpdates', C_.unchangedUpdates, IF_CHANGED)
+    publish('linkMBps', round(C_.linkMBps,3), IF_CHANGED)
+    ts, acqCount = time.time(), pvv('acqCount')
+    replayed = 0 if C_.replay is None else C_.replay.acquisitions
+    if C_.lastRate[0] > 0.:
+        dt = ts - C_.lastRate[0]
+        publish('acqRate', round((acqCount - C_.lastRate[1])/dt,3))
+        if pargs.sequence:
+            publish('gapFreeRate', round((C_.sequences - C_.lastRate[2])/dt,3))
+        if C_.replay is not None:
+            report_replay((replayed - C_.lastRate[3])/dt)
+    C_.lastRate = (ts, acqCount, C_.sequences, replayed)
+    if pargs.autoTune:
+        tune_transport()
+    if C_.offloader is not None:
+        publish('offloadPending', C_.offloader.pending())
+    if C_.recorder is not None:
+        depth, dropped, mbps = C_.recorder.stats()
+        publish('recordFile', C_.recorder.filename, IF_CHANGED)
+        publish('recordQueue', depth)
+        publish('recordDropped', dropped, IF_CHANGED)
+        publish('recordMBps', round(mbps,3))
+    if C_.ring is not None:
+        publish('ringRange', list(C_.ring.range()))
+    if C_.tracer.enabled:
+        publish('traceSpans', len(C_.tracer), IF_CHANGED)
+    if C_.capture is not None:
+        C_.capture.flush()
+
+def report_replay(offered:float):
+    """Compare the publish rate with the rate of acquisitions, offered by
+    the replay. At the replay speed 0 the offer follows the server, so it
+    is always saturated and the acqRate is its max sustained rate."""
+    published = pvv('acqRate')
+    C_.replayPeakRate = max(C_.replayPeakRate, published)
+    steps = {step:ElapsedTime.get(step, 0.) for step in ReplaySteps}
+    slowest = max(steps, key=steps.get)
+    saturated = C_.replay.speed == 0. or published < SaturationRatio*offered
+    report = f'{"saturated" if saturated else "sustained"} at {published:.1f} Hz, slowest step: {slowest} {steps[slowest]*1000.:.1f} ms'
+    publish('replayRate', round(offered,3))
+    publish('replayReport', report)
+    if saturated != C_.replaySaturated:
+        # a CURVEStream replay offers the stream, not the trigger replies
+        offer = f'offered {offered:.1f} Hz, ' if offered else ''
+        printi(f'Replay: {offer}{report}')
+    C_.replaySaturated = saturated
 
 def poll():
     """Example of polling function"""
+    if not C_.connected:
+        if time.time() >= C_.nextAttempt:
+            reconnect()
+        return
+    sync_settings()
+    if not C_.connected:
+        return
+    if pargs.curveStream:
+        poll_curveStream()
+        return
+    if pargs.sequence:
+        poll_sequence()
+        return
     if trigger_is_detected():
         acquire_waveforms()
 
 #``````````````````Main```````````````````````````````````````````````````````
 if __name__ == "__main__":
+    C_.startTime = time.time()
     # Argument parsing
     parser = argparse.ArgumentParser(description = __doc__,
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     epilog=f'{__version__}')
+    parser.add_argument('-A', '--autoTune', action='store_true', help=
+    'Adapt the VISA read chunk size and, with --splitSessions, the timeout of waveform transfers to the record length and the measured throughput')
+    parser.add_argument('-a', '--alwaysRead', default='', help=
+    'Comma-separated list of channels, which are read even when no client watches them, e.g. for archiving')
+    parser.add_argument('--calibrate', action='store_true', help=
+    'Measure the throughput with a waveform transfer at startup, for --autoTune')
+    parser.add_argument('--cacheDir', default=os.path.expanduser(
+    '~/.cache/epicsdev_tektronix'), help=
+    'Directory to cache the validated SCPI map and the setup snapshots in, it speeds up the startup, the trace dumps are written there too, empty: no cache')
+    parser.add_argument('--capture', default='', help=
+    'File to capture the traffic of the instrument sessions to, for the --replay')
+    parser.add_argument('--chunkPoints', type=int, default=0, help=
+    'Read waveforms in chunks of this number of points and process them on the fly, it bounds the memory for long records, 0: read whole waveforms')
+    parser.add_argument('--codec', choices=['auto','zlib','lz4'],
+    default='auto', help=
+    'Codec of the compressed waveforms, auto: lz4 if it is installed, zlib otherwise')
+    parser.add_argument('--controlTimeout', type=int, default=5000, help=
+    'Timeout (ms) of the control session')
     parser.add_argument('-c', '--channels', type=int, default=4, help=
     'Number of channels per device')
+    parser.add_argument('--dataTimeout', type=int, default=20000, help=
+    'Timeout (ms) of the data session, opened with --splitSessions')
+    parser.add_argument('-S', '--curveStream', action='store_true', help=
+    'Continuous acquisition: the scope pushes waveforms of all enabled channels with CURVEStream?, the trigger is not polled. It implies --splitSessions')
+    parser.add_argument('-D', '--digital', default='', help=
+    'Comma-separated list of FlexChannels with logic probes, e.g. 5,6, their lines are published as d<nn> PVs')
     parser.add_argument('-d', '--device', default='tektronix', help=
     'Device name, the PV name will be <device><index>:')
+    parser.add_argument('-f', '--fullTAxis', action='store_true', help=
+    'Publish full tAxis array, by default it is published only while a client watches it')
     parser.add_argument('-i', '--index', default='0', help=
     'Device index, the PV name will be <device><index>:') 
+    parser.add_argument('-M', '--mathChannels', type=int, default=2, help=
+    'Number of math channels, defined by the m<nn>Expression PVs')
+    parser.add_argument('-m', '--maxRates', default='', help=
+    'Max publish rates (Hz) of channel PVs, e.g. Waveform:2,WaveformDisplay:5, the PVs not listed are published on every trigger')
+    parser.add_argument('--revalidate', action='store_true', help=
+    'Validate the SCPI commands by the instrument, even if they are cached')
+    parser.add_argument('--reconnectMax', type=float, default=60., help=
+    'Max interval (s) between attempts to reconnect to the device, the interval doubles after each failed attempt')
+    parser.add_argument('--ring', default='', help=
+    'File of the memory-mapped ring buffer of recent acquisitions, it survives server restart')
+    parser.add_argument('--ringPoints', type=int, default=100000, help=
+    'Max number of points per channel in the ring buffer. The ring file takes ringSize*channels*ringPoints*2 bytes, 240 MB with the defaults and 4 channels')
+    parser.add_argument('--ringSize', type=int, default=300, help=
+    'Number of acquisitions in the ring buffer')
+    parser.add_argument('-p', '--processes', type=int, default=0, help=
+    'Number of worker processes for scaling and statistics of waveforms, 0: process in the acquisition thread')
+    parser.add_argument('-R', '--record', default='', help=
+    'Directory to record acquisitions of all channels to, HDF5 files if h5py is installed, binary otherwise')
+    parser.add_argument('--recordCompression', choices=['none','lzf','gzip'],
+    default='none', help='Compression of the recorded HDF5 files')
+    parser.add_argument('--recordQueue', type=int, default=100, help=
+    'Max number of acquisitions waiting to be recorded, the acquisitions are dropped when it is full')
+    parser.add_argument('--rotateMB', type=float, default=1000., help=
+    'Start new record file when the current one exceeds this size')
+    parser.add_argument('--rotateMinutes', type=float, default=60., help=
+    'Start new record file after this time')
+    parser.add_argument('--replay', default='', help=
+    'Replay the file, captured with --capture, instead of connecting to the instrument')
+    parser.add_argument('--replaySpeed', type=float, default=0., help=
+    'Speed of the --replay relative to the captured timing, 0: as fast as the server can publish')
     parser.add_argument('-r', '--resource', default='TCPIP::192.168.1.100::5025::SOCKET', help=
     'Resource string to access the device, e.g., TCPIP::192.168.1.100::INSTR. Note, the INSTR is more reliable, SOCKET is faster for long waveforms')
+    parser.add_argument('-s', '--splitSessions', action='store_true', help=
+    'Open separate VISA sessions for waveform transfers and for control, so that the control commands do not wait for waveform transfers')
+    parser.add_argument('--sequence', action='store_true', help=
+    'Single-sequence acquisition: arm, wait for the completion, read all channels and re-arm, so that all waveforms belong to the same trigger')
+    parser.add_argument('--syncFast', type=float, default=1., help=
+    'Interval (s) of reading the volatile settings and the event status register, 0: never')
+    parser.add_argument('--syncSlow', type=float, default=30., help=
+    'Interval (s) of reading the stable settings, they are read earlier when the front panel was used, 0: never')
+    parser.add_argument('--streamPool', type=int, default=8, help=
+    'Number of buffered acquisitions in the --curveStream mode')
+    parser.add_argument('--shm', default='', help=
+    'Name of the shared-memory segment to export acquisitions to, see epicsdev_tektronix.shmexport.ShmReader')
+    parser.add_argument('--shmPoints', type=int, default=1000000, help=
+    'Max number of points per channel in the shared-memory segment')
+    parser.add_argument('--trace', type=int, default=0, help=
+    'Record spans of the acquisition steps into a buffer of this size, for dumping with the traceDump PV, 0: tracing is off')
     parser.add_argument('-v', '--verbose', action='count', default=0, help=
     'Show more log messages (-vv: show even more)') 
     pargs = parser.parse_args()
     print(f'pargs: {pargs}')
     pargs.channelList = [f'CH{i+1}' for i in range(pargs.channels)]
+    pargs.digitalList = [int(ch) for ch in pargs.digital.split(',') if ch]
+    try:
+        pargs.codec = choose_codec(pargs.codec)
+    except ValueError as e:
+        printe(str(e))
+        sys.exit(1)
+    if pargs.curveStream:
+        pargs.splitSessions = True# the data session is busy all the time
+        if pargs.sequence:
+            printw('--sequence is ignored with --curveStream')
+            pargs.sequence = False
+        if pargs.digitalList:
+            printw('--digital is ignored with --curveStream')
+            pargs.digitalList = []
+    if pargs.splitSessions:
+        C_.dataLock = threading.Lock()
+    if pargs.trace > 0:
+        C_.tracer = Tracer(pargs.trace)
+    if pargs.replay:
+        C_.replay = Replay(pargs.replay, pargs.replaySpeed)
+    elif pargs.capture:
+        C_.capture = Capture(pargs.capture)
 
     # Initialize epicsdev and PVs
     pargs.prefix = f'{pargs.device}{pargs.index}:'
@@ -630,7 +2224,39 @@ if __name__ == "__main__":
 
     # Initialize the device, using pargs if needed.
     init()
+    if pargs.calibrate:
+        try:
+            calibrate_transport()
+        except:
+            handle_exception('in calibrate_transport')
+    watch_channelPVs()
+    set_maxRates(pargs.maxRates)
+    if pargs.processes > 0:
+        if pargs.chunkPoints > 0:
+            printw('--chunkPoints is ignored with --processes')
+        C_.offloader = Offloader(pargs.processes, publish_products)
+    if pargs.record:
+        C_.recorder = Recorder(pargs.record, pargs.prefix.replace(':','_'),
+            pargs.recordQueue,
+            None if pargs.recordCompression == 'none' else pargs.recordCompression,
+            pargs.rotateMB, pargs.rotateMinutes)
+    if pargs.ring:
+        C_.ring = RingBuffer(pargs.ring, pargs.ringSize, pargs.channels,
+            pargs.ringPoints)
+        printi(f'Ring buffer {pargs.ring}, reused: {C_.ring.reused}, acqCounts of previous runs: {C_.ring.range(allRuns=True)}')
+    if pargs.shm:
+        if pargs.channels > MaxShmChannels:
+            printe(f'Shared-memory export supports up to {MaxShmChannels} channels')
+            sys.exit(1)
+        C_.shm = ShmWriter(pargs.shm, pargs.channels, pargs.shmPoints)
+        printi(f'Exporting acquisitions to shared memory /dev/shm/{pargs.shm}')
 
+    if C_.replay is not None:
+        override_sleep(0.001 if pargs.replaySpeed > 0. else 0.,
+            'the main loop must not limit the rate, offered by the replay')
+    elif pargs.curveStream or pargs.sequence:
+        # the acquisitions are awaited in poll_curveStream or poll_sequence
+        override_sleep(0.01, 'the acquisitions are awaited in the poll')
     # Start the Server.
     set_server('Start')
 
@@ -643,6 +2269,23 @@ if __name__ == "__main__":
             break
         if not state.startswith('Stop'):
             poll()
+        elif C_.streamer is not None:
+            stop_curveStream()
         if not sleep():
             periodicUpdate()
+    stop_curveStream()
+    if pargs.sequence and C_.connected:
+        stop_sequence()
+    if C_.offloader is not None:
+        C_.offloader.close()
+    if C_.recorder is not None:
+        C_.recorder.close()
+    if C_.ring is not None:
+        C_.ring.flush()
+    if C_.shm is not None:
+        C_.shm.close()
+    if C_.capture is not None:
+        C_.capture.close()
+    if C_.replay is not None:
+        printi(f'Replay: {pvv("acqCount")} acquisitions published in {time.time() - C_.startTime:.1f} s, peak sustained rate {C_.replayPeakRate:.1f} Hz')
     printi('Server is exited')
@@ -0,0 +1,134 @@
+"""Offload of the per-channel processing to a pool of worker processes.
+The raw samples are passed to the workers through shared-memory slots,
+the scaled waveforms are returned in the same slots, only the small
+products (statistics and display envelopes) are pickled. The results are
+delivered to the callback on a publisher thread in the order of
+submission, that is in the order of acqCount.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.2 26-10-19'# workers release the replaced slots
+import os
+import queue
+import threading
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from epicsdev.epicsdev import printe
+from .processing import channel_products, Buffers
+
+#``````````````````Worker side````````````````````````````````````````````````
+_Attached = {}# {slot name: SharedMemory} of the worker process
+_Buffers = Buffers()# the products are pickled, so the buffers can be reused
+
+def _attach(name:str, live:frozenset):
+    """Shared memory of the slot, attached once per worker process. The
+    mappings of the slots, which are not live, i.e. were replaced by larger
+    ones, are closed, so that their memory is released."""
+    for old in [n for n in _Attached if n not in live]:
+        _Attached.pop(old).close()
+    shm = _Attached.get(name)
+    if shm is None:
+        # The workers share the resource tracker of the server, which
+        # owns the slot, so the slot remains registered only once.
+        shm = shared_memory.SharedMemory(name)
+        _Attached[name] = shm
+    return shm
+
+def _process(name:str, live:frozenset, capacity:int, npoints:int,
+        scale:float, offset:float, step:int, plan:list):
+    """Worker task: compute products of the raw samples in the slot.
+    The scaled waveform is stored in the slot, it is not returned.
+    The live are the names of all current slots."""
+    shm = _attach(name, live)
+    raw = np.ndarray((npoints,), np.int16, shm.buf)
+    out = np.ndarray((npoints,), np.float32, shm.buf, offset=capacity*2)
+    products = channel_products(raw, scale, offset, step, plan, out, _Buffers)
+    products.pop('Waveform', None)
+    return products
+
+#``````````````````Server side````````````````````````````````````````````````
+class _Slot():
+    """Shared memory for raw samples and the scaled waveform of a channel"""
+    _names = itertools.count()
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.name = f'tkoffload_{os.getpid()}_{next(self._names)}'
+        self.shm = shared_memory.SharedMemory(self.name, create=True,
+            size=capacity*(2+4))
+        self.raw = np.ndarray((capacity,), np.int16, self.shm.buf)
+        self.out = np.ndarray((capacity,), np.float32, self.shm.buf,
+            offset=capacity*2)
+
+    def close(self):
+        del self.raw, self.out
+        self.shm.close()
+        self.shm.unlink()
+
+class Offloader():
+    """Pool of nworkers processes. The callback(ch, products, trigTime) is
+    called on the publisher thread for each submitted channel, in the order
+    of submission. The products['Waveform'] is a view into a slot, it is
+    valid only during the callback."""
+    def __init__(self, nworkers:int, callback):
+        self.callback = callback
+        self.pool = ProcessPoolExecutor(max_workers=nworkers,
+            mp_context=mp.get_context('spawn'))
+        self._free = queue.Queue()
+        self._live = frozenset()# names of the current slots
+        for _ in range(2*nworkers):
+            self._free.put(None)# slots are allocated on demand
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._publisher, daemon=True)
+        self._thread.start()
+
+    def pending(self):
+        """Number of submitted channels, not yet delivered"""
+        return self._pending.qsize()
+
+    def submit(self, ch:int, raw, scale:float, offset:float, step:int,
+            plan:list, trigTime:float):
+        """Copy raw samples to a free slot and submit their processing.
+        Blocks if all slots are busy, that throttles the acquisition to
+        the processing capacity."""
+        slot = self._free.get()
+        npoints = len(raw)
+        if slot is None or slot.capacity < npoints:
+            live = set(self._live)
+            if slot is not None:
+                slot.close()
+                live.discard(slot.name)
+            slot = _Slot(npoints)
+            live.add(slot.name)
+            self._live = frozenset(live)
+        slot.raw[:npoints] = raw
+        future = self.pool.submit(_process, slot.name, self._live,
+            slot.capacity, npoints, scale, offset, step, plan)
+        self._pending.put((ch, slot, npoints, plan, trigTime, future))
+
+    def _publisher(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            ch, slot, npoints, plan, trigTime, future = item
+            try:
+                products = future.result()
+                if 'Waveform' in plan:
+                    products = {'Waveform':slot.out[:npoints], **products}
+                self.callback(ch, products, trigTime)
+            except Exception as e:
+                printe(f'in offloaded processing of channel {ch}: {e}')
+            self._free.put(slot)
+
+    def close(self):
+        """Deliver pending results, stop the workers and release the slots"""
+        self._pending.put(None)
+        self._thread.join()
+        self.pool.shutdown()
+        while not self._free.empty():
+            slot = self._free.get()
+            if slot is not None:
+                slot.close()
@@ -0,0 +1,311 @@
+"""Per-channel processing of raw waveforms. The functions use only numpy,
+so that they can run in the server as well as in the worker processes of
+the offload module."""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.4 26-10-19'# pulse detection
+import zlib
+import math
+import numpy as np
+
+class Buffers():
+    """Reusable arrays, identified by a key. An array is reallocated only
+    when its length or type changes, i.e. when the record length changes.
+    The allocations and allocatedBytes count all allocations, they stay
+    constant in the steady state."""
+    def __init__(self):
+        self.arrays = {}
+        self.allocations = 0
+        self.allocatedBytes = 0
+
+    def get(self, key, n:int, dtype):
+        """Array of n elements of dtype, its content is undefined"""
+        a = self.arrays.get(key)
+        if a is None or len(a) != n or a.dtype != dtype:
+            a = self.new(n, dtype)
+            self.arrays[key] = a
+        return a
+
+    def new(self, n:int, dtype):
+        """Accounted allocation of an array, which cannot be reused"""
+        a = np.empty(n, dtype)
+        self.allocations += 1
+        self.allocatedBytes += a.nbytes
+        return a
+
+def envelope_length(npoints:int, step:int):
+    """Length of the minmax_envelope() of npoints"""
+    nbins = npoints//step
+    return npoints if step <= 1 or nbins == 0 else 2*nbins
+
+def minmax_envelope(wave, step:int, out=None):
+    """Decimate wave by the factor of step, keeping min and max of each bin.
+    The result contains interleaved (min,max) pairs, so that narrow glitches
+    remain visible. Samples beyond the last full bin are merged into it.
+    If out is given, the result is stored there."""
+    nbins = len(wave)//step
+    if step <= 1 or nbins == 0:
+        return wave
+    bins = wave[:nbins*step].reshape(nbins, step)
+    envelope = np.empty((nbins,2), dtype=wave.dtype) if out is None\
+        else out.reshape(nbins,2)
+    np.min(bins, axis=1, out=envelope[:,0])
+    np.max(bins, axis=1, out=envelope[:,1])
+    tail = wave[nbins*step:]
+    if len(tail):
+        envelope[-1,0] = min(envelope[-1,0], tail.min())
+        envelope[-1,1] = max(envelope[-1,1], tail.max())
+    return envelope.ravel()
+
+def scale_waveform(raw, scale:float, offset:float, out=None):
+    """Return raw*scale + offset as float32, which is the type of the
+    waveform PVs. If out is given, the result is stored there."""
+    out = np.multiply(raw, scale, out=out, dtype=np.float32)
+    out += np.float32(offset)
+    return out
+
+def channel_products(raw, scale:float, offset:float, step:int, plan, out=None,
+        buffers=None):
+    """Compute the products of a channel, listed in plan, from its raw
+    samples. The plan is a list of the channel PV suffixes: Waveform,
+    WaveformDisplay, Peak2Peak, Mean. The statistics are computed on the
+    raw samples, that is cheaper than on the scaled waveform.
+    The arrays are stored in out (the Waveform) and in the Buffers of the
+    channel, if given, they are valid until the next call.
+    Returns {suffix: value} map."""
+    products = {}
+    buffers = Buffers() if buffers is None else buffers
+    npoints = len(raw)
+    for suffix in plan:
+        if suffix == 'Waveform':
+            if out is None:
+                out = buffers.get(suffix, npoints, np.float32)
+            products[suffix] = scale_waveform(raw, scale, offset, out)
+        elif suffix == 'WaveformDisplay':
+            n = envelope_length(npoints, step)
+            envelope = minmax_envelope(raw, step,
+                buffers.get('envelope', n, raw.dtype))
+            products[suffix] = scale_waveform(envelope, scale, offset,
+                buffers.get(suffix, n, np.float32))
+        elif suffix == 'Peak2Peak':# float() avoids int16 overflow
+            products[suffix] = (float(raw.max()) - float(raw.min()))*abs(scale)
+        elif suffix == 'Mean':
+            products[suffix] = float(np.mean(raw))*scale + offset
+    return products
+
+DigitalLines = 8# number of logic lines of a digital channel
+
+def digital_products(dall, buffers=None):
+    """Products of a digital channel from its samples dall, one uint8 per
+    sample, bit k of which is the logic line k. Returns {suffix: value} map:
+    Bits: lines packed by np.packbits, shaped (DigitalLines, ceil(n/8)) and
+    flattened, the line k is Bits.reshape(DigitalLines,-1)[k];
+    Edges: indices of the samples, where a line changed, of all lines,
+    line 0 first; EdgeCounts: number of edges of each line, the edges of
+    the lines are np.split(Edges, np.cumsum(EdgeCounts)[:-1])."""
+    buffers = Buffers() if buffers is None else buffers
+    npoints = len(dall)
+    nbytes = (npoints + 7)//8
+    packed = buffers.get('Bits', DigitalLines*nbytes, np.uint8)
+    line = buffers.get('line', npoints, np.uint8)
+    for k in range(DigitalLines):
+        np.right_shift(dall, k, out=line)
+        np.bitwise_and(line, 1, out=line)
+        packed[k*nbytes:(k+1)*nbytes] = np.packbits(line)
+    # all lines at once: the changed bits of the changed samples
+    changed = buffers.get('changed', max(npoints-1,0), np.uint8)
+    np.bitwise_xor(dall[1:], dall[:-1], out=changed)
+    where = np.flatnonzero(changed)
+    bits = np.unpackbits(changed[where][:,None], axis=1, bitorder='little')
+    lines, positions = np.nonzero(bits.T)# ordered by line, then by position
+    edges = (where[positions] + 1).astype(np.uint32)
+    counts = np.bincount(lines, minlength=DigitalLines).astype(np.int32)
+    return {'Bits':packed, 'Edges':edges, 'EdgeCounts':counts}
+
+def _entries(region, buffers, key):
+    """Indices of the samples, where the boolean region is entered"""
+    n = len(region)
+    entered = buffers.get(key, max(n-1,0), bool)
+    np.greater(region[1:], region[:-1], out=entered)
+    return np.flatnonzero(entered) + 1
+
+def find_pulses(raw, high:float, low:float, negative=False, buffers=None):
+    """Detect pulses in raw samples by a comparator with hysteresis: a pulse
+    starts when the samples reach the high threshold and ends when they
+    pass the low one. For negative pulses the samples go below the high
+    threshold and above the low one. Pulses, truncated by the ends of the
+    record, are ignored. Beyond the vectorized comparisons, the work is
+    proportional to the number of threshold crossings.
+    Returns arrays of the rising and falling indices: the first sample of
+    each pulse past the high threshold and the first one past the low."""
+    buffers = Buffers() if buffers is None else buffers
+    n = len(raw)
+    info = np.iinfo(raw.dtype)
+    above = buffers.get('above', n, bool)
+    below = buffers.get('below', n, bool)
+    if negative:
+        np.less_equal(raw, max(math.floor(high), info.min), out=above)
+        np.greater(raw, min(math.floor(low), info.max), out=below)
+    else:
+        np.greater_equal(raw, min(math.ceil(high), info.max), out=above)
+        np.less(raw, max(math.ceil(low), info.min), out=below)
+    # entries of the regions, sorted by position, with the initial state
+    toAbove = _entries(above, buffers, 'entered')
+    toBelow = _entries(below, buffers, 'entered')
+    positions = np.concatenate(([0], toAbove, toBelow))
+    kinds = np.concatenate(([n > 0 and above[0]],# True: the pulse region
+        np.ones(len(toAbove), bool), np.zeros(len(toBelow), bool)))
+    order = np.argsort(positions, kind='stable')
+    positions, kinds = positions[order], kinds[order]
+    # the state of the comparator changes at the alternating entries
+    changes = np.flatnonzero(kinds[1:] != kinds[:-1]) + 1
+    positions, kinds = positions[changes], kinds[changes]
+    if len(kinds) and not kinds[0]:# the record starts inside a pulse
+        positions, kinds = positions[1:], kinds[1:]
+    npulses = len(positions)//2# the last one may be truncated
+    return positions[0:2*npulses:2], positions[1:2*npulses:2]
+
+def _crossings(raw, indices, level:float):
+    """Fractional positions, where the raw samples cross the level between
+    indices-1 and indices"""
+    before = raw[indices-1].astype(np.float64)
+    return indices - 1 + (level - before)/(raw[indices] - before)
+
+def pulse_products(raw, scale:float, offset:float, threshold:float,
+        hysteresis:float, negative:bool, xorigin:float, xincrement:float,
+        window:int, plan, buffers=None):
+    """Compute the pulse products of a channel, listed in plan, from its raw
+    samples. The threshold, hysteresis and the results are in the units of
+    the scaled waveform, raw*scale + offset. The plan is a list of the
+    channel PV suffixes: PulseTimes (crossings of the threshold by the
+    leading edges), PulseWidths (from the threshold to the crossing of the
+    threshold-hysteresis by the trailing edges), PulseHeights (peak
+    values), PulseSamples (zero-suppressed waveform: the samples within
+    window from the pulses) and PulseSegments (start and length of each
+    merged window of PulseSamples, interleaved).
+    Returns {suffix: value} map."""
+    products = {}
+    sign = -1. if negative else 1.
+    high = (threshold - offset)/scale
+    low = (threshold - sign*abs(hysteresis) - offset)/scale
+    negative = negative != (scale < 0)# of the raw samples
+    rising, falling = find_pulses(raw, high, low, negative, buffers)
+    for suffix in plan:
+        if suffix == 'PulseTimes':
+            products[suffix] = xorigin + _crossings(raw, rising, high)*xincrement
+        elif suffix == 'PulseWidths':
+            products[suffix] = (_crossings(raw, falling, low)
+                - _crossings(raw, rising, high))*xincrement
+        elif suffix == 'PulseHeights':
+            peaks = np.empty(0, raw.dtype)
+            if len(rising):
+                reduce = np.minimum if negative else np.maximum
+                bounds = np.stack((rising, falling), axis=1).ravel()
+                peaks = reduce.reduceat(raw, bounds)[::2]
+            products[suffix] = scale_waveform(peaks, scale, offset)
+        elif suffix in ('PulseSamples', 'PulseSegments'):
+            starts = np.maximum(rising - window, 0)
+            ends = np.maximum.accumulate(np.minimum(falling + window, len(raw)))
+            # overlapping windows are merged
+            first = np.ones(len(starts), bool)
+            first[1:] = starts[1:] > ends[:-1]
+            last = np.ones(len(starts), bool)
+            last[:-1] = first[1:]
+            starts = starts[first]
+            lengths = ends[last] - starts
+            if suffix == 'PulseSegments':
+                products[suffix] = np.stack((starts, lengths), axis=1).ravel()\
+                    .astype(np.uint32)
+                continue
+            shifts = starts - np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            indices = np.arange(int(lengths.sum())) + np.repeat(shifts, lengths)
+            products[suffix] = scale_waveform(raw[indices], scale, offset)
+    return products
+
+class StreamingProducts():
+    """Incremental channel_products() of a waveform of npoints, which arrives
+    in consecutive chunks. Each chunk, except the last one, must contain a
+    multiple of step samples. Only the products listed in the plan are
+    accumulated: the full scaled waveform is allocated only if the Waveform
+    is in the plan, the full raw waveform only if keepRaw. Otherwise the
+    memory does not depend on npoints. If checksum, the adler32 of the raw
+    samples is accumulated as well. The arrays, except the raw waveform,
+    are taken from the Buffers of the channel, if given."""
+    def __init__(self, npoints:int, scale:float, offset:float, step:int,
+            plan, keepRaw=False, checksum=False, buffers=None):
+        self.npoints = npoints
+        self.scale = scale
+        self.offset = offset
+        self.step = step
+        self.plan = plan
+        self.buffers = Buffers() if buffers is None else buffers
+        # the raw waveform is passed to the consumers, it cannot be reused
+        self.raw = self.buffers.new(npoints, np.int16) if keepRaw else None
+        self.out = self.buffers.get('Waveform', npoints, np.float32)\
+            if 'Waveform' in plan else None
+        self.checksum = zlib.adler32(b'') if checksum else None
+        self.envelope = None
+        if 'WaveformDisplay' in plan:
+            self.envelope = self.buffers.get('envelope',
+                envelope_length(npoints, step), np.int16)
+        self.nbins = 0# filled in the envelope
+        self.nread = 0
+        self.sum = 0
+        self.min = np.iinfo(np.int16).max
+        self.max = np.iinfo(np.int16).min
+
+    def add(self, chunk):
+        """Account the next chunk of raw samples"""
+        first = self.nread
+        self.nread += len(chunk)
+        if self.raw is not None:
+            self.raw[first:self.nread] = chunk
+        if self.out is not None:
+            scale_waveform(chunk, self.scale, self.offset,
+                self.out[first:self.nread])
+        if self.checksum is not None:
+            self.checksum = zlib.adler32(chunk.data, self.checksum)
+        if self.envelope is not None:
+            self._add_envelope(chunk)
+        if len(chunk) == 0:
+            return
+        if 'Mean' in self.plan:
+            self.sum += int(chunk.sum(dtype=np.int64))
+        if 'Peak2Peak' in self.plan:
+            self.min = min(self.min, int(chunk.min()))
+            self.max = max(self.max, int(chunk.max()))
+
+    def _add_envelope(self, chunk):
+        # Samples beyond the last full bin of the waveform are merged into
+        # the last bin, as in minmax_envelope().
+        if self.step <= 1 or self.npoints < self.step:# no decimation
+            self.envelope[self.nread-len(chunk):self.nread] = chunk
+            return
+        nbins = len(chunk)//self.step
+        tail = chunk[nbins*self.step:]
+        if nbins:
+            minmax_envelope(chunk[:nbins*self.step], self.step,
+                self.envelope[2*self.nbins:2*(self.nbins+nbins)])
+            self.nbins += nbins
+        if len(tail):
+            last = self.envelope[2*self.nbins-2:2*self.nbins]
+            last[0] = min(last[0], tail.min())
+            last[1] = max(last[1], tail.max())
+
+    def products(self):
+        """Return {suffix: value} map in the order of the plan, as
+        channel_products() does"""
+        products = {}
+        for suffix in self.plan:
+            if suffix == 'Waveform':
+                products[suffix] = self.out[:self.nread]
+            elif suffix == 'WaveformDisplay':
+                products[suffix] = scale_waveform(self.envelope, self.scale,
+                    self.offset, self.buffers.get(suffix, len(self.envelope),
+                    np.float32))
+            elif suffix == 'Peak2Peak':
+                products[suffix] = (self.max - self.min)*abs(self.scale)\
+                    if self.nread else 0.
+            elif suffix == 'Mean':
+                products[suffix] = self.sum/max(self.nread,1)*self.scale\
+                    + self.offset
+        return products
@@ -0,0 +1,217 @@
+"""Background recorder of acquisitions for epicsdev_tektronix server.
+The acquisitions are queued by the acquisition thread and written to files
+by a dedicated writer thread, so the disk never stalls the acquisition.
+If h5py is available, the files are chunked, optionally compressed HDF5,
+otherwise a simple append-only binary format is used, see read_binary().
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.2 26-10-19'# files numbered, never overwritten
+import os
+import time
+import struct
+import queue
+import threading
+import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from epicsdev.epicsdev import printi, printe, printw
+
+#``````````````````Binary format``````````````````````````````````````````````
+# Record header: magic, number of channels, acqCount, trigTime, xOrigin,
+# xIncrement, number of points. It is followed by the channel blocks.
+RecordHeader = struct.Struct('<4sIqdddI')
+# Channel block header: channel number, scale, offset. It is followed by
+# the int16 samples.
+ChannelHeader = struct.Struct('<Idd')
+Magic = b'TKAQ'
+
+def write_record(f, acqCount:int, trigTime:float, xorigin:float,
+        xincrement:float, acquired:dict):
+    """Append acquisition to the binary file f, return number of bytes
+    written. The acquired is the {channel:(samples,scale,offset)} map."""
+    npoints = len(next(iter(acquired.values()))[0])
+    f.write(RecordHeader.pack(Magic, len(acquired), acqCount, trigTime,
+        xorigin, xincrement, npoints))
+    nbytes = RecordHeader.size
+    for ch,(samples,scale,offset) in acquired.items():
+        f.write(ChannelHeader.pack(ch, scale, offset))
+        f.write(samples.astype('<i2', copy=False).data)
+        nbytes += ChannelHeader.size + samples.nbytes
+    return nbytes
+
+def read_binary(filename:str):
+    """Generator of acquisitions from the binary file, written by the
+    Recorder. Each acquisition is a dictionary with keys acqCount, trigTime,
+    xOrigin, xIncrement and the {channel:(samples,scale,offset)} map under
+    the key channels."""
+    with open(filename, 'rb') as f:
+        while True:
+            header = f.read(RecordHeader.size)
+            if len(header) < RecordHeader.size:
+                return
+            magic,nch,acqCount,trigTime,xorigin,xincrement,npoints =\
+                RecordHeader.unpack(header)
+            if magic != Magic:
+                raise ValueError(f'Corrupted record in {filename}')
+            channels = {}
+            for _ in range(nch):
+                ch,scale,offset = ChannelHeader.unpack(f.read(ChannelHeader.size))
+                samples = np.frombuffer(f.read(npoints*2), dtype='<i2')
+                channels[ch] = (samples, scale, offset)
+            yield {'acqCount':acqCount, 'trigTime':trigTime, 'xOrigin':xorigin,
+                'xIncrement':xincrement, 'channels':channels}
+
+#``````````````````Recorder```````````````````````````````````````````````````
+class Recorder():
+    """Writes acquisitions to files in the directory on a writer thread.
+    The files are rotated when they exceed rotateMB or rotateMinutes, they
+    are named <prefix><YYYYmmdd_HHMMSS>_<sequence number>.
+    compression is one of None, 'lzf', 'gzip' and only applies to HDF5."""
+    def __init__(self, directory:str, prefix='', queueSize=100,
+            compression=None, rotateMB=1000., rotateMinutes=60.):
+        self.directory = directory
+        self.prefix = prefix
+        self.compression = compression
+        self.rotateBytes = rotateMB*1.e6
+        self.rotateSeconds = rotateMinutes*60.
+        self.hdf5 = h5py is not None
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.dropped = 0
+        self.bytesWritten = 0
+        self.filename = ''
+        self.files = 0# sequence number of the last opened file
+        self._file = None
+        self._fileBytes = 0
+        self._fileStart = 0.
+        self._layout = None# (npoints, channels) of the current file
+        self._lastStats = (time.time(), 0)
+        os.makedirs(directory, exist_ok=True)
+        if not self.hdf5:
+            printw('h5py is not available, recording in binary format')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, acqCount:int, trigTime:float, xorigin:float,
+            xincrement:float, acquired:dict):
+        """Queue the acquisition for writing. The acquired is the
+        {channel:(samples,scale,offset)} map, the samples must not be
+        modified after the call. Returns False if the queue is full and
+        the acquisition was dropped."""
+        if len(acquired) == 0:
+            return True
+        try:
+            self.queue.put_nowait((acqCount, trigTime, xorigin, xincrement,
+                dict(acquired)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stats(self):
+        """Return queue depth, number of dropped acquisitions and write
+        throughput in MB/s since the previous call."""
+        ts = time.time()
+        t0,b0 = self._lastStats
+        self._lastStats = (ts, self.bytesWritten)
+        mbps = (self.bytesWritten - b0)/1.e6/max(ts - t0, 1.e-6)
+        return self.queue.qsize(), self.dropped, mbps
+
+    def close(self):
+        """Write the queued acquisitions and close the file"""
+        self.queue.put(None)
+        self._thread.join()
+
+    #``````````````Writer thread``````````````````````````````````````````````
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.dropped += 1
+                printe(f'Recorder could not write to {self.filename}: {e}')
+                self._close_file()
+        self._close_file()
+
+    def _write(self, acqCount, trigTime, xorigin, xincrement, acquired):
+        npoints = len(next(iter(acquired.values()))[0])
+        layout = (npoints, tuple(acquired))
+        if (self._file is None or layout != self._layout
+            or self._fileBytes >= self.rotateBytes
+            or time.time() - self._fileStart >= self.rotateSeconds):
+            self._open_file(layout)
+        if self.hdf5:
+            nbytes = self._write_hdf5(acqCount, trigTime, xorigin, xincrement,
+                acquired)
+        else:
+            nbytes = write_record(self._file, acqCount, trigTime, xorigin,
+                xincrement, acquired)
+        self._fileBytes += nbytes
+        self.bytesWritten += nbytes
+
+    def _open_file(self, layout):
+        self._close_file()
+        self._layout = layout
+        self._fileStart = time.time()
+        self._fileBytes = 0
+        extension = 'h5' if self.hdf5 else 'bin'
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(self._fileStart))
+        # the rotations may happen within a second, the files of a previous
+        # run may have the same stamp, an existing file is never appended
+        while True:
+            self.files += 1
+            self.filename = os.path.join(self.directory,
+                f'{self.prefix}{stamp}_{self.files:04}.{extension}')
+            if not os.path.exists(self.filename):
+                break
+        if not self.hdf5:
+            self._file = open(self.filename, 'xb')
+            printi(f'Recording to {self.filename}')
+            return
+        npoints,channels = layout
+        self._file = h5py.File(self.filename, 'w-')
+        scalars = {'acqCount':'i8', 'trigTime':'f8', 'xOrigin':'f8',
+            'xIncrement':'f8'}
+        for name,dtype in scalars.items():
+            self._file.create_dataset(name, (0,), dtype=dtype, maxshape=(None,),
+                chunks=(1024,))
+        for name in ('scale','offset'):
+            self._file.create_dataset(name, (0,len(channels)), dtype='f8',
+                maxshape=(None,len(channels)), chunks=(1024,len(channels)))
+        for ch in channels:
+            self._file.create_dataset(f'c{ch:02}', (0,npoints), dtype='i2',
+                maxshape=(None,npoints), chunks=(1,npoints),
+                compression=self.compression)
+        self._file.attrs['channels'] = list(channels)
+        printi(f'Recording to {self.filename}')
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_hdf5(self, acqCount, trigTime, xorigin, xincrement, acquired):
+        f = self._file
+        n = len(f['acqCount'])
+        values = {'acqCount':acqCount, 'trigTime':trigTime, 'xOrigin':xorigin,
+            'xIncrement':xincrement}
+        for name,value in values.items():
+            f[name].resize((n+1,))
+            f[name][n] = value
+        scales = [scale for _,scale,_ in acquired.values()]
+        offsets = [offset for _,_,offset in acquired.values()]
+        for name,value in (('scale',scales), ('offset',offsets)):
+            f[name].resize((n+1,len(acquired)))
+            f[name][n] = value
+        nbytes = 0
+        for ch,(samples,_,_) in acquired.items():
+            dataset = f[f'c{ch:02}']
+            dataset.resize((n+1,dataset.shape[1]))
+            dataset[n] = samples
+            nbytes += samples.nbytes
+        return nbytes
@@ -0,0 +1,322 @@
+"""Capture and replay of instrument sessions, for load-testing the server
+and its PVAccess consumers without an instrument.
+The Capture wraps the VISA sessions and appends everything the server
+writes and everything the instrument replies (settings, preambles, CURVe?
+blocks, streamed reads) to a file. The Replay is a drop-in replacement of
+the VISA resource manager: its sessions answer the queries with the
+captured replies of the same command and the same DATa:SOUrce. The
+acquisition count (ACQuire:NUMACq?) is renumbered, so that the replay can
+cycle through the capture indefinitely, either as fast as the server asks
+(speed 0) or at the captured timing, scaled by the speed.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.0 26-10-19'# initial version
+import re
+import time
+import bisect
+import struct
+import threading
+import numpy as np
+from pyvisa.errors import VisaIOError
+from pyvisa import constants
+
+from epicsdev.epicsdev import printi, printw
+
+#``````````````````Capture format`````````````````````````````````````````````
+# Record header: operation, session number, time (s) since the capture
+# start, numpy dtype of binary values, command length, payload length.
+# It is followed by the command and the payload.
+# The operations are: W - write, Q - query, B - query_binary_values,
+# R - read_bytes or read_raw after a written query.
+RecordHeader = struct.Struct('<cBd4sII')
+Magic = b'TKCAPT01'
+SourceRe = re.compile(r'DAT(?:A)?:SOU(?:RCE)?\s+([^;\s]+)', re.IGNORECASE)
+
+def source_of(cmd:str, source:str):
+    """The DATa:SOUrce, selected by the command, or the current one"""
+    m = SourceRe.search(cmd)
+    return source if m is None else m.group(1).upper()
+
+def is_query(cmd:str):
+    """True if the last command of the compound command is a query"""
+    return cmd.rstrip().endswith('?')
+
+class Capture():
+    """Appends the traffic of the wrapped sessions to the file"""
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.f = open(filename, 'wb')
+        self.f.write(Magic)
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.sessions = 0
+        self.nbytes = len(Magic)
+        printi(f'Capturing the instrument sessions to {filename}')
+
+    def session(self, session):
+        """Return the session, wrapped for capturing"""
+        self.sessions += 1
+        return CapturedSession(session, self, self.sessions - 1)
+
+    def record(self, op:bytes, sid:int, cmd:str, payload:bytes, dtype=''):
+        cmd = cmd.encode()
+        header = RecordHeader.pack(op, sid, time.perf_counter() - self.t0,
+            dtype.encode(), len(cmd), len(payload))
+        with self.lock:
+            self.f.write(header)
+            self.f.write(cmd)
+            self.f.write(payload)
+            self.nbytes += len(header) + len(cmd) + len(payload)
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+        printi(f'Capture {self.filename} closed, {self.nbytes/1.e6:.1f} MB')
+
+class CapturedSession():
+    """VISA session, which records its traffic to the Capture. Only the
+    methods, used by the server, are recorded, the rest is delegated."""
+    __slots__ = ('_session', '_capture', '_sid')
+    def __init__(self, session, capture:Capture, sid:int):
+        object.__setattr__(self, '_session', session)
+        object.__setattr__(self, '_capture', capture)
+        object.__setattr__(self, '_sid', sid)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._session, name, value)
+
+    def write(self, cmd:str):
+        r = self._session.write(cmd)
+        self._capture.record(b'W', self._sid, cmd, b'')
+        return r
+
+    def query(self, cmd:str):
+        reply = self._session.query(cmd)
+        self._capture.record(b'Q', self._sid, cmd, reply.encode())
+        return reply
+
+    def query_binary_values(self, cmd:str, **kwargs):
+        values = self._session.query_binary_values(cmd, **kwargs)
+        values = np.asarray(values)
+        self._capture.record(b'B', self._sid, cmd, values.tobytes(),
+            values.dtype.str)
+        return values
+
+    def read_bytes(self, count:int):
+        data = self._session.read_bytes(count)
+        self._capture.record(b'R', self._sid, '', data)
+        return data
+
+    def read_raw(self):
+        data = self._session.read_raw()
+        self._capture.record(b'R', self._sid, '', data)
+        return data
+
+#``````````````````Replay`````````````````````````````````````````````````````
+def read_capture(filename:str):
+    """Generator of the captured records as tuples
+    (operation, session, time, dtype, command, payload)"""
+    with open(filename, 'rb') as f:
+        if f.read(len(Magic)) != Magic:
+            raise ValueError(f'{filename} is not a session capture')
+        while True:
+            header = f.read(RecordHeader.size)
+            if len(header) < RecordHeader.size:
+                return
+            op,sid,t,dtype,ncmd,npayload = RecordHeader.unpack(header)
+            cmd = f.read(ncmd).decode()
+            payload = f.read(npayload)
+            if len(payload) < npayload:
+                return# truncated by a kill of the capturing server
+            yield (op, sid, t, dtype.rstrip(b'\0').decode(), cmd, payload)
+
+class _Reply():
+    __slots__ = ('t', 'payload', 'dtype', 'chunks', 'acquired')
+    def __init__(self, t:float, payload, dtype=''):
+        self.t = t
+        self.payload = payload
+        self.dtype = dtype
+        self.chunks = []# [(time, bytes)] read after a written query
+        self.acquired = False# a waveform transfer followed it
+
+class Replay():
+    """Resource manager, which opens ReplaySessions of the capture. With
+    speed 0 every trigger query reports a new acquisition, otherwise the
+    acquisitions are reported at the captured timing, divided by the speed.
+    The acquisitions attribute counts the acquisitions reported."""
+    def __init__(self, filename:str, speed=0.):
+        self.filename = filename
+        self.speed = speed
+        self.replies = {}# {(DATa:SOUrce, command): [_Reply]}
+        self.cursors = {}# {(DATa:SOUrce, command): index of the next reply}
+        self.triggerKeys = set()# keys of the trigger queries
+        self.times = {}# {trigger key: [captured times of the replies]}
+        self.aliases = {}# {key: captured key}, for the keys not captured
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.load()
+        self.t0 = time.perf_counter()
+
+    def load(self):
+        sources = {}# {session: DATa:SOUrce}
+        pending = {}# {session: _Reply of the written query}
+        lastTrigger = None
+        duration = 0.
+        for op,sid,t,dtype,cmd,payload in read_capture(self.filename):
+            duration = t
+            source = sources[sid] = source_of(cmd, sources.get(sid))
+            if op == b'R':
+                if sid in pending:
+                    pending[sid].chunks.append((t, payload))
+                    if lastTrigger is not None:
+                        lastTrigger.acquired = True
+                continue
+            pending.pop(sid, None)
+            if op == b'W' and not is_query(cmd):
+                continue
+            reply = _Reply(t, payload.decode() if op == b'Q' else payload,
+                dtype)
+            self.replies.setdefault((source, cmd), []).append(reply)
+            if op == b'W':
+                pending[sid] = reply
+            elif op == b'B' and lastTrigger is not None:
+                lastTrigger.acquired = True
+            elif 'NUMAC' in cmd.upper():
+                lastTrigger = reply
+        # only the trigger queries, which were followed by a transfer, are
+        # replayed, they all report new acquisitions
+        for key,replies in self.replies.items():
+            acquired = [r for r in replies if r.acquired]
+            if acquired:
+                self.replies[key] = acquired
+                self.triggerKeys.add(key)
+                self.times[key] = [r.t for r in acquired]
+        self.duration = max(duration, 1.e-3)
+        printi(f'Replaying {duration:.1f} s of {self.filename}, speed: {self.speed or "max"}')
+
+    def open_resource(self, _resourceName:str, **_):
+        return ReplaySession(self)
+
+    def close(self):
+        pass
+
+    def reply(self, source:str, cmd:str):
+        """The next captured reply to the command, None if the command
+        was not captured"""
+        key = (source, cmd)
+        if key not in self.replies:
+            # e.g. a setting query, which does not depend on the source
+            if key not in self.aliases:
+                self.aliases[key] = next(
+                    (k for k in self.replies if k[1] == cmd), None)
+            key = self.aliases[key]
+            if key is None:
+                return None
+        replies = self.replies[key]
+        with self.lock:
+            if key not in self.triggerKeys:
+                i = self.cursors.get(key, 0)
+                self.cursors[key] = i + 1
+                return replies[i % len(replies)]
+            if self.speed == 0.:
+                self.acquisitions += 1
+            else:
+                elapsed = (time.perf_counter() - self.t0)*self.speed
+                cycles, t = divmod(elapsed, self.duration)
+                self.acquisitions = int(cycles)*len(replies)\
+                    + bisect.bisect_right(self.times[key], t)
+            return replies[max(self.acquisitions - 1, 0) % len(replies)]
+
+    def renumbered(self, cmd:str, reply:str):
+        """The reply with the acquisition count of the replay"""
+        fields = reply.split(';')
+        for i,scpi in enumerate(cmd.split(';')):
+            if 'NUMAC' in scpi.upper() and i < len(fields):
+                fields[i] = str(self.acquisitions)
+        return ';'.join(fields)
+
+class ReplaySession():
+    """VISA session, which answers with the captured replies. The writes
+    are accepted and ignored, except the selection of DATa:SOUrce.
+    A query, which was not captured, times out."""
+    def __init__(self, replay:Replay):
+        self.replay = replay
+        self.source = None
+        self.stream = None# chunks of the written query: [index, [(t, bytes)], start]
+        self.rest = b''# of the last chunk, not read yet
+        self.timeout = 2000
+        self.chunk_size = 20*1024
+        self.read_termination = '\n'
+        self.write_termination = '\n'
+
+    def clear(self):
+        self.stream = None
+        self.rest = b''
+
+    def close(self):
+        self.clear()
+
+    def _reply(self, cmd:str):
+        self.source = source_of(cmd, self.source)
+        reply = self.replay.reply(self.source, cmd)
+        if reply is None:
+            printw(f'Not captured: {cmd}')
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        return reply
+
+    def write(self, cmd:str):
+        self.clear()
+        if not is_query(cmd):
+            self.source = source_of(cmd, self.source)
+            return
+        reply = self._reply(cmd)
+        if reply.chunks:
+            self.stream = [0, reply.chunks, time.perf_counter()]
+
+    def query(self, cmd:str):
+        self.clear()
+        return self.replay.renumbered(cmd, self._reply(cmd).payload)
+
+    def query_binary_values(self, cmd:str, datatype='h', **_):
+        self.clear()
+        reply = self._reply(cmd)
+        dtype = reply.dtype or np.dtype(datatype).str
+        return np.frombuffer(reply.payload, dtype).copy()
+
+    def _next_chunk(self):
+        """Next chunk of the written query. The captured stream (e.g.
+        CURVEStream) is repeated, at its timing if the speed is not 0."""
+        if self.stream is None:
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        index, chunks, start = self.stream
+        cycles, i = divmod(index, len(chunks))
+        self.stream[0] += 1
+        speed = self.replay.speed
+        if speed > 0.:
+            span = chunks[-1][0] - chunks[0][0] + 1.e-3
+            t = (chunks[i][0] - chunks[0][0] + cycles*span)/speed
+            delay = start + t - time.perf_counter()
+            if delay > 0.:
+                time.sleep(delay)
+        return chunks[i][1]
+
+    def read_raw(self):
+        data, self.rest = self.rest, b''
+        return data or self._next_chunk()
+
+    def read_bytes(self, count:int):
+        if len(self.rest) >= count:
+            data, self.rest = self.rest[:count], self.rest[count:]
+            return data
+        data = bytearray(self.rest)
+        while len(data) < count:
+            data += self._next_chunk()
+        self.rest = bytes(data[count:])
+        return bytes(data[:count])
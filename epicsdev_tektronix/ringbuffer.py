@@ -0,0 +1,133 @@
+"""Memory-mapped ring buffer of recent acquisitions.
+The ring is a file of fixed-size slots, each holding the raw samples of all
+channels, their scale factors, the time axis parameters and the trigger time
+of one acquisition. The slots are overwritten in place, nothing is
+allocated per trigger. Since the file is memory-mapped, the content
+survives a server restart and can be used for post-mortem analysis.
+The acqCount restarts with every run, so each slot carries the id of the
+run, which wrote it, the lookups see only the slots of the current run.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# slots of previous runs are not recalled
+import os
+import time
+import numpy as np
+
+Magic = 0x514B4154# 'TAKQ'
+HeaderDtype = np.dtype([('magic','<u4'), ('nslots','<u4'), ('nchannels','<u4'),
+    ('maxPoints','<u4'), ('head','<u8'), ('written','<u8'), ('runId','<u8')])
+HeaderSize = 64
+
+def slot_dtype(nchannels:int, maxPoints:int):
+    """Structure of one slot. Slot with negative acqCount is invalid."""
+    return np.dtype([('acqCount','<i8'), ('runId','<u8'), ('trigTime','<f8'),
+        ('xOrigin','<f8'), ('xIncrement','<f8'), ('npoints','<u4'),
+        ('channelMask','<u4'), ('scale','<f8',(nchannels,)),
+        ('offset','<f8',(nchannels,)),
+        ('samples','<i2',(nchannels,maxPoints))])
+
+class RingBuffer():
+    """Ring of nslots acquisitions with up to maxPoints samples per channel.
+    An existing file with the same geometry is reused, otherwise it is
+    created anew. The start time of the ring (ns) is the id of the run."""
+    def __init__(self, filename:str, nslots:int, nchannels:int, maxPoints:int):
+        self.filename = filename
+        dtype = slot_dtype(nchannels, maxPoints)
+        size = HeaderSize + nslots*dtype.itemsize
+        reuse = False
+        if os.path.exists(filename) and os.path.getsize(filename) == size:
+            header = np.memmap(filename, HeaderDtype, 'r', shape=(1,))[0]
+            reuse = (header['magic'] == Magic and header['nslots'] == nslots
+                and header['nchannels'] == nchannels
+                and header['maxPoints'] == maxPoints)
+        if not reuse:
+            with open(filename, 'wb') as f:
+                f.truncate(size)# sparse file, the pages are allocated on write
+        self._header = np.memmap(filename, HeaderDtype, 'r+', shape=(1,))
+        self.slots = np.memmap(filename, dtype, 'r+', offset=HeaderSize,
+            shape=(nslots,))
+        # the clock may be coarse, the id must differ from the previous run
+        self.runId = max(time.time_ns(), int(self._header[0]['runId'])+1)
+        if not reuse:
+            self._header[0] = (Magic, nslots, nchannels, maxPoints, 0, 0,
+                self.runId)
+            self.slots['acqCount'] = -1
+        else:
+            self._header[0]['runId'] = self.runId
+        self.reused = reuse
+        self.nslots = nslots
+        self.nchannels = nchannels
+        self.maxPoints = maxPoints
+
+    def write(self, acqCount:int, trigTime:float, xorigin:float,
+            xincrement:float, acquired:dict):
+        """Store acquisition in the next slot. The acquired is the
+        {channel:(samples,scale,offset)} map. Returns False if the waveforms
+        are longer than maxPoints."""
+        npoints = len(next(iter(acquired.values()))[0]) if acquired else 0
+        if npoints > self.maxPoints:
+            return False
+        head = int(self._header[0]['head'])
+        slot = self.slots[head]
+        slot['acqCount'] = -1# invalid while it is being written
+        mask = 0
+        for ch,(samples,scale,offset) in acquired.items():
+            slot['samples'][ch-1,:npoints] = samples
+            slot['scale'][ch-1] = scale
+            slot['offset'][ch-1] = offset
+            mask |= 1 << (ch-1)
+        slot['trigTime'] = trigTime
+        slot['xOrigin'] = xorigin
+        slot['xIncrement'] = xincrement
+        slot['npoints'] = npoints
+        slot['channelMask'] = mask
+        slot['runId'] = self.runId
+        slot['acqCount'] = acqCount
+        self._header[0]['head'] = (head + 1) % self.nslots
+        self._header[0]['written'] += 1
+        return True
+
+    def indexes(self, allRuns=False):
+        """Slot indexes of valid acquisitions from the oldest to the newest,
+        of the current run, or of all runs, left in the reused file"""
+        head = int(self._header[0]['head'])
+        order = np.roll(np.arange(self.nslots), -head)
+        valid = self.slots['acqCount'][order] >= 0
+        if not allRuns:
+            valid &= self.slots['runId'][order] == self.runId
+        return [int(i) for i in order[valid]]
+
+    def range(self, allRuns=False):
+        """acqCounts of the oldest and the newest acquisitions"""
+        indexes = self.indexes(allRuns)
+        if len(indexes) == 0:
+            return -1, -1
+        return (int(self.slots[indexes[0]]['acqCount']),
+            int(self.slots[indexes[-1]]['acqCount']))
+
+    def find(self, acqCount:int):
+        """Slot index of the latest acquisition with acqCount of the current
+        run, None if it is not in the ring."""
+        for i in reversed(self.indexes()):
+            if self.slots[i]['acqCount'] == acqCount:
+                return i
+        return None
+
+    def read(self, index:int):
+        """Return acqCount, trigTime, xOrigin, xIncrement and the
+        {channel:(samples,scale,offset)} map of the slot. The samples are
+        views into the ring, they are overwritten after nslots triggers."""
+        slot = self.slots[index]
+        npoints = int(slot['npoints'])
+        acquired = {}
+        for ich in range(self.nchannels):
+            if int(slot['channelMask']) & (1 << ich):
+                acquired[ich+1] = (slot['samples'][ich,:npoints],
+                    float(slot['scale'][ich]), float(slot['offset'][ich]))
+        return (int(slot['acqCount']), float(slot['trigTime']),
+            float(slot['xOrigin']), float(slot['xIncrement']), acquired)
+
+    def flush(self):
+        """Write the modified pages to the file"""
+        self._header.flush()
+        self.slots.flush()
@@ -0,0 +1,148 @@
+"""Export of acquisitions to a POSIX shared-memory segment for co-located
+analysis processes.
+The segment starts with a header, protected by a sequence lock: the
+sequence is odd while the acquisition is being written. It is followed by
+int16 samples of all channels, shaped (nchannels, maxPoints).
+
+Usage in a client process, it does not require epicsdev or pyvisa:
+
+    from epicsdev_tektronix.shmexport import ShmReader
+    reader = ShmReader('tektronix0')
+    acq = reader.wait()# zero-copy views into the segment
+    ... process acq['samples'][ich,:acq['npoints']] ...
+    if not reader.is_current(acq['sequence']):
+        ...# the data were overwritten during processing, discard the result
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.0 26-10-19'# initial version
+import time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+Magic = 0x4D484B54# 'TKHM'
+MaxChannels = 8
+HeaderDtype = np.dtype([('magic','<u4'), ('nchannels','<u4'),
+    ('sequence','<u8'), ('acqCount','<i8'), ('trigTime','<f8'),
+    ('xOrigin','<f8'), ('xIncrement','<f8'), ('maxPoints','<u4'),
+    ('npoints','<u4'), ('channelMask','<u4'),
+    ('scale','<f8',(MaxChannels,)), ('offset','<f8',(MaxChannels,))])
+HeaderSize = 256
+
+def _map(shm):
+    """Header and samples views of the segment"""
+    header = np.ndarray((1,), HeaderDtype, shm.buf)[0]
+    nchannels, maxPoints = int(header['nchannels']), int(header['maxPoints'])
+    samples = np.ndarray((nchannels, maxPoints), '<i2', shm.buf,
+        offset=HeaderSize)
+    return header, samples
+
+#``````````````````Writer`````````````````````````````````````````````````````
+class ShmWriter():
+    """Owner of the shared-memory segment, used by the server"""
+    def __init__(self, name:str, nchannels:int, maxPoints:int):
+        size = HeaderSize + nchannels*maxPoints*2
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:# left after a crash
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.name = name
+        header = np.ndarray((1,), HeaderDtype, self.shm.buf)
+        header[0] = np.zeros(1, HeaderDtype)[0]
+        header[0]['nchannels'] = nchannels
+        header[0]['maxPoints'] = maxPoints
+        header[0]['acqCount'] = -1
+        self.header, self.samples = _map(self.shm)
+        self.header['magic'] = Magic
+
+    def write(self, acqCount:int, trigTime:float, xorigin:float,
+            xincrement:float, acquired:dict):
+        """Publish acquisition, the acquired is the
+        {channel:(samples,scale,offset)} map. Returns False if the
+        waveforms are longer than maxPoints."""
+        npoints = len(next(iter(acquired.values()))[0]) if acquired else 0
+        if npoints > self.samples.shape[1]:
+            return False
+        h = self.header
+        h['sequence'] += 1# odd: writing
+        mask = 0
+        for ch,(samples,scale,offset) in acquired.items():
+            self.samples[ch-1,:npoints] = samples
+            h['scale'][ch-1] = scale
+            h['offset'][ch-1] = offset
+            mask |= 1 << (ch-1)
+        h['acqCount'] = acqCount
+        h['trigTime'] = trigTime
+        h['xOrigin'] = xorigin
+        h['xIncrement'] = xincrement
+        h['npoints'] = npoints
+        h['channelMask'] = mask
+        h['sequence'] += 1# even: consistent
+        return True
+
+    def close(self):
+        """Remove the segment"""
+        del self.header, self.samples
+        self.shm.close()
+        self.shm.unlink()
+
+#``````````````````Reader`````````````````````````````````````````````````````
+class ShmReader():
+    """Attach to the segment, exported by the server"""
+    def __init__(self, name:str):
+        self.shm = shared_memory.SharedMemory(name)
+        # The segment is owned by the server, prevent the resource tracker
+        # from removing it when this process exits.
+        try:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        except Exception:
+            pass
+        self.header, self.samples = _map(self.shm)
+        if self.header['magic'] != Magic:
+            raise ValueError(f'Segment {name} is not an epicsdev_tektronix export')
+        self.sequence = 0# of the last read
+
+    def read(self):
+        """Return consistent snapshot of the latest acquisition as a
+        dictionary. Its samples are zero-copy views, shaped
+        (nchannels, maxPoints), only [:, :npoints] are valid. The views are
+        overwritten by the next acquisition, check it with is_current()."""
+        h = self.header
+        while True:
+            seq = int(h['sequence'])
+            if seq & 1:# writer is busy
+                time.sleep(0)
+                continue
+            npoints = int(h['npoints'])
+            mask = int(h['channelMask'])
+            r = {'sequence':seq, 'acqCount':int(h['acqCount']),
+                'trigTime':float(h['trigTime']), 'xOrigin':float(h['xOrigin']),
+                'xIncrement':float(h['xIncrement']), 'npoints':npoints,
+                'channels':[ich+1 for ich in range(self.samples.shape[0])
+                    if mask & (1 << ich)],
+                'scale':h['scale'].copy(), 'offset':h['offset'].copy(),
+                'samples':self.samples}
+            if int(h['sequence']) == seq:
+                self.sequence = seq
+                return r
+
+    def is_current(self, sequence:int):
+        """True if the acquisition with the sequence was not overwritten"""
+        return int(self.header['sequence']) == sequence
+
+    def wait(self, timeout=10., poll=0.0002):
+        """Wait for an acquisition, newer than the last read one and
+        return it, None if timeout expired."""
+        tmax = time.time() + timeout
+        while int(self.header['sequence']) in (self.sequence, self.sequence+1):
+            if time.time() > tmax:
+                return None
+            time.sleep(poll)
+        return self.read()
+
+    def close(self):
+        """Detach from the segment"""
+        del self.header, self.samples
+        self.shm.close()
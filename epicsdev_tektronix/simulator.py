@@ -0,0 +1,217 @@
+"""Simulated Tektronix MSO for tests and benchmarks without an instrument.
+It serves the subset of SCPI, used by the server, on a raw TCP socket, as
+the socket server of the scope does:
+
+    python -m epicsdev_tektronix.simulator -c4 --rate 20 &
+    python -m epicsdev_tektronix.mso -c4 -r TCPIP::127.0.0.1::5025::SOCKET
+
+The settings are stored as written, under the short form of the header
+(HORizontal:RECOrdlength is HOR:RECO), and returned by the queries. The
+instrument triggers at a constant rate, the waveforms are sine waves with
+optional noise, the digital sources CH<n>_DALL return a counter. The
+CURVEStream? and the ACQuire:STOPAfter SEQuence modes are supported.
+The module depends only on numpy.
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# listen() and serve() split for the tests
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+
+Settings = {'HOR:RECO':'10000', 'HOR:SAMPLER':'1.25E9', 'HOR:SCA':'1E-6',
+    'HOR:MODE':'MANUAL', 'HOR:DEL:TIM':'0', 'TRIG:STATE':'READY',
+    'TRIG:A:MOD':'AUTO', 'TRIG:A:TYPE':'EDGE', 'TRIG:A:EDGE:COUP':'DC',
+    'TRIG:A:EDGE:SOU':'CH1', 'TRIG:A:EDGE:SLO':'RISE', 'ACTONEV:EN':'0',
+    'ACTONEV:LIMITC':'80', 'DATE':'"2026-10-19"', 'TIM':'"12:00:00"',
+    '*IDN':'TEKTRONIX,MSO58,SIMULATOR,FV:2.0', 'WFMO:XIN':'8E-10',
+    'WFMO:XZE':'-5E-6', 'WFMO:YMU':'1.5625E-4', 'WFMO:YOF':'0',
+    'WFMO:YZE':'0', 'DAT:SOU':'CH1', '*ESR':'0', '*OPC':'1', '*STB':'0',
+    '*ESE':'0', 'ACQ:STOPA':'RUNSTOP', 'ACQ:STATE':'1'}
+ChannelSettings = {'DIS:WAVEV1:CH<n>:STATE':'1', 'CH<n>:COUP':'DC',
+    'CH<n>:SCA':'0.1', 'CH<n>:OFFS':'0', 'CH<n>:TER':'50.0000',
+    'CH<n>:STATE':'1', 'TRIG:A:LEV:CH<n>':'0.0'}
+# short forms, which differ from the capital letters of the long ones
+Aliases = {'CURVE':'CURV', 'HORIZ':'HOR', 'WFMOUTPRE':'WFMO',
+    'DATA:SOURCE':'DAT:SOU', 'DATA':'DAT'}
+
+def short_form(header:str):
+    """Short form of the SCPI header, e.g. HOR:RECO of :HORizontal:RECOrdlength"""
+    keywords = []
+    for keyword in header.strip().lstrip(':').split(':'):
+        short = ''.join([c for c in keyword if not c.islower()])
+        keywords.append(short if short else keyword.upper()[:4])
+    short = ':'.join(keywords)
+    return Aliases.get(short, short)
+
+def binary_block(data:bytes):
+    """IEEE 488.2 definite length block: #<x><yyy><data>, terminated"""
+    length = str(len(data))
+    return f'#{len(length)}{length}'.encode() + data + b'\n'
+
+class Simulator():
+    """Instrument with nchannels, which triggers rate times per second and
+    streams up to streamRate acquisitions per second. The connections share
+    the settings."""
+    def __init__(self, nchannels=4, rate=20., streamRate=200., noise=True):
+        self.nchannels = nchannels
+        self.rate = rate
+        self.streamRate = streamRate
+        self.noise = noise
+        self.settings = dict(Settings)
+        for ch in range(1, nchannels+1):
+            for header,value in ChannelSettings.items():
+                self.settings[header.replace('<n>', str(ch))] = value
+        self.t0 = time.time()
+        self.armedAt = 0.# time of the last ACQuire:STATE ON of a sequence
+        self.sequences = 0# completed sequences
+
+    def curve(self, source:str):
+        """Binary block of the waveform of the source"""
+        n = int(float(self.settings['HOR:RECO']))
+        t = np.arange(n)
+        if source.endswith('_DALL'):
+            samples = ((t//50) & 0xff).astype(np.uint8)
+            if self.settings.get('WFMO:BYT_N', '2') != '1':
+                samples = samples.astype('<i2')
+            return binary_block(samples.tobytes())
+        wave = 3000*np.sin(t*2*np.pi/max(n//5,1) + int(source[-1]))
+        if self.noise:
+            wave += np.random.randint(-50, 50, n)
+        return binary_block(wave.astype('<i2').tobytes())
+
+    def sequence_complete(self):
+        """True if the armed sequence acquired"""
+        return self.settings['ACQ:STOPA'].startswith('SEQ')\
+            and self.armedAt > 0. and time.time() - self.armedAt > 1./self.rate
+
+    def query(self, header:str):
+        """Reply to the query of the short header"""
+        s = self.settings
+        if header == 'ACQ:NUMAC':
+            if s['ACQ:STOPA'].startswith('SEQ'):
+                return str(self.sequences + self.sequence_complete())
+            return str(int((time.time() - self.t0)*self.rate))
+        if header == 'ACQ:STATE' and s['ACQ:STOPA'].startswith('SEQ'):
+            return '0' if self.sequence_complete() else '1'
+        if header == 'DAT:SOU:AVAIL':
+            return ','.join([f'CH{ch}' for ch in range(1, self.nchannels+1)
+                if s.get(f'DIS:WAVEV1:CH{ch}:STATE') == '1']) or 'NONE'
+        if header == 'WFMO:NR_P':
+            return str(int(float(s['HOR:RECO'])))
+        if header in ('SET', '*LRN'):
+            return ';'.join([f':{h} {v}' for h,v in s.items()
+                if not h.startswith('*')])
+        return s.get(header, '0')
+
+    def write(self, command:str):
+        """Execute the command, which is not a query"""
+        parts = command.split(None, 1)
+        header = short_form(parts[0])
+        if len(parts) == 1:
+            return
+        value = parts[1].strip()
+        if header == 'ACQ:STATE' and self.settings['ACQ:STOPA'].startswith('SEQ')\
+          and value.upper() in ('1', 'ON', 'RUN'):
+            self.sequences += self.sequence_complete()
+            self.armedAt = time.time()
+        if header == 'HOR:RECO':
+            value = str(int(float(value)))
+        self.settings[header] = value if value[0] in '\'"' else value.upper()
+
+    def stream(self, connection, stop:threading.Event):
+        """Push the waveforms of all sources until stopped"""
+        sources = self.settings['DAT:SOU'].split(',')
+        while not stop.is_set():
+            try:
+                for source in sources:
+                    connection.sendall(self.curve(source))
+            except OSError:
+                return
+            time.sleep(1./self.streamRate)
+
+    def handle(self, connection):
+        """Serve a connection, a line is a compound command"""
+        f = connection.makefile('rb')
+        streaming = None# (stop event, thread) of CURVEStream?
+        while True:
+            line = f.readline()
+            if streaming is not None:# any command stops the streaming
+                streaming[0].set()
+                streaming[1].join()
+                streaming = None
+            if not line:
+                return
+            line = line.decode('latin1').strip()
+            if short_form(line.rstrip('?')) == 'CURVES':
+                stop = threading.Event()
+                thread = threading.Thread(target=self.stream,
+                    args=(connection, stop), daemon=True)
+                thread.start()
+                streaming = (stop, thread)
+                continue
+            replies = []
+            block = None
+            for command in line.split(';'):
+                command = command.strip()
+                if not command:
+                    continue
+                if not command.endswith('?'):
+                    self.write(command)
+                    continue
+                header = short_form(command[:-1])
+                if header in ('CURV', 'CURVE'):
+                    block = self.curve(self.settings['DAT:SOU'])
+                else:
+                    replies.append(self.query(header))
+            if block is not None:
+                connection.sendall(block)
+            elif replies:
+                connection.sendall((';'.join(replies) + '\n').encode())
+
+    def listen(self, port:int):
+        """Listening socket on localhost, port 0 picks a free port"""
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(5)
+        return server
+
+    def serve(self, server:socket.socket):
+        """Accept the connections until the server socket is closed"""
+        while True:
+            try:
+                connection,_ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(connection,),
+                daemon=True).start()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f'{__version__}')
+    parser.add_argument('-c', '--channels', type=int, default=4, help=
+    'Number of channels')
+    parser.add_argument('--noiseless', action='store_true', help=
+    'Waveforms without noise')
+    parser.add_argument('-p', '--port', type=int, default=5025, help=
+    'TCP port on localhost, 0: any free port')
+    parser.add_argument('--rate', type=float, default=20., help=
+    'Trigger rate (Hz)')
+    parser.add_argument('--streamRate', type=float, default=200., help=
+    'Max rate (Hz) of the CURVEStream acquisitions')
+    pargs = parser.parse_args()
+    simulator = Simulator(pargs.channels, pargs.rate, pargs.streamRate,
+        not pargs.noiseless)
+    server = simulator.listen(pargs.port)
+    port = server.getsockname()[1]
+    print(f'Simulated {pargs.channels}-channel scope on TCPIP::127.0.0.1::{port}::SOCKET, pid {os.getpid()}')
+    sys.stdout.flush()
+    simulator.serve(server)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Tracing of the acquisition steps for latency debugging.
+The spans are recorded into a bounded in-memory buffer, tagged with the
+acqCount, and dumped on demand in the Chrome trace event format, which is
+viewable in chrome://tracing or https://ui.perfetto.dev.
+
+    with tracer.span('CURVe?', ch=1) as span:
+        ...
+        span.args['bytes'] = n
+    with tracer.locked(lock, 'data session'):# records the wait for the lock
+        ...
+
+When tracing is off, the NullTracer is used: its span() returns a shared
+do-nothing context and locked() returns the lock itself. The callers on
+the hot paths do not even build the arguments of the span:
+
+    with tracer.span('CURVe?', ch=1) if tracer.enabled else NullSpan:
+"""
+# pylint: disable=invalid-name
+__version__ = 'v1.0.1 26-10-19'# NullSpan is public
+import os
+import json
+import threading
+import collections
+import contextlib
+from time import perf_counter_ns
+
+class _Span():
+    __slots__ = ('tracer', 'name', 'args', 'start')
+    def __init__(self, tracer, name:str, args:dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        self.tracer.record(self.name, self.start, perf_counter_ns(), self.args)
+
+class _NullSpan():
+    __slots__ = ('args',)
+    def __init__(self):
+        self.args = {}# written by the callers, never read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.args.clear()
+
+NullSpan = _NullSpan()# context of the spans, which are not recorded
+
+class NullTracer():
+    """Tracer, which records nothing"""
+    enabled = False
+    acqCount = 0
+
+    def span(self, _name:str, **_args):
+        return NullSpan
+
+    def locked(self, lock, _name=''):
+        return lock
+
+    def __len__(self):
+        return 0
+
+class Tracer():
+    """Records up to capacity spans, the oldest are dropped. The acqCount
+    attribute is attached to the spans, it should be set at the start of
+    each acquisition."""
+    enabled = True
+    def __init__(self, capacity:int):
+        self.events = collections.deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.threads = {}# {thread id: thread name}
+        self.acqCount = 0
+        self.pid = os.getpid()
+        self.t0 = perf_counter_ns()
+
+    def __len__(self):
+        return len(self.events)
+
+    def span(self, name:str, **args):
+        """Context, which records its duration as the span name, the args
+        are shown in the trace viewer"""
+        return _Span(self, name, args)
+
+    @contextlib.contextmanager
+    def locked(self, lock, name='lock'):
+        """Acquire the lock, recording the wait as a span"""
+        start = perf_counter_ns()
+        with lock:
+            self.record(f'wait {name}', start, perf_counter_ns(), {})
+            yield
+
+    def record(self, name:str, start:int, end:int, args:dict):
+        """Add a span, the times are from perf_counter_ns()"""
+        tid = threading.get_ident()
+        with self.lock:
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+            self.events.append((name, start, end, tid, self.acqCount, args))
+
+    def dump(self, filename:str):
+        """Write the recorded spans to the file in the Chrome trace event
+        format. Returns the number of spans."""
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        trace = [{'name':'thread_name', 'ph':'M', 'pid':self.pid, 'tid':tid,
+            'args':{'name':name}} for tid,name in threads.items()]
+        for name,start,end,tid,acqCount,args in events:
+            trace.append({'name':name, 'cat':'acquisition', 'ph':'X',
+                'ts':(start - self.t0)/1000., 'dur':(end - start)/1000.,
+                'pid':self.pid, 'tid':tid, 'args':{'acqCount':acqCount, **args}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents':trace, 'displayTimeUnit':'ms'}, f)
+        return len(events)
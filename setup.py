@@ -1,15 +1,20 @@
 """Setup script for epicsdev_tektronix package."""
+import re
 from setuptools import setup, find_packages
 
 with open("README.md", "r", encoding="utf-8") as fh:
     long_description = fh.read()
 
+# the package version is the version of the server, e.g. 'v1.1.36 26-10-19'
+with open("epicsdev_tektronix/mso.py", "r", encoding="utf-8") as fh:
+    version = re.search(r"__version__ = 'v([\d.]+)", fh.read()).group(1)
+
 #with open("requirements.txt", "r", encoding="utf-8") as fh:
 #    requirements = [line.strip() for line in fh if line.strip() and not line.startswith("#")]
 
 setup(
     name="epicsdev_tektronix",
-    version="1.0.3",
+    version=version,
     author="Andrey Sukhanov",
     author_email="",
     description="EPICS PVAccess server for Tektronix MSO oscilloscopes",
@@ -23,15 +28,19 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
-        "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Topic :: Scientific/Engineering :: Physics",
         "Topic :: System :: Hardware :: Hardware Drivers",
     ],
-    python_requires=">=3.7",
+    python_requires=">=3.9",# multiprocessing.shared_memory: 3.8, ast.unparse: 3.9
     #install_requires=requirements,
+    extras_require={
+        "hdf5": ["h5py"],# recording in HDF5 format
+        "lz4": ["lz4"],# faster codec of the compressed waveforms
+    },
     keywords="epics oscilloscope tektronix mso pvaccess scpi visa",
     project_urls={
         "Bug Reports": "https://github.com/ASukhanov/epicsdev_tektronix/issues",
@@ -0,0 +1,47 @@
+"""Tests of the waveform compression"""
+import numpy as np
+import pytest
+from epicsdev_tektronix.compression import compress_waveform,\
+    decompress_waveform, choose_codec, Header
+from epicsdev_tektronix.processing import Buffers, scale_waveform
+
+def noisy(n=10000, seed=2):
+    rng = np.random.default_rng(seed)
+    t = np.arange(n)
+    return (20000*np.sin(t/300.) + rng.normal(0, 50, n)).astype(np.int16)
+
+@pytest.mark.parametrize('raw', [noisy(), np.zeros(1000, np.int16),
+    np.array([-32768, 32767, -32768, 0, 32767], np.int16),# wrapping deltas
+    np.array([7], np.int16), np.zeros(0, np.int16)])
+def test_round_trip(raw):
+    blob = compress_waveform(raw, 0.001, -0.25)
+    assert np.array_equal(decompress_waveform(blob, raw=True), raw)
+    waveform = decompress_waveform(np.frombuffer(blob, np.uint8))
+    assert waveform.dtype == np.float32
+    assert np.array_equal(waveform, scale_waveform(raw, 0.001, -0.25))
+
+def test_big_endian_input():
+    raw = noisy()
+    blob = compress_waveform(raw.astype('>i2'), 0.001, 0.)
+    assert blob == compress_waveform(raw, 0.001, 0.)
+    assert np.array_equal(decompress_waveform(blob, raw=True), raw)
+
+def test_compresses_noisy_waveform():
+    raw = noisy()
+    assert len(compress_waveform(raw, 1., 0.)) - Header.size < 0.75*raw.nbytes
+
+def test_buffers_reused():
+    buffers = Buffers()
+    raw = noisy()
+    first = compress_waveform(raw, 1., 0., buffers=buffers)
+    allocations = buffers.allocations
+    assert compress_waveform(raw, 1., 0., buffers=buffers) == first
+    assert buffers.allocations == allocations
+
+def test_codecs():
+    assert choose_codec('zlib') == 'zlib'
+    assert choose_codec('auto') in ('zlib', 'lz4')
+    with pytest.raises(ValueError):
+        choose_codec('gzip')
+    with pytest.raises(ValueError):
+        decompress_waveform(b'\0'*Header.size)
@@ -0,0 +1,54 @@
+"""Tests of the math channels"""
+import numpy as np
+import pytest
+from epicsdev_tektronix import mathchannel
+from epicsdev_tektronix.mathchannel import MathChannel
+
+def acquired():
+    rng = np.random.default_rng(3)
+    return {ch: (rng.integers(-1000, 1000, 500, dtype=np.int16), 0.01*ch,
+        0.1*ch) for ch in (1, 2, 3, 4)}
+
+def volts(acq, ch):
+    raw, scale, offset = acq[ch]
+    return raw.astype(np.float64)*scale + offset
+
+@pytest.mark.parametrize('text, expected', [
+    ('CH1-CH2', lambda v: v(1) - v(2)),
+    ('CH1*CH2 + 2*CH3', lambda v: v(1)*v(2) + 2*v(3)),
+    ('-abs(CH4)/2', lambda v: -abs(v(4))/2),
+    ('sqrt(CH1**2 + CH2**2)', lambda v: np.sqrt(v(1)**2 + v(2)**2)),
+    ('CH1 + (1+2)*3', lambda v: v(1) + 9),
+    ('integral(CH1)', lambda v: np.cumsum(v(1))*1.e-3),
+    ])
+def test_accepted(text, expected):
+    acq = acquired()
+    math = MathChannel(text, 4)
+    result = math.evaluate(acq, 1.e-3)
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected(lambda ch: volts(acq, ch)),
+        rtol=1e-5, atol=1e-5)
+
+@pytest.mark.parametrize('text', ['', 'CH1 +', 'CH5', 'CH0', 'X1', '1+2',
+    'integral(2)', 'CH1 % 2', 'CH1 if CH2 else CH3', '__import__("os")',
+    'CH1.real', 'CH1[0]', 'sqrt(CH1, CH2)', 'abs(x=CH1)', '"CH1"', 'CH1 < 2',
+    'lambda: CH1', 'exp(CH1)', '9'*400 + '*CH1', '+'.join(['CH1']*300),
+    '-'*20000 + 'CH1', 'abs('*300 + 'CH1' + ')'*300])
+def test_rejected(text):
+    with pytest.raises(ValueError):
+        MathChannel(text, 4)
+
+def test_too_deep(monkeypatch):
+    monkeypatch.setattr(mathchannel, 'MaxLength', 1000000)
+    for text in ['-'*20000 + 'CH1', '+'.join(['CH1']*5000)]:
+        with pytest.raises(ValueError):
+            MathChannel(text, 4)
+
+def test_no_allocations_in_steady_state():
+    acq = acquired()
+    math = MathChannel('CH1*CH1 - CH2 + integral(CH3)', 4)
+    first = math.evaluate(acq, 1.e-9).copy()
+    allocations = math.buffers.allocations
+    assert np.array_equal(math.evaluate(acq, 1.e-9), first)
+    assert math.buffers.allocations == allocations
+    assert math.channels == [1, 2, 3]
@@ -0,0 +1,239 @@
+"""Tests of the helpers of the server, which do not need an instrument.
+The PV access of the server is replaced by a dictionary of values."""
+import argparse
+import pytest
+from epicsdev_tektronix import mso
+from epicsdev_tektronix.mso import C_, OK, NotOK
+
+class Clock():
+    """Replacement of the perf_counter of the server"""
+    def __init__(self):
+        self.t = 100.
+    def __call__(self):
+        return self.t
+
+@pytest.fixture
+def server(monkeypatch):
+    """PV values, published by the server functions"""
+    values = {}
+    monkeypatch.setattr(mso, 'publish', lambda pvname, value, *_, **__:
+        values.__setitem__(pvname, value))
+    monkeypatch.setattr(mso, 'pvv', values.get)
+    monkeypatch.setattr(mso, 'timer', Clock())
+    for name,value in [('maxRates', {}), ('lastPublished', {}),
+            ('throttledUpdates', 0), ('waveformSignature', {}),
+            ('unchangedUpdates', 0)]:
+        monkeypatch.setattr(C_, name, value)
+    return values
+
+class Scope():
+    """Instrument, which executes the compound commands on its settings,
+    given by the headers, as the server sends them"""
+    def __init__(self, settings:dict):
+        self.settings = settings
+        self.commands = []
+    def write(self, cmd):
+        self.query(cmd)
+    def query(self, cmd):
+        self.commands.append(cmd)
+        replies = []
+        for command in cmd.split(';'):
+            header, _, value = command.lstrip(':').partition(' ')
+            if header.endswith('?'):
+                replies.append(self.settings[header[:-1]])
+            else:
+                # the instrument returns the numbers in its own format
+                try:
+                    value = f'{float(value):.4E}'
+                except ValueError:
+                    pass
+                self.settings[header] = value
+        return ';'.join(replies)
+
+class PV():
+    def __init__(self, writable):
+        self.writable = writable
+
+@pytest.fixture
+def scope(monkeypatch, server):
+    """Instrument with the settings of the SCPI PVs, the recLengthR is
+    read-only"""
+    scpi = {'timePerDiv':'HORizontal:SCAle', 'recLengthR':'HORizontal:RECOrdlength',
+        'c01Coupling':'CH1:COUPling', 'trigSource':'TRIGger:A:EDGE:SOUrce'}
+    instrument = Scope({'HORizontal:SCAle':'1.0000E-06',
+        'HORizontal:RECOrdlength':'10000', 'CH1:COUPling':'DC',
+        'TRIGger:A:EDGE:SOUrce':'CH1', 'TRIGger:A:LEVel:CH1':'0.0000E+00',
+        'TRIGger:A:LEVel:CH2':'0.0000E+00', '*ESR':'0'})
+    monkeypatch.setattr(C_, 'scpi', scpi)
+    monkeypatch.setattr(C_, 'setterMap', {pvname:mso.set_scpi
+        for pvname in scpi if pvname != 'recLengthR'})
+    monkeypatch.setattr(C_, 'scope', instrument)
+    monkeypatch.setattr(mso, 'pvobj', lambda pvname:
+        PV(pvname != 'recLengthR'))
+    server.update({'timePerDiv':1.e-6, 'recLengthR':10000,
+        'c01Coupling':'DC', 'trigSource':'CH1', 'trigLevel':0.})
+    return instrument
+
+@pytest.fixture
+def pargs(monkeypatch):
+    """Command line options of the server"""
+    options = argparse.Namespace(channels=4, syncFast=1., syncSlow=30.)
+    monkeypatch.setattr(mso, 'pargs', options, raising=False)
+    return options
+
+def test_set_maxRates(server):
+    assert mso.set_maxRates('Waveform:2, Mean:10,') == OK
+    assert C_.maxRates == {'Waveform':2., 'Mean':10.}
+    assert server['maxRates'] == 'Waveform:2, Mean:10,'
+    assert mso.set_maxRates('Waveform') == NotOK
+    assert C_.maxRates == {'Waveform':2., 'Mean':10.}
+
+def test_publish_plan_rates(server):
+    mso.set_maxRates('Waveform:2,Mean:10')
+    All = ['Waveform', 'WaveformDisplay', 'Peak2Peak', 'Mean']
+    assert mso.publish_plan(1, None, 1.) == All
+    mso.timer.t += 0.05
+    assert mso.publish_plan(1, None, 1.) == ['WaveformDisplay', 'Peak2Peak']
+    assert C_.throttledUpdates == 2
+    # the rates are per channel
+    assert mso.publish_plan(2, None, 1.) == All
+    mso.timer.t += 0.1
+    assert mso.publish_plan(1, None, 1.) == ['WaveformDisplay', 'Peak2Peak',
+        'Mean']
+    mso.timer.t += 0.5
+    assert mso.publish_plan(1, None, 1.) == All
+
+def test_publish_plan_unchanged(server):
+    mso.set_maxRates('Waveform:2')
+    All = ['Waveform', 'WaveformDisplay', 'Peak2Peak', 'Mean']
+    assert mso.publish_plan(1, 123, 1.) == All
+    mso.timer.t += 1.
+    assert mso.publish_plan(1, 123, 1.) == ['Peak2Peak', 'Mean']
+    assert C_.unchangedUpdates == 2
+    # the suppressed waveform did not use its rate slot
+    assert mso.publish_plan(1, 456, 1.) == All
+    # a throttled change is not taken for published
+    assert mso.publish_plan(1, 789, 1.) == ['WaveformDisplay', 'Peak2Peak',
+        'Mean']
+    mso.timer.t += 1.
+    assert mso.publish_plan(1, 789, 1.) == ['Waveform', 'Peak2Peak', 'Mean']
+    # the scale is a part of the signature
+    mso.timer.t += 1.
+    assert mso.publish_plan(1, 789, 2.) == All
+
+def test_analog_channels(pargs):
+    assert mso.analog_channels(['CH1', ' CH3', 'CH4']) == [1, 3, 4]
+    # digital sources of the FlexChannels are not analog channels
+    assert mso.analog_channels(['CH2_DALL', 'CH2', 'CH3_D0', 'MATH1']) == [2]
+    # the channels beyond --channels are not served
+    pargs.channels = 2
+    assert mso.analog_channels(['CH1', 'CH2', 'CH3', 'CH4']) == [1, 2]
+    assert mso.analog_channels(['NONE']) == []
+
+def snapshot(**settings):
+    values = {'timePerDiv':'1E-6', 'recLengthR':'10000', 'c01Coupling':'DC',
+        'trigSource':'CH1', 'trigLevel':'0'}
+    values.update(settings)
+    return {'settings':values}
+
+def test_restore_unchanged(scope):
+    # the values differ from the PVs only in format
+    assert mso.restore_snapshot(snapshot(timePerDiv='1.0E-06',
+        c01Coupling='dc', trigLevel='0.0')) == 0
+    assert scope.commands == []
+
+def test_restore_changed(scope, server):
+    # the read-only PVs are not restored
+    assert mso.restore_snapshot(snapshot(timePerDiv='2E-6', c01Coupling='AC',
+        recLengthR='20000')) == 2
+    # the settings are written and verified in one round trip
+    assert scope.commands == [':HORizontal:SCAle 2E-6;:CH1:COUPling AC'
+        ';:HORizontal:SCAle?;:CH1:COUPling?']
+    assert scope.settings['HORizontal:RECOrdlength'] == '10000'
+    # the PVs get the replies of the instrument
+    assert server['timePerDiv'] == '2.0000E-06'
+    assert server['c01Coupling'] == 'AC'
+    assert server['recLengthR'] == 10000
+
+def test_restore_trigLevel(scope, server):
+    # the level is set for the trigger source of the snapshot
+    assert mso.restore_snapshot(snapshot(trigSource='CH2', trigLevel='0.5'))\
+        == 2
+    assert scope.commands == [':TRIGger:A:EDGE:SOUrce CH2'
+        ';:TRIGger:A:LEVel:CH2 0.5;:TRIGger:A:EDGE:SOUrce?'
+        ';:TRIGger:A:LEVel:CH2?']
+    assert (server['trigSource'], server['trigLevel']) == ('CH2', '5.0000E-01')
+    # the level alone
+    scope.commands.clear()
+    assert mso.restore_snapshot(snapshot(trigSource='CH2', trigLevel='0.25'))\
+        == 1
+    assert scope.commands == [':TRIGger:A:LEVel:CH2 0.25'
+        ';:TRIGger:A:LEVel:CH2?']
+
+def test_restore_rejected(scope, server, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(mso, 'printw', warnings.append)
+    # the instrument does not accept the setting
+    accepted = scope.query
+    monkeypatch.setattr(scope, 'query', lambda cmd:
+        accepted(cmd.replace('COUPling GND', 'COUPling DC')))
+    assert mso.restore_snapshot(snapshot(c01Coupling='GND')) == 1
+    assert server['c01Coupling'] == 'DC'
+    assert len(warnings) == 1 and 'c01Coupling' in warnings[0]
+
+def test_sync_tier(scope, server):
+    published = dict(server)
+    assert mso.sync_tier(['timePerDiv', 'recLengthR'], ['*ESR'],
+        {'trigLevel':'TRIGger:A:LEVel:CH1'}) == (['0'], 0)
+    assert scope.commands == [':HORizontal:SCAle?;:HORizontal:RECOrdlength?'
+        ';:TRIGger:A:LEVel:CH1?;*ESR?']
+    # the replies, which differ only in format, are not published
+    assert server == published
+    # changed on the front panel, the read-only PVs are published, but
+    # they are not counted as changed settings
+    scope.settings['HORizontal:SCAle'] = '2.0000E-06'
+    scope.settings['HORizontal:RECOrdlength'] = '20000'
+    assert mso.sync_tier(['timePerDiv', 'recLengthR']) == ([], 1)
+    assert (server['timePerDiv'], server['recLengthR']) == ('2.0000E-06',
+        '20000')
+
+def test_sync_tier_wrong_reply(scope, server, monkeypatch):
+    monkeypatch.setattr(mso, 'printw', lambda _: None)
+    monkeypatch.setattr(scope, 'query', lambda _: '1E-6')
+    assert mso.sync_tier(['timePerDiv', 'recLengthR']) == (None, 0)
+    assert server['timePerDiv'] == 1.e-6
+
+@pytest.fixture
+def tiers(monkeypatch, scope, pargs):
+    """Settings sync, which is due for the fast tier only"""
+    monkeypatch.setattr(C_, 'syncTiers', (['timePerDiv', 'recLengthR'],
+        ['c01Coupling', 'trigSource']))
+    monkeypatch.setattr(C_, 'nextFastSync', 0.)
+    monkeypatch.setattr(C_, 'nextSlowSync', mso.time.time() + 100.)
+    monkeypatch.setattr(C_, 'volatileChanged', False)
+    monkeypatch.setattr(C_, 'syncChanges', 0)
+    monkeypatch.setattr(C_, 'streamer', None)
+    return scope
+
+def test_sync_fast_only(tiers, server):
+    mso.sync_settings()
+    assert tiers.commands == [':HORizontal:SCAle?;:HORizontal:RECOrdlength?'
+        ';:TRIGger:A:LEVel:CH1?;*ESR?']
+    assert C_.syncChanges == 0
+    # not due yet
+    mso.sync_settings()
+    assert len(tiers.commands) == 1
+
+@pytest.mark.parametrize('flag', ['frontPanel', 'volatile'])
+def test_sync_flagged(tiers, server, flag):
+    tiers.settings['CH1:COUPling'] = 'AC'
+    if flag == 'frontPanel':
+        tiers.settings['*ESR'] = str(mso.UserRequest)
+    else:# published by triggered()
+        C_.volatileChanged = True
+    mso.sync_settings()
+    # the slow tier is read immediately
+    assert tiers.commands[1] == ':CH1:COUPling?;:TRIGger:A:EDGE:SOUrce?'
+    assert server['c01Coupling'] == 'AC'
+    assert C_.syncChanges == server['syncChanges'] == 1
+    assert not C_.volatileChanged
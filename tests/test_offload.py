@@ -0,0 +1,52 @@
+"""Tests of the offload of the per-channel processing to worker processes"""
+import threading
+import numpy as np
+from epicsdev_tektronix.offload import Offloader
+from epicsdev_tektronix.processing import channel_products
+
+Plan = ['Waveform', 'WaveformDisplay', 'Peak2Peak', 'Mean']
+
+def raw_waveform(n, seed):
+    return np.random.default_rng(seed).integers(-30000, 30000, n,
+        dtype=np.int16)
+
+def test_offloaded_products():
+    delivered = []
+    done = threading.Event()
+    def callback(ch, products, trigTime):
+        # the Waveform is a view into a slot, valid only during the callback
+        delivered.append((ch, trigTime, {suffix:np.copy(value)
+            for suffix,value in products.items()}))
+        if len(delivered) == 6:
+            done.set()
+    offloader = Offloader(2, callback)
+    raws = {}
+    try:
+        for acq in range(3):
+            for ch in (1, 2):
+                # the last acquisition is longer, its slots are replaced
+                raws[acq, ch] = raw_waveform(1000 + 500*(acq == 2), acq*10+ch)
+                offloader.submit(ch, raws[acq, ch], 0.001*ch, 0.5, 10, Plan,
+                    float(acq))
+        assert done.wait(60)
+    finally:
+        offloader.close()
+    # delivered in the order of submission
+    assert [(ch, trigTime) for ch,trigTime,_ in delivered]\
+        == [(ch, float(acq)) for acq in range(3) for ch in (1, 2)]
+    for ch,trigTime,products in delivered:
+        reference = channel_products(raws[int(trigTime), ch], 0.001*ch, 0.5,
+            10, Plan)
+        assert list(products) == Plan
+        for suffix,value in products.items():
+            assert np.allclose(value, reference[suffix], atol=1e-5), suffix
+
+def test_partial_plan():
+    delivered = []
+    offloader = Offloader(1, lambda ch, products, _: delivered.append(
+        sorted(products)))
+    try:
+        offloader.submit(1, raw_waveform(100, 0), 1., 0., 1, ['Mean'], 0.)
+    finally:
+        offloader.close()# delivers the pending results
+    assert delivered == [['Mean']]
@@ -0,0 +1,97 @@
+"""Tests of the per-channel processing"""
+import numpy as np
+from epicsdev_tektronix.processing import Buffers, minmax_envelope,\
+    envelope_length, scale_waveform, channel_products, StreamingProducts,\
+    digital_products, pulse_products
+
+Plan = ['Waveform', 'WaveformDisplay', 'Peak2Peak', 'Mean']
+
+def raw_waveform(n=1003, seed=1):
+    return np.random.default_rng(seed).integers(-30000, 30000, n,
+        dtype=np.int16)
+
+def test_envelope():
+    raw = raw_waveform()
+    envelope = minmax_envelope(raw, 10)
+    assert len(envelope) == 200
+    bins = raw[:1000].reshape(100, 10)
+    assert np.array_equal(envelope[0:-2:2], bins.min(axis=1)[:-1])
+    assert np.array_equal(envelope[1:-2:2], bins.max(axis=1)[:-1])
+    # the tail is merged into the last bin
+    assert envelope[-2] == raw[990:].min() and envelope[-1] == raw[990:].max()
+    assert minmax_envelope(raw, 1) is raw
+
+def test_envelope_length():
+    raw = raw_waveform()
+    assert envelope_length(len(raw), 10) == len(minmax_envelope(raw, 10))
+    assert envelope_length(5, 10) == 5
+
+def test_channel_products():
+    raw = raw_waveform()
+    products = channel_products(raw, 0.001, 0.5, 10, Plan)
+    assert list(products) == Plan
+    assert products['Waveform'].dtype == np.float32
+    assert np.allclose(products['Waveform'], raw*0.001 + 0.5, atol=1e-5)
+    assert np.allclose(products['WaveformDisplay'],
+        minmax_envelope(raw, 10)*0.001 + 0.5, atol=1e-5)
+    assert products['Peak2Peak'] == (int(raw.max()) - int(raw.min()))*0.001
+    assert np.isclose(products['Mean'], raw.mean()*0.001 + 0.5)
+
+def test_scale_waveform_out():
+    raw = raw_waveform(100)
+    out = np.empty(100, np.float32)
+    assert scale_waveform(raw, 2., 1., out) is out
+    assert np.array_equal(out, raw.astype(np.float32)*2 + 1)
+
+def test_buffers_reused():
+    buffers = Buffers()
+    raw = raw_waveform()
+    first = channel_products(raw, 0.001, 0., 10, Plan, buffers=buffers)
+    allocations = buffers.allocations
+    second = channel_products(raw, 0.001, 0., 10, Plan, buffers=buffers)
+    assert buffers.allocations == allocations
+    assert second['Waveform'] is first['Waveform']
+    channel_products(raw[:500], 0.001, 0., 10, Plan, buffers=buffers)
+    assert buffers.allocations > allocations
+
+def test_streaming_products():
+    raw = raw_waveform(10007)
+    reference = channel_products(raw, -0.002, 0.1, 10, Plan)
+    streaming = StreamingProducts(len(raw), -0.002, 0.1, 10, Plan,
+        keepRaw=True)
+    for first in range(0, len(raw), 1000):
+        streaming.add(raw[first:first+1000])
+    assert np.array_equal(streaming.raw, raw)
+    for suffix,value in streaming.products().items():
+        assert np.allclose(value, reference[suffix], atol=1e-5), suffix
+
+def test_digital_products():
+    dall = np.array([0, 1, 1, 3, 2, 0, 0x80], np.uint8)
+    products = digital_products(dall)
+    bits = np.unpackbits(products['Bits'].reshape(8, -1), axis=1)[:, :len(dall)]
+    for k in range(8):
+        assert np.array_equal(bits[k], (dall >> k) & 1)
+    assert list(products['EdgeCounts']) == [2, 2, 0, 0, 0, 0, 0, 1]
+    edges = np.split(products['Edges'], np.cumsum(products['EdgeCounts'])[:-1])
+    assert list(edges[0]) == [1, 4]
+    assert list(edges[1]) == [3, 5]
+    assert list(edges[7]) == [6]
+
+def test_pulses():
+    raw = np.zeros(1000, np.int16)
+    raw[100:110] = 1000
+    raw[500:520] = 2000
+    raw[995:] = 1000# truncated by the end of the record
+    plan = ['PulseTimes', 'PulseWidths', 'PulseHeights', 'PulseSamples',
+        'PulseSegments']
+    products = pulse_products(raw, 0.001, 0., 0.5, 0.1, False, 0., 1.e-9,
+        5, plan)
+    assert np.allclose(products['PulseTimes'], [99.5e-9, 499.25e-9])
+    assert np.allclose(products['PulseWidths'], [10e-9, 20e-9], rtol=0.05)
+    assert np.allclose(products['PulseHeights'], [1., 2.])
+    assert list(products['PulseSegments']) == [95, 20, 495, 30]
+    assert len(products['PulseSamples']) == 50
+    # negative pulses of the inverted waveform
+    products = pulse_products(-raw, 0.001, 0., -0.5, 0.1, True, 0., 1.e-9,
+        5, plan)
+    assert np.allclose(products['PulseHeights'], [-1., -2.])
@@ -0,0 +1,55 @@
+"""Tests of the background recorder of acquisitions"""
+import os
+import numpy as np
+import pytest
+from epicsdev_tektronix import recorder
+from epicsdev_tektronix.recorder import Recorder, read_binary
+
+def acquisition(acqCount, npoints=100):
+    return {ch: (np.full(npoints, acqCount*10 + ch, np.int16), 0.001*ch,
+        0.5) for ch in (1, 2)}
+
+def record(directory, n, **kwargs):
+    """Record n acquisitions, each one exceeds the rotateMB"""
+    rec = Recorder(str(directory), 'scope_', rotateMB=1.e-6, **kwargs)
+    for acqCount in range(1, n+1):
+        assert rec.put(acqCount, 100.+acqCount, -1.e-6, 1.e-9,
+            acquisition(acqCount))
+    rec.close()
+    assert rec.dropped == 0
+    return rec
+
+def test_binary_rotation(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, 'h5py', None)
+    record(tmp_path, 3)
+    # the rotations within a second do not collide
+    filenames = sorted(os.listdir(tmp_path))
+    assert len(filenames) == 3
+    assert all(name.startswith('scope_') and name.endswith('.bin')
+        for name in filenames)
+    for acqCount,name in enumerate(filenames, 1):
+        records = list(read_binary(str(tmp_path/name)))
+        assert [r['acqCount'] for r in records] == [acqCount]
+        samples, scale, offset = records[0]['channels'][2]
+        assert np.all(samples == acqCount*10 + 2) and (scale, offset) == (0.002, 0.5)
+
+def test_hdf5_rotation(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    record(tmp_path, 3, compression='gzip')
+    filenames = sorted(os.listdir(tmp_path))
+    assert len(filenames) == 3
+    for acqCount,name in enumerate(filenames, 1):
+        with h5py.File(str(tmp_path/name), 'r') as f:
+            assert list(f['acqCount']) == [acqCount]
+            assert list(f.attrs['channels']) == [1, 2]
+            assert np.all(f['c01'][0] == acqCount*10 + 1)
+
+def test_existing_not_overwritten(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, 'h5py', None)
+    monkeypatch.setattr(recorder.time, 'strftime', lambda *_: '20261019_120000')
+    first = record(tmp_path, 1)
+    contents = open(first.filename, 'rb').read()
+    # a restarted recorder numbers its files from 1 again
+    second = record(tmp_path, 1)
+    assert os.path.basename(second.filename) == 'scope_20261019_120000_0002.bin'
+    assert open(first.filename, 'rb').read() == contents
@@ -0,0 +1,67 @@
+"""Tests of the capture and replay of instrument sessions"""
+import numpy as np
+import pytest
+from pyvisa.errors import VisaIOError
+from epicsdev_tektronix.replay import Capture, Replay, read_capture,\
+    source_of, is_query
+
+class Instrument():
+    """Session of a scope, which acquires on every trigger query"""
+    def __init__(self):
+        self.acquisitions = 100
+        self.timeout = 2000
+
+    def write(self, cmd):
+        pass
+
+    def query(self, cmd):
+        if cmd == 'ACQuire:NUMACq?;:HORizontal:RECOrdlength?':
+            self.acquisitions += 1
+            return f'{self.acquisitions};1000'
+        return 'Tektronix,MSO44'
+
+    def query_binary_values(self, cmd, datatype='h', **_):
+        return np.full(10, self.acquisitions, np.int16)
+
+def capture(filename):
+    cap = Capture(filename)
+    session = cap.session(Instrument())
+    session.timeout = 5000# delegated
+    assert session.query('*IDN?') == 'Tektronix,MSO44'
+    for _ in range(2):
+        session.query('ACQuire:NUMACq?;:HORizontal:RECOrdlength?')
+        for ch in (1, 2):
+            session.write(f'DATa:SOUrce CH{ch}')
+            session.query_binary_values('CURVe?', datatype='h')
+    session.query('ACQuire:NUMACq?;:HORizontal:RECOrdlength?')# no transfer
+    cap.close()
+
+def test_capture(tmp_path):
+    filename = str(tmp_path/'session.cap')
+    capture(filename)
+    records = list(read_capture(filename))
+    assert [r[0] for r in records[:4]] == [b'Q', b'Q', b'W', b'B']
+    assert records[3][3] == '<i2' and records[3][4] == 'CURVe?'
+
+def test_replay_renumbered(tmp_path):
+    filename = str(tmp_path/'session.cap')
+    capture(filename)
+    replay = Replay(filename, speed=0.)
+    session = replay.open_resource('TCPIP::replay')
+    assert session.query('*IDN?') == 'Tektronix,MSO44'
+    for acqCount in range(1, 6):
+        reply = session.query('ACQuire:NUMACq?;:HORizontal:RECOrdlength?')
+        assert reply == f'{acqCount};1000'
+        session.write('DATa:SOUrce CH2')
+        samples = session.query_binary_values('CURVe?')
+        # the captured acquisitions 101 and 102 are cycled
+        assert np.all(samples == 101 + (acqCount - 1)%2)
+    assert replay.acquisitions == 5
+    with pytest.raises(VisaIOError):
+        session.query('NOT:CAPTured?')
+
+def test_helpers():
+    assert source_of('DATa:SOUrce CH3;:CURVe?', 'CH1') == 'CH3'
+    assert source_of('DAT:SOU ch2', None) == 'CH2'
+    assert source_of('CURVe?', 'CH1') == 'CH1'
+    assert is_query('*IDN? ') and not is_query('DATa:SOUrce CH1')
@@ -0,0 +1,47 @@
+"""Tests of the ring buffer of acquisitions"""
+import numpy as np
+from epicsdev_tektronix.ringbuffer import RingBuffer
+
+def acquisition(acqCount, npoints=100):
+    return {ch: (np.full(npoints, acqCount*10 + ch, np.int16), 0.001*ch,
+        0.5) for ch in (1, 3)}
+
+def test_write_read(tmp_path):
+    ring = RingBuffer(str(tmp_path/'ring.dat'), 4, 4, 1000)
+    assert ring.range() == (-1, -1)
+    for acqCount in range(1, 7):
+        assert ring.write(acqCount, 100.+acqCount, -1.e-6, 1.e-9,
+            acquisition(acqCount))
+    assert ring.range() == (3, 6)
+    assert ring.find(2) is None
+    acqCount, trigTime, xorigin, xincrement, acquired = ring.read(ring.find(5))
+    assert (acqCount, trigTime, xorigin, xincrement) == (5, 105., -1.e-6, 1.e-9)
+    assert list(acquired) == [1, 3]
+    samples, scale, offset = acquired[3]
+    assert len(samples) == 100 and np.all(samples == 53)
+    assert (scale, offset) == (0.003, 0.5)
+
+def test_too_long(tmp_path):
+    ring = RingBuffer(str(tmp_path/'ring.dat'), 4, 4, 1000)
+    assert not ring.write(1, 0., 0., 1., acquisition(1, 1001))
+    assert ring.range() == (-1, -1)
+
+def test_reused_after_restart(tmp_path):
+    filename = str(tmp_path/'ring.dat')
+    ring = RingBuffer(filename, 4, 4, 1000)
+    for acqCount in range(1, 4):
+        ring.write(acqCount, 0., 0., 1., acquisition(acqCount))
+    ring.flush()
+    del ring
+    ring = RingBuffer(filename, 4, 4, 1000)
+    assert ring.reused and ring.range(allRuns=True) == (1, 3)
+    # the acqCounts of the previous run are not recalled
+    assert ring.range() == (-1, -1) and ring.find(2) is None
+    ring.write(1, 0., 0., 1., acquisition(11))
+    ring.write(2, 0., 0., 1., acquisition(12))
+    assert ring.range() == (1, 2) and ring.range(allRuns=True) == (2, 2)
+    assert np.all(ring.read(ring.find(2))[4][1][0] == 121)
+    assert len(ring.indexes(allRuns=True)) == 4
+    # another geometry starts anew
+    ring = RingBuffer(filename, 8, 4, 1000)
+    assert not ring.reused and ring.range() == (-1, -1)
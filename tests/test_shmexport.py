@@ -0,0 +1,55 @@
+"""Tests of the shared-memory export"""
+import os
+import numpy as np
+import pytest
+from multiprocessing import shared_memory, resource_tracker
+from epicsdev_tektronix.shmexport import ShmWriter, ShmReader
+
+def attach(name):
+    """ShmReader in the process of the writer. The reader unregisters
+    the segment from the resource tracker, register it back for the
+    writer, which unlinks it."""
+    reader = ShmReader(name)
+    resource_tracker.register(reader.shm._name, 'shared_memory')
+    return reader
+
+@pytest.fixture
+def writer():
+    w = ShmWriter(f'tektest{os.getpid()}', 4, 1000)
+    yield w
+    w.close()
+
+def acquisition(acqCount, npoints=100):
+    return {ch: (np.arange(npoints, dtype=np.int16) + acqCount, 0.001*ch,
+        0.1) for ch in (2, 4)}
+
+def test_write_read(writer):
+    reader = attach(writer.name)
+    assert reader.wait(timeout=0.01) is None
+    assert writer.write(7, 123.5, -1.e-6, 1.e-9, acquisition(7))
+    acq = reader.wait(timeout=1.)
+    assert acq['acqCount'] == 7 and acq['npoints'] == 100
+    assert acq['channels'] == [2, 4]
+    assert (acq['trigTime'], acq['xOrigin'], acq['xIncrement'])\
+        == (123.5, -1.e-6, 1.e-9)
+    assert np.array_equal(acq['samples'][3,:100], np.arange(100) + 7)
+    assert acq['scale'][1] == 0.002 and acq['offset'][3] == 0.1
+    assert reader.is_current(acq['sequence'])
+    assert reader.wait(timeout=0.01) is None# nothing new
+    writer.write(8, 124.5, -1.e-6, 1.e-9, acquisition(8))
+    assert not reader.is_current(acq['sequence'])
+    assert reader.wait(timeout=1.)['acqCount'] == 8
+    reader.close()
+
+def test_too_long(writer):
+    assert not writer.write(1, 0., 0., 1., acquisition(1, 1001))
+
+def test_not_an_export():
+    shm = shared_memory.SharedMemory(create=True, size=4096)
+    try:
+        with pytest.raises(ValueError):
+            ShmReader(shm.name)
+        resource_tracker.register(shm._name, 'shared_memory')
+    finally:
+        shm.close()
+        shm.unlink()
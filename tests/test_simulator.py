@@ -0,0 +1,138 @@
+"""Tests of the simulated instrument"""
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+from epicsdev_tektronix.simulator import Simulator, short_form, binary_block
+
+class Client():
+    """Raw socket connection to the simulator"""
+    def __init__(self, port):
+        self.socket = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.f = self.socket.makefile('rb')
+
+    def write(self, cmd):
+        self.socket.sendall((cmd + '\n').encode())
+
+    def query(self, cmd):
+        self.write(cmd)
+        return self.f.readline().decode().strip()
+
+    def read_block(self):
+        """Samples of a binary block"""
+        assert self.f.read(1) == b'#'
+        ndigits = int(self.f.read(1))
+        data = self.f.read(int(self.f.read(ndigits)))
+        assert self.f.read(1) == b'\n'
+        return np.frombuffer(data, '<i2')
+
+    def close(self):
+        self.f.close()
+        self.socket.close()
+
+@pytest.fixture
+def simulator():
+    """Simulator, served on a free port, the tests connect to it with
+    connect()"""
+    sim = Simulator(nchannels=4, rate=20., noise=False)
+    server = sim.listen(0)
+    thread = threading.Thread(target=sim.serve, args=(server,), daemon=True)
+    thread.start()
+    clients = []
+    def connect():
+        clients.append(Client(server.getsockname()[1]))
+        return clients[-1]
+    sim.connect = connect
+    sim.port = server.getsockname()[1]
+    yield sim
+    for client in clients:
+        client.close()
+    server.shutdown(socket.SHUT_RDWR)# wakes up the accept()
+    server.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_short_form():
+    assert short_form(':HORizontal:RECOrdlength') == 'HOR:RECO'
+    assert short_form('horizontal:recordlength') == 'HORI:RECO'
+    assert short_form('DATa:SOUrce') == 'DAT:SOU'
+    assert short_form('*IDN') == '*IDN'
+
+def test_binary_block():
+    assert binary_block(b'\x01\x02') == b'#12\x01\x02\n'
+    assert binary_block(bytes(1000))[:6] == b'#41000'
+
+def test_settings(simulator):
+    client = simulator.connect()
+    assert client.query('*IDN?').startswith('TEKTRONIX,MSO58')
+    # a compound command, the settings are shared by the connections
+    client.write(':HORizontal:RECOrdlength 2000;:CH2:COUPling ac')
+    other = simulator.connect()
+    assert other.query(':HOR:RECO?;:CH2:COUP?;WFMOutpre:NR_Pt?')\
+        == '2000;AC;2000'
+    assert other.query('DATa:SOUrce:AVAILable?') == 'CH1,CH2,CH3,CH4'
+    other.write('DISplay:WAVEView1:CH3:STATE 0')
+    assert client.query('DATa:SOUrce:AVAILable?') == 'CH1,CH2,CH4'
+
+def test_curve(simulator):
+    client = simulator.connect()
+    client.write('HORizontal:RECOrdlength 1000;:DATa:SOUrce CH2')
+    client.write('CURVe?')
+    samples = client.read_block()
+    assert len(samples) == 1000
+    assert np.array_equal(samples, (3000*np.sin(np.arange(1000)*2*np.pi/200
+        + 2)).astype('<i2'))
+    # 8 digital lines of a FlexChannel, one byte per sample
+    client.write('DATa:SOUrce CH5_DALL;:WFMOutpre:BYT_Nr 1;:CURVe?')
+    assert client.f.read(7) == b'#41000\x00'
+
+def test_trigger_rate(simulator):
+    client = simulator.connect()
+    first = int(client.query('ACQuire:NUMACq?'))
+    time.sleep(0.5)
+    assert 8 <= int(client.query('ACQuire:NUMACq?')) - first <= 12
+
+def test_sequence(simulator):
+    client = simulator.connect()
+    client.write('ACQuire:STOPAfter SEQuence;:ACQuire:STATE ON')
+    assert client.query('ACQuire:STATE?;:ACQuire:NUMACq?') == '1;0'
+    time.sleep(0.1)# longer than 1/rate
+    assert client.query('ACQuire:STATE?;:ACQuire:NUMACq?') == '0;1'
+    client.write('ACQuire:STATE ON')
+    assert client.query('ACQuire:STATE?;:ACQuire:NUMACq?') == '1;1'
+
+def test_curveStream(simulator):
+    client = simulator.connect()
+    client.write('HORizontal:RECOrdlength 500;:DATa:SOUrce CH1,CH3')
+    client.write('CURVEStream?')
+    blocks = [client.read_block() for _ in range(6)]
+    assert [len(b) for b in blocks] == [500]*6
+    # the sources alternate
+    assert np.array_equal(blocks[0], blocks[2])
+    assert not np.array_equal(blocks[0], blocks[1])
+    # any command stops the streaming
+    client.write('*CLS')
+    client.socket.settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        while client.socket.recv(1 << 20):# the remainder of the stream
+            pass
+    with pytest.raises(socket.timeout):
+        client.socket.recv(1 << 20)
+    assert simulator.connect().query('HOR:RECO?') == '500'
+
+def test_pyvisa(simulator):
+    """The server talks to the simulator through pyvisa-py"""
+    visa = pytest.importorskip('pyvisa')
+    rm = visa.ResourceManager('@py')
+    scope = rm.open_resource(f'TCPIP::127.0.0.1::{simulator.port}::SOCKET',
+        read_termination='\n', write_termination='\n', timeout=5000)
+    try:
+        scope.write('HORizontal:RECOrdlength 10000;:DATa:SOUrce CH1')
+        assert scope.query('HOR:RECO?') == '10000'
+        samples = scope.query_binary_values('CURVe?', datatype='h',
+            container=np.array)
+        assert len(samples) == 10000
+    finally:
+        scope.close()
+        rm.close()
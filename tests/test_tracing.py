@@ -0,0 +1,36 @@
+"""Tests of the tracing of the acquisition steps"""
+import json
+import threading
+from epicsdev_tektronix.tracing import Tracer, NullTracer, NullSpan
+
+def test_spans(tmp_path):
+    tracer = Tracer(3)
+    lock = threading.Lock()
+    for acqCount in range(1, 3):
+        tracer.acqCount = acqCount
+        with tracer.locked(lock, 'data session'),\
+          tracer.span('CURVe?', ch=1) as span:
+            span.args['bytes'] = 100
+    # the oldest span is dropped
+    assert len(tracer) == 3
+    filename = str(tmp_path/'trace.json')
+    assert tracer.dump(filename) == 3
+    with open(filename) as f:
+        trace = json.load(f)['traceEvents']
+    threads = [event for event in trace if event['ph'] == 'M']
+    spans = [event for event in trace if event['ph'] == 'X']
+    assert threads[0]['args']['name'] == threading.current_thread().name
+    assert [event['name'] for event in spans] == ['CURVe?', 'wait data session',
+        'CURVe?']
+    assert spans[-1]['args'] == {'acqCount':2, 'ch':1, 'bytes':100}
+    assert all(event['dur'] >= 0. for event in spans)
+
+def test_null_tracer():
+    tracer = NullTracer()
+    lock = threading.Lock()
+    assert tracer.locked(lock) is lock
+    with tracer.span('CURVe?', ch=1) as span:
+        assert span is NullSpan
+        span.args['bytes'] = 100
+    # the arguments, written by the callers, are not kept
+    assert NullSpan.args == {} and len(tracer) == 0